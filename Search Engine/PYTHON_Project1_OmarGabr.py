@@ -5,9 +5,8 @@ import mysql.connector
 import urllib.parse
 from urllib.parse import urlparse
 from flask import Flask, request, render_template
-import io
-from PyPDF2 import PdfReader
-import pytesseract
+from ocr_queue import OCRQueue
+from url_stats import get_connection, store_results
 
 # Define the database connection details
 config = {
@@ -26,30 +25,6 @@ search_engines = {
 }
 
 
-def perform_ocr_on_pdf(pdf_data):
-    try:
-        with io.BytesIO(pdf_data) as pdf_file:
-            pdf_reader = PdfReader(pdf_file)
-            text = ''
-            for page in pdf_reader.pages:
-                text += page.extract_text()
-            paragraphs = text.split('\n\n')
-            return '\n\n'.join(paragraphs[:2]).encode('utf-8')
-    except Exception as e:
-        print("An error occurred while trying to extract text from the PDF:", e)
-        return None
-
-def extract_text_from_image(image_data):
-    try:
-        # Extract text from image using pytesseract
-        text = pytesseract.image_to_string(image_data, lang='eng')
-        paragraphs = text.split('\n\n')
-        return '\n\n'.join(paragraphs[:2]).encode('utf-8')
-    except Exception as e:
-        print("An error occurred while trying to extract text from the image:", e)
-        return None
-
-
 def filter_and_parse_results(response, engine, query):
     soup = BeautifulSoup(response.text, 'html.parser')
     results = []
@@ -70,44 +45,30 @@ def filter_and_parse_results(response, engine, query):
                     domain = urlparse(link).netloc
                     title = domain.split('.')[0].capitalize()
     
-                # Perform the Google search
-                try:
-                    page = requests.get(link)
-                    soup = BeautifulSoup(page.content, "html.parser")
-    
-                    text_elements = soup.find_all("p")
-                    text_data = "\n".join([element.text.strip() for element in text_elements])
-                except Exception as e:
-                    print("An error occurred while processing the URL:", link)
-                    print("Error:", e)
-                    # Set the text_data to 'No Description' if an error occurs
-                    text_data = 'No Description'
-
-                # Check if the URL is a PDF or image
+                # Check if the URL is a PDF or image; OCR for those runs in the background (see ocr_queue.py)
                 if link.endswith('.pdf'):
                     info_type = 'PDF'
-                    try:
-                        # Extract text from PDF using OCR
-                        pdf_response = requests.get(link, stream=True)
-                        pdf_data = pdf_response.content
-                        ocr_response = perform_ocr_on_pdf(pdf_data)
-                        text_data = ocr_response.decode('utf-8')
-                        info_type = 'OCR_text'
-                    except:
-                        pass
                 elif link.endswith('.png') or link.endswith('.jpg') or link.endswith('.jpeg') or link.endswith('.gif'):
                     info_type = 'Image'
-                    try:
-                        # Extract text from image using OCR
-                        image_response = requests.get(link, stream=True)
-                        image_data = image_response.content
-                        text_data = extract_text_from_image(image_data)
-                        info_type = 'OCR_text'
-                    except:
-                        pass
                 else:
                     info_type = 'Text'
 
+                # Perform the Google search (PDFs and images are downloaded by the OCR queue instead)
+                if info_type != 'Text':
+                    text_data = 'No Description'
+                else:
+                    try:
+                        page = requests.get(link)
+                        soup = BeautifulSoup(page.content, "html.parser")
+        
+                        text_elements = soup.find_all("p")
+                        text_data = "\n".join([element.text.strip() for element in text_elements])
+                    except Exception as e:
+                        print("An error occurred while processing the URL:", link)
+                        print("Error:", e)
+                        # Set the text_data to 'No Description' if an error occurs
+                        text_data = 'No Description'
+
                 # Extract the domain name from the URL
                 domain_name = urlparse(link).netloc
                 domain_name = domain_name.split('www.')[-1].split('.')[0]
@@ -137,38 +98,11 @@ def filter_and_parse_results(response, engine, query):
             else:
                 text_data = 'No Description'
             
-            # Set the info_type based on the URL type
+            # Set the info_type based on the URL type; OCR for PDFs and images runs in the background
             if url.endswith('.pdf'):
                 info_type = 'PDF'
-                try:
-                    # Perform OCR on PDF
-                    pdf_data = requests.get(url).content
-                    ocr_response = perform_ocr_on_pdf(pdf_data)
-                    if ocr_response:
-                        # If OCR is successful, set info_type to OCR_text
-                        info_type = 'OCR_text'
-                        # Parse OCR text to store title and description separately
-                        decoded_data = ocr_response.decode('utf-8')
-                        title = re.findall(r"^(.*)\n", decoded_data)[0]
-                        text_data = re.findall(r"\n(.*)", decoded_data)[0]
-                except Exception as e:
-                    print("An error occurred while trying to extract text from the PDF:", e)
-                    # If OCR fails, just store the original text
-                    text_data = 'No Description'
             elif url.endswith('.png') or url.endswith('.jpg') or url.endswith('.jpeg') or url.endswith('.gif'):
                 info_type = 'Image'
-                try:
-                    # Extract text from image using OCR
-                    img_response = requests.get(url, stream=True)
-                    img_data = img_response.content
-                    ocr_response = extract_text_from_image(img_data)
-                    if ocr_response:
-                        # If OCR is successful, set info_type to OCR_text
-                        info_type = 'OCR_text'
-                        text_data = ocr_response
-                except Exception as e:
-                    print("An error occurred while trying to extract text from the image:", e)
-                    text_data = 'No Description'
             else:
                 info_type = 'Text'
             
@@ -200,39 +134,14 @@ def filter_and_parse_results(response, engine, query):
             # Format the title
             formatted_title = f"{domain_name.capitalize()}: {title}"
     
-            # Determine the info type of the URL content
+            # Determine the info type of the URL content; OCR for PDFs and images runs in the background
             if link_yahoo.endswith('.pdf'):
-                # Download the PDF file
-                pdf_response = requests.get(link_yahoo)
-                pdf_data = pdf_response.content
-                # Perform OCR on the PDF file
-                try:
-                    ocr_response = perform_ocr_on_pdf(pdf_data)
-                    text_data = ocr_response.decode('utf-8') if ocr_response is not None else desc
-                    info_type = 'OCR_text'
-                except:
-                    text_data = desc
-                    info_type = 'PDF'
+                info_type = 'PDF'
             elif link_yahoo.endswith('.png') or link_yahoo.endswith('.jpg') or link_yahoo.endswith('.jpeg') or link_yahoo.endswith('.gif'):
                 info_type = 'Image'
-                try:
-                    # Extract text from image using OCR
-                    image_response = requests.get(link_yahoo, stream=True)
-                    image_data = image_response.content
-                    ocr_response = extract_text_from_image(image_data)
-                    if ocr_response:
-                        # If OCR is successful, set info_type to OCR_text
-                        info_type = 'OCR_text'
-                        text_data = ocr_response
-                    else:
-                        # If OCR fails, just store the original text
-                        text_data = desc
-                except Exception as e:
-                    print("An error occurred while trying to extract text from the image:", e)
-                    text_data = desc
             else:
                 info_type = 'Text'
-                text_data = desc
+            text_data = desc
     
             results.append((link_yahoo, 'Yahoo', len(query.split()), formatted_title, text_data, info_type))
     
@@ -246,6 +155,9 @@ def filter_and_parse_results(response, engine, query):
 # Initialize set to store domain names
 domain_names = set()
 
+# Background OCR worker queue for PDF and image results
+ocr_queue = OCRQueue(config)
+
 # Define the Flask app
 app = Flask(__name__)
 
@@ -259,8 +171,8 @@ def index():
         # Get the search query from the form
         search_query = request.form['query']
 
-        # Connect to the database
-        cnx = mysql.connector.connect(user=config['user'], password=config['password'], host=config['host'], database=config['database'])
+        # Take a connection from the pool
+        cnx = get_connection(config)
         cursor = cnx.cursor()
 
         # Process each search engine
@@ -276,14 +188,10 @@ def index():
             # Parse the HTML response and filter the search results
             results = filter_and_parse_results(response, engine, search_query)
         
-            # Process each search result and add it to the database
+            # Keep one result per domain name
+            new_results = []
             for result in results:
-                url = result[0]
-                title = result[3]
-                text_data = result[4]
-                search_term_id = None
-        
-                domain_name = title.split(':')[0]
+                domain_name = result[3].split(':')[0]
         
                 # Check if the domain name is already in the set
                 if domain_name in domain_names:
@@ -291,42 +199,20 @@ def index():
         
                 # Add the domain name to the set
                 domain_names.add(domain_name)
-        
-                # Insert the URL into the database
-                add_url = ("INSERT INTO search_term "
-                           "(url, search_engine, number_of_search_terms, search) "
-                           "VALUES (%s, %s, %s, %s)")
-                try:
-                    cursor.execute(add_url, (url, engine, len(search_query.split()), search_query))
-                    cnx.commit()
-                    search_term_id = cursor.lastrowid
-                except mysql.connector.Error as err:
-                    print("Error: {}".format(err))
-        
-                # Get the info type of the URL content
-                info_type = result[5]
-        
-                # Insert the parsed URL data into the database
-                add_parsed_url = ("INSERT INTO parsed_url "
-                                  "(Results_ID, title, description, info_type) "
-                                  "VALUES (%s, %s, SUBSTRING(%s, 1, 500), %s)")
-                cursor.execute(add_parsed_url, (search_term_id, title, text_data, info_type))
-                cnx.commit()
-        
-                # Compute the occurrence count of search terms and insert them into the database
-                search_terms = search_query.lower().split()
-                for term in search_terms:
-                    count = 0
-                    for result in results:
-                        if term in result[3].lower() or term in result[4].lower():
-                            count += 1
-        
-                    # Insert the occurrence count into the database
-                    add_url_stats = ("INSERT INTO url_stats "
-                                     "(Stats_ID, stats_url, occurrence_count) "
-                                     "VALUES (%s, %s, %s)")
-                    cursor.execute(add_url_stats, (search_term_id, url, count))
-                    cnx.commit()
+                new_results.append(result)
+
+            # Store the results, their parsed data and the search term occurrence counts in one transaction
+            # Occurrence counts are taken over all of this engine's results, including skipped domains
+            # A failed write was rolled back; the other engines' results are still stored
+            try:
+                stored = store_results(cnx, search_query, engine, new_results, counted_results=results)
+            except mysql.connector.Error:
+                continue
+
+            # Queue OCR for PDFs and images; the text shows up in parsed_url on later queries
+            for search_term_id, url, info_type in stored:
+                if info_type in ('PDF', 'Image'):
+                    ocr_queue.submit(url, info_type, search_term_id)
         
         # Fetch the search results from the database
         select_urls = ("SELECT DISTINCT search_term.url, parsed_url.title, parsed_url.description, parsed_url.info_type, search_term.search_engine, url_stats.occurrence_count "
@@ -349,7 +235,7 @@ def index():
                 filtered_results.append(result)
                 visited_domains.add(domain)
     
-        # Close the database connection
+        # Return the connection to the pool
         cursor.close()
         cnx.close()
     
@@ -358,13 +244,13 @@ def index():
 
     # If the request method is GET, render the search page
     # Fetch recent search queries
-    cnx = mysql.connector.connect(user=config['user'], password=config['password'], host=config['host'], database=config['database'])
+    cnx = get_connection(config)
     cursor = cnx.cursor()
     fetch_recent_searches = "SELECT search_query FROM recent_searches ORDER BY search_date DESC LIMIT 10"
     cursor.execute(fetch_recent_searches)
     recent_searches = [row[0] for row in cursor.fetchall()]
 
-    # Close the database connection
+    # Return the connection to the pool
     cursor.close()
     cnx.close()
 
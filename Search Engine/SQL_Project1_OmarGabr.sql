@@ -5,4 +5,21 @@ USE my_custom_bot;
 # (1) search_term: id (primary), search,  number of terms in search query
 DESCRIBE search_term;
 
+# (2) ocr_jobs: one OCR job per distinct file (SHA-256 of its content), with status tracking; indexed by URL so a
+#     file already OCR'd is found before it is downloaded again
+CREATE TABLE IF NOT EXISTS ocr_jobs (
+    content_hash CHAR(64) PRIMARY KEY,
+    url TEXT,
+    info_type VARCHAR(16),
+    status ENUM('pending', 'running', 'done', 'failed') NOT NULL DEFAULT 'pending',
+    text MEDIUMTEXT,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    INDEX (url(255))
+);
 
+# (3) ocr_targets: parsed_url rows waiting on (or filled from) an OCR job
+CREATE TABLE IF NOT EXISTS ocr_targets (
+    Results_ID INT PRIMARY KEY,
+    content_hash CHAR(64) NOT NULL,
+    INDEX (content_hash)
+);
@@ -0,0 +1,153 @@
+import io
+import hashlib
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import requests
+from url_stats import get_connection
+from PyPDF2 import PdfReader
+import pytesseract
+from PIL import Image
+
+
+def perform_ocr_on_pdf(pdf_data):
+    try:
+        with io.BytesIO(pdf_data) as pdf_file:
+            pdf_reader = PdfReader(pdf_file)
+            text = ''
+            for page in pdf_reader.pages:
+                text += page.extract_text()
+            paragraphs = text.split('\n\n')
+            return '\n\n'.join(paragraphs[:2]).encode('utf-8')
+    except Exception as e:
+        print("An error occurred while trying to extract text from the PDF:", e)
+        return None
+
+def extract_text_from_image(image_data):
+    try:
+        # Extract text from image using pytesseract
+        text = pytesseract.image_to_string(Image.open(io.BytesIO(image_data)), lang='eng')
+        paragraphs = text.split('\n\n')
+        return '\n\n'.join(paragraphs[:2]).encode('utf-8')
+    except Exception as e:
+        print("An error occurred while trying to extract text from the image:", e)
+        return None
+
+
+# Worker process entry point: run the OCR function for a file type and return the text (or None)
+def run_ocr(info_type, data):
+    if info_type == 'PDF':
+        ocr_response = perform_ocr_on_pdf(data)
+    else:
+        ocr_response = extract_text_from_image(data)
+    return ocr_response.decode('utf-8') if ocr_response else None
+
+
+# Background OCR for PDFs and images found in search results
+# Downloads run on a thread pool and OCR on a process pool, so a search never waits for either.
+# Jobs are keyed by the SHA-256 of the downloaded file: the same file is only OCR'd once,
+# and every parsed_url row pointing at it is filled in when the job finishes. A URL whose file was already
+# OCR'd is not downloaded again. Connections come from the shared pool (see url_stats.get_connection).
+class OCRQueue:
+    def __init__(self, config, ocr_workers=2, download_workers=4):
+        self.config = config
+        self.ocr_pool = ProcessPoolExecutor(ocr_workers)
+        self.download_pool = ThreadPoolExecutor(download_workers)
+        # Content hash -> future of a job running in this process
+        self.running = {}
+        self.lock = threading.Lock()
+        self.expire_unfinished()
+
+    # Mark jobs an earlier process left pending or running as failed, since nothing is working on them now
+    # A later search that finds the same file queues it again
+    def expire_unfinished(self):
+        cnx = get_connection(self.config)
+        cursor = cnx.cursor()
+        try:
+            cursor.execute("UPDATE ocr_jobs SET status = 'failed' WHERE status IN ('pending', 'running')")
+            if cursor.rowcount:
+                print("Expired %d OCR jobs left unfinished by an earlier run" % cursor.rowcount)
+            cnx.commit()
+        finally:
+            cursor.close()
+            cnx.close()
+
+    # Queue OCR for a result; parsed_url row results_id is updated when the text is ready
+    def submit(self, url, info_type, results_id):
+        return self.download_pool.submit(self.process, url, info_type, results_id)
+
+    # Reuse finished OCR text for a URL, or download the file and reuse the text for its content or run OCR
+    def process(self, url, info_type, results_id):
+        # Check for a finished job from this URL before downloading, without holding a connection during the download
+        cnx = get_connection(self.config)
+        cursor = cnx.cursor()
+        try:
+            cursor.execute("SELECT content_hash FROM ocr_jobs WHERE url = %s AND status = 'done' LIMIT 1", (url,))
+            job = cursor.fetchone()
+        finally:
+            cursor.close()
+            cnx.close()
+
+        data = None
+        if job is not None:
+            content_hash = job[0]
+        else:
+            try:
+                data = requests.get(url, timeout=30).content
+            except Exception as e:
+                print("An error occurred while downloading the file for OCR:", url, e)
+                return None
+            content_hash = hashlib.sha256(data).hexdigest()
+
+        cnx = get_connection(self.config)
+        cursor = cnx.cursor()
+        try:
+            # Remember which result this file belongs to
+            cursor.execute("INSERT IGNORE INTO ocr_targets (Results_ID, content_hash) VALUES (%s, %s)",
+                           (results_id, content_hash))
+            cursor.execute("SELECT status, text FROM ocr_jobs WHERE content_hash = %s", (content_hash,))
+            job = cursor.fetchone()
+            if job is None:
+                cursor.execute("INSERT IGNORE INTO ocr_jobs (content_hash, url, info_type, status) VALUES (%s, %s, %s, 'pending')",
+                               (content_hash, url, info_type))
+            cnx.commit()
+
+            if job is not None and job[0] == 'done':
+                text = job[1]
+            else:
+                text = self.ocr(content_hash, info_type, data, cnx, cursor)
+
+            # Fill in every result that points at this file
+            if text:
+                cursor.execute("UPDATE parsed_url SET description = SUBSTRING(%s, 1, 500), info_type = 'OCR_text' "
+                               "WHERE Results_ID IN (SELECT Results_ID FROM ocr_targets WHERE content_hash = %s)",
+                               (text, content_hash))
+                cnx.commit()
+            return text
+        finally:
+            cursor.close()
+            cnx.close()
+
+    # Run OCR for a file on the process pool, sharing the job with any concurrent request for the same file
+    def ocr(self, content_hash, info_type, data, cnx, cursor):
+        with self.lock:
+            future = self.running.get(content_hash)
+            owner = future is None
+            if owner:
+                future = self.running[content_hash] = self.ocr_pool.submit(run_ocr, info_type, data)
+        if not owner:
+            return future.result()
+
+        cursor.execute("UPDATE ocr_jobs SET status = 'running' WHERE content_hash = %s", (content_hash,))
+        cnx.commit()
+        try:
+            text = future.result()
+        except Exception as e:
+            print("An error occurred while running OCR:", e)
+            text = None
+        finally:
+            with self.lock:
+                del self.running[content_hash]
+        cursor.execute("UPDATE ocr_jobs SET status = %s, text = %s WHERE content_hash = %s",
+                       ('done' if text else 'failed', text, content_hash))
+        cnx.commit()
+        return text
@@ -0,0 +1,89 @@
+import time
+import sqlite3
+import threading
+import mysql.connector
+import mysql.connector.pooling
+
+
+# Shared connection pool, created on first use
+pool = None
+pool_lock = threading.Lock()
+
+
+# Get a pooled MySQL connection; close() hands it back to the pool instead of disconnecting
+# The pool raises PoolError when every connection is checked out, so a request beyond pool_size waits up to
+# timeout seconds for one to come back instead of failing (Flask serves requests on as many threads as arrive)
+def get_connection(config, pool_size=5, timeout=30):
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = mysql.connector.pooling.MySQLConnectionPool(pool_name='search_engine', pool_size=pool_size, **config)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return pool.get_connection()
+        except mysql.connector.errors.PoolError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.05)
+
+
+# Count, for each query term, how many results mention it in their title or text
+# Each result is lowercased once, so this is one pass over the results rather than one per result and term
+def term_document_frequency(results, terms):
+    frequency = dict.fromkeys(terms, 0)
+    for result in results:
+        text = result[3].lower() + '\n' + result[4].lower()
+        for term in frequency:
+            if term in text:
+                frequency[term] += 1
+    return frequency
+
+
+# Store one engine's parsed results with their search terms and url_stats rows, in one transaction
+# results are (url, engine, number_of_terms, title, text_data, info_type) tuples from filter_and_parse_results
+# Occurrence counts are taken over counted_results when given (e.g. before dropping repeated domains), else over results
+# Works on a MySQL connection or a sqlite3 one (see sqlite_schema), which only differ in placeholder style
+# Returns (search_term_id, url, info_type) for every stored result; on a database error the transaction is
+# rolled back and the error re-raised, so callers can tell a failure from an empty result list
+def store_results(cnx, search_query, engine, results, counted_results=None):
+    if not results:
+        return []
+    placeholder = '?' if isinstance(cnx, sqlite3.Connection) else '%s'
+    sql = lambda statement: statement.replace('%s', placeholder)
+    number_of_terms = len(search_query.split())
+    search_terms = search_query.lower().split()
+    frequency = term_document_frequency(results if counted_results is None else counted_results, search_terms)
+    cursor = cnx.cursor()
+    try:
+        # Rows already stored for this query and engine keep their ids; only ids above this one are new
+        cursor.execute(sql("SELECT COALESCE(MAX(id), 0) FROM search_term WHERE search = %s AND search_engine = %s"), (search_query, engine))
+        last_id = cursor.fetchone()[0]
+        cursor.executemany(sql("INSERT INTO search_term (url, search_engine, number_of_search_terms, search) VALUES (%s, %s, %s, %s)"),
+                           [(result[0], engine, number_of_terms, search_query) for result in results])
+        # Read the new ids back rather than trusting lastrowid, which a batched insert reports for one row only
+        cursor.execute(sql("SELECT id, url FROM search_term WHERE search = %s AND search_engine = %s AND id > %s ORDER BY id"),
+                       (search_query, engine, last_id))
+        ids = cursor.fetchall()
+        stored = [(search_term_id, url, result[3], result[4], result[5]) for (search_term_id, url), result in zip(ids, results)]
+        cursor.executemany(sql("INSERT INTO parsed_url (Results_ID, title, description, info_type) VALUES (%s, %s, SUBSTRING(%s, 1, 500), %s)"),
+                           [(search_term_id, title, text_data, info_type) for search_term_id, _, title, text_data, info_type in stored])
+        cursor.executemany(sql("INSERT INTO url_stats (Stats_ID, stats_url, occurrence_count) VALUES (%s, %s, %s)"),
+                           [(search_term_id, url, frequency[term]) for search_term_id, url, _, _, _ in stored for term in search_terms])
+        cnx.commit()
+    except (mysql.connector.Error, sqlite3.Error) as err:
+        cnx.rollback()
+        print("Error: {}".format(err))
+        raise
+    finally:
+        cursor.close()
+    return [(search_term_id, url, info_type) for search_term_id, url, _, _, info_type in stored]
+
+
+# Tables store_results writes, for running it against SQLite instead of MySQL
+sqlite_schema = [
+    "CREATE TABLE search_term (id INTEGER PRIMARY KEY AUTOINCREMENT, url TEXT, search_engine TEXT, number_of_search_terms INTEGER, search TEXT)",
+    "CREATE TABLE parsed_url (Results_ID INTEGER, title TEXT, description TEXT, info_type TEXT)",
+    "CREATE TABLE url_stats (Stats_ID INTEGER, stats_url TEXT, occurrence_count INTEGER)",
+]
+
@@ -0,0 +1,97 @@
+import os
+import re
+import html
+import random
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Directory of recorded engine results pages, named <engine>.html (e.g. Google.html)
+# Recorded pages keep the engine's markup, ads and navigation links, so the engine parsers pick results
+# out of them as they would live. Result URLs are replaced with placeholders: {{url:N}} is the Nth
+# result link, {{quoted:N}} the same link percent-encoded (for redirect URLs) and {{query}} the query.
+# Engines without a recording get a generated results page in that engine's link format
+fixtures_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Vocabulary for synthetic page text; word frequencies roughly follow Zipf's law
+vocabulary = ['w%d' % i for i in range(5000)]
+vocabulary_weights = [1.0 / (rank + 1) for rank in range(len(vocabulary))]
+
+# Generate deterministic synthetic text for a seed
+def synthetic_text(seed, words):
+    rng = random.Random(seed)
+    return ' '.join(rng.choices(vocabulary, vocabulary_weights, k=words))
+
+# Generate a synthetic result page with a title and paragraphs, plus the script/style noise real pages have
+def synthetic_page(page_id, paragraphs=20, words_per_paragraph=60):
+    rng = random.Random(page_id)
+    body = ''.join('<p>%s</p>\n' % synthetic_text('%d-%d' % (page_id, i), rng.randint(words_per_paragraph // 2, words_per_paragraph * 2))
+                   for i in range(paragraphs))
+    return ('<html><head><title>Page %d %s</title><style>p { color: black; }</style>'
+            '<script>var x = %d;</script></head><body><div>%s</div></body></html>') % (page_id, synthetic_text(page_id, 4), page_id, body)
+
+# An engine's recorded results page for a query with its result links pointed at links, or None without a recording
+def recorded_results_page(engine, query, links):
+    path = os.path.join(fixtures_dir, engine + '.html')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        recorded = f.read()
+    def link(match):
+        url = links[int(match.group(2))]
+        return urllib.parse.quote(url, safe='') if match.group(1) == 'quoted' else url
+    return re.sub(r'\{\{(url|quoted):(\d+)\}\}', link, recorded.replace('{{query}}', html.escape(query)))
+
+# Local stand-in for the search engines and the sites they link to
+#   /engine/<Engine>?q=<query>  results page linking to results_per_page synthetic pages
+#   /page/<n>                   synthetic result page n
+class FixtureHandler(BaseHTTPRequestHandler):
+    results_per_page = 10
+
+    def do_GET(self):
+        parts = urllib.parse.urlparse(self.path)
+        if parts.path.startswith('/engine/'):
+            engine = parts.path[len('/engine/'):]
+            query = urllib.parse.parse_qs(parts.query).get('q', [''])[0]
+            self.respond(self.results_page(engine, query))
+        elif parts.path.startswith('/page/'):
+            self.respond(synthetic_page(int(parts.path[len('/page/'):])))
+        else:
+            self.send_error(404)
+
+    # Results page for an engine; the linked page ids depend on the query, so different queries
+    # crawl different pages
+    def results_page(self, engine, query):
+        base = 'http://%s:%d' % self.server.server_address
+        first = random.Random(engine + query).randrange(1000000)
+        links = [base + '/page/%d' % (first + i) for i in range(self.results_per_page)]
+        recorded = recorded_results_page(engine, query, links)
+        if recorded is not None:
+            return recorded
+        if engine == 'Google':
+            # Google wraps result links in /url?q=...&sa=...
+            links = ['/url?q=%s&sa=U' % link for link in links]
+        return '<html><body>%s</body></html>' % ''.join('<div><a href="%s">Result %d</a></div>' % (link, i) for i, link in enumerate(links))
+
+    def respond(self, html):
+        body = html.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Keep benchmark output quiet
+    def log_message(self, format, *args):
+        pass
+
+# Start the fixture server on a free local port in a background thread; returns (server, base_url)
+def start_fixture_server(host='127.0.0.1', port=0):
+    server = ThreadingHTTPServer((host, port), FixtureHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://%s:%d' % server.server_address
+
+if __name__ == '__main__':
+    server, base_url = start_fixture_server(port=8765)
+    print('Serving fixtures at ' + base_url)
+    threading.Event().wait()
@@ -0,0 +1,187 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import resource
+import subprocess
+
+# Benchmarks import the engine modules from the repository root
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_root)
+
+from fixture_server import start_fixture_server, synthetic_page, synthetic_text, vocabulary
+
+# Percentile of a list of latencies (nearest rank)
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+
+# Run a stage and return (result, seconds, max_rss_kb), where max_rss_kb is the process peak so far
+def measure(stage, *args):
+    start = time.perf_counter()
+    result = stage(*args)
+    seconds = time.perf_counter() - start
+    return result, seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+# Benchmark get_raw_text on one core and on the extraction process pool
+def bench_extraction(pages, workers):
+    from extraction import get_raw_text, ExtractionPool
+    htmls = [synthetic_page(i) for i in range(pages)]
+    start = time.perf_counter()
+    for html in htmls:
+        get_raw_text(html)
+    single = pages / (time.perf_counter() - start)
+    pool = ExtractionPool(workers)
+    # Warm the workers up before timing
+    list(pool.extract(('<p>warm up</p>', str(i)) for i in range(pool.workers)))
+    start = time.perf_counter()
+    list(pool.extract((html, str(i)) for i, html in enumerate(htmls)))
+    pooled = pages / (time.perf_counter() - start)
+    pool.close()
+    return {'pages': pages, 'page_bytes': sum(map(len, htmls)) // pages, 'single_process_pages_per_sec': single,
+            'pool_pages_per_sec': pooled, 'pool_workers': pool.workers}
+
+# Benchmark end-to-end populate_database against the fixture server
+def bench_populate(base_url, db_file, queries):
+    import search_functions
+    from engine_config import search_engines, js_engines
+    from page_cache import get_page_cache
+    # Point every engine at the fixture server and fetch them all as static HTML
+    for engine in search_engines:
+        search_engines[engine] = base_url + '/engine/' + engine + '?q='
+    del js_engines[:]
+    # A throwaway page cache with ttl=0, so every page is really downloaded
+    get_page_cache(path=db_file + '.page_cache', ttl=0)
+    latencies = []
+    for query in queries:
+        for engine in search_engines:
+            start = time.perf_counter()
+            search_functions.populate_database(query, engine, db_file)
+            latencies.append(time.perf_counter() - start)
+    from database import connect
+    connection = connect(db_file)
+    documents = connection.execute('SELECT COUNT(*) FROM documents').fetchone()[0]
+    connection.close()
+    return {'crawls': len(latencies), 'documents': documents, 'crawl_p50_ms': percentile(latencies, 50) * 1000,
+            'crawl_p99_ms': percentile(latencies, 99) * 1000, 'documents_per_sec': documents / sum(latencies)}
+
+# Fill a database with synthetic documents through the normal upsert path
+def build_corpus(db_file, size, words=200, batch=10000):
+    from database import connect
+    from schema import url_hash, write_documents
+    from doc_store import get_doc_store
+    from query_cache import bump_generation
+    connection = connect(db_file)
+    cursor = connection.cursor()
+    store = get_doc_store(db_file, cursor)
+    with connection:
+        generation = bump_generation(cursor)
+        for first in range(0, size, batch):
+            rows = []
+            for doc_id in range(first, min(size, first + batch)):
+                url = 'http://corpus.test/%d' % doc_id
+                rows.append((url_hash(url), url, synthetic_text('t%d' % doc_id, 4), synthetic_text('d%d' % doc_id, words)))
+            write_documents(cursor, store, rows, generation)
+    cursor.close()
+    connection.close()
+
+# Benchmark search latency for a corpus, with the query cache off
+# backend 'rerank' is the index backend with TF-IDF cosine re-ranking
+def bench_search(db_file, queries, backend):
+    from data_processing import search
+    from inverted_index import start_index, index_ready
+    options = {'backend': 'index', 'rerank': True} if backend == 'rerank' else {'backend': backend}
+    # The index is built before the first query, as the app does at startup; the growth of the process peak
+    # RSS is what it cost. Corpora over INDEX_MAX_DOCUMENTS are answered by FTS5, reported as fts_fallback
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    if options['backend'] == 'index':
+        thread = start_index(db_file)
+        if thread is not None:
+            thread.join()
+    search(queries[0], db_file, k=10, use_cache=False, **options)
+    first = time.perf_counter() - start
+    index_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        search(query, db_file, k=10, use_cache=False, **options)
+        latencies.append(time.perf_counter() - start)
+    return {'first_query_ms': first * 1000, 'first_query_rss_kb': index_rss, 'p50_ms': percentile(latencies, 50) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000, 'queries': len(queries),
+            'fts_fallback': options['backend'] == 'index' and not index_ready(db_file)}
+
+# Random two- and three-word queries over mid-frequency vocabulary
+def make_queries(count, seed=0):
+    rng = random.Random(seed)
+    return [' '.join(rng.sample(vocabulary[10:2000], rng.randint(2, 3))) for _ in range(count)]
+
+# Current git commit, so results can be compared between commits
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=repo_root, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Print the ratio of each numeric metric to the same metric in an earlier results file
+def compare(results, baseline_file):
+    with open(baseline_file) as f:
+        baseline = json.load(f)['results']
+    for stage, metrics in results.items():
+        for name, value in metrics.items():
+            old = baseline.get(stage, {}).get(name)
+            if isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+                print('%-40s %12.2f -> %12.2f  (x%.2f)' % (stage + '.' + name, old, value, value / old))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ingest, extraction and search against local fixtures')
+    parser.add_argument('--sizes', default='1000,10000,100000', help='comma-separated corpus sizes for search benchmarks (up to 1000000)')
+    parser.add_argument('--queries', type=int, default=200, help='queries per search benchmark')
+    parser.add_argument('--crawl-queries', type=int, default=3, help='queries crawled across every engine for the populate benchmark')
+    parser.add_argument('--pages', type=int, default=500, help='pages for the extraction benchmark')
+    parser.add_argument('--workers', type=int, default=None, help='extraction pool size (default: CPU count)')
+    parser.add_argument('--backends', default='index,fts', help='search backends to benchmark (index, fts or rerank)')
+    parser.add_argument('--output', default='benchmark_results.json', help='where to write the JSON results')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='search-bench-')
+    server, base_url = start_fixture_server()
+    results = {}
+    try:
+        result, seconds, rss = measure(bench_extraction, args.pages, args.workers)
+        results['extraction'] = dict(result, max_rss_kb=rss)
+
+        result, seconds, rss = measure(bench_populate, base_url, os.path.join(workdir, 'crawl.db'), make_queries(args.crawl_queries, seed=1))
+        results['populate'] = dict(result, seconds=seconds, max_rss_kb=rss)
+
+        queries = make_queries(args.queries)
+        for size in [int(size) for size in args.sizes.split(',')]:
+            db_file = os.path.join(workdir, 'corpus-%d.db' % size)
+            _, seconds, _ = measure(build_corpus, db_file, size)
+            for backend in args.backends.split(','):
+                result, _, rss = measure(bench_search, db_file, queries, backend)
+                results['search_%s_%d' % (backend, size)] = dict(result, build_seconds=seconds, max_rss_kb=rss)
+    finally:
+        # Close the shared fetcher's session, if the populate benchmark opened one
+        import search_functions
+        if search_functions.fetcher is not None:
+            search_functions.fetcher.close()
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {'commit': git_commit(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+              'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, 'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == '__main__':
+    main()
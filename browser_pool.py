@@ -0,0 +1,82 @@
+import queue
+import threading
+
+# Shared pool of WebDriver browsers for the few engines that only render results with JavaScript
+# Browsers are started on first use and reused across queries, so a query pays for one page load
+# rather than a browser launch; failures raise instead of exiting the process.
+class BrowserPool:
+    def __init__(self, size=2, driver='Safari'):
+        # Most browsers running at once, and the selenium webdriver class that starts them
+        self.size = size
+        self.driver = driver
+        self.idle = queue.Queue()
+        self.started = 0
+        self.lock = threading.Lock()
+
+    # Start a browser; selenium is only imported when a browser is actually needed
+    def start(self):
+        from selenium import webdriver
+        return getattr(webdriver, self.driver)()
+
+    # Take an idle browser, start one if the pool has room, or wait for one to come back
+    def acquire(self):
+        while True:
+            with self.lock:
+                start = self.idle.empty() and self.started < self.size
+                if start:
+                    self.started += 1
+            if start:
+                try:
+                    return self.start()
+                except Exception:
+                    with self.lock:
+                        self.started -= 1
+                    raise
+            # Wake up now and then in case a broken browser freed its slot
+            try:
+                return self.idle.get(timeout=1)
+            except queue.Empty:
+                continue
+
+    # Load a URL and return the rendered page source
+    # A browser that fails is shut down and replaced on a later call
+    def render(self, url):
+        import selenium.common.exceptions
+        browser = self.acquire()
+        try:
+            browser.get(url)
+            html = browser.page_source
+        except selenium.common.exceptions.WebDriverException as e:
+            self.discard(browser)
+            raise RuntimeError('Error: WebDriverException (%s browser) %s' % (self.driver, e))
+        self.idle.put(browser)
+        return html
+
+    # Shut down a broken browser and free its slot
+    def discard(self, browser):
+        try:
+            browser.quit()
+        except Exception:
+            pass
+        with self.lock:
+            self.started -= 1
+
+    # Shut down every idle browser
+    def close(self):
+        while True:
+            try:
+                self.discard(self.idle.get_nowait())
+            except queue.Empty:
+                return
+
+# Shared browser pool, created on first use
+browser_pool = None
+browser_pool_lock = threading.Lock()
+
+# Get the shared browser pool; size and driver only apply when it is first created
+def get_browser_pool(size=2, driver='Safari'):
+    global browser_pool
+    with browser_pool_lock:
+        if browser_pool is None:
+            browser_pool = BrowserPool(size, driver)
+    return browser_pool
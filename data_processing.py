@@ -1,12 +1,18 @@
 from collections import Counter
-import nltk
-from nltk.corpus import stopwords
-from nltk.tokenize import word_tokenize
-import sqlite3
+from query_analyzer import get_analyzer
+from database import connect
+from query_cache import query_cache
+from fingerprint import NearDuplicateFilter, load_fingerprints
+from inverted_index import get_index, index_ready, tokenize
+import reranker
+from fts_index import fts_search
+from snippets import build_snippet
+from doc_store import get_doc_store
+from metrics import span, count
 
 # Function for removing stopwords from passed text 
 def remove_stop_words(text, stop_words):
-    tokens = word_tokenize(text)
+    tokens = get_analyzer().tokenize(text)
     return [w for w in tokens if not w.lower() in stop_words]
 
 # Function to count the occurrences of keywords 
@@ -24,44 +30,160 @@ def dict_to_tuple(d):
     return sorted(tuple(zip(keys, values)), key=lambda x: -x[1]), sum_counts
 
 # Function for performing search in the SQLite database
-def search(query, db_file): 
-    # Downloading necessary NLTK data
-    nltk.download('stopwords')
-    nltk.download('punkt')
-    # Get stop_words from NLTK
-    stop_words = set(stopwords.words('english'))
-    # Get keywords from query 
-    query_keywords = remove_stop_words(query, stop_words)
+# Returns (url, title, description, keyword_counts, total) tuples in ranked order
+# backend='index' ranks with the in-process inverted index, backend='fts' with SQLite FTS5
+# The index backend is answered by FTS5 while the index is built in the background, or when the database is
+# too big to index (see inverted_index.get_index); rerank needs the index and is skipped then
+# snippets=True returns a short HTML snippet around the query terms in place of the full text
+# analyzer defaults to the shared process-wide query analyzer
+# Results are cached per analyzed query until the next write bumps the database generation
+# collapse=True drops results that are near-duplicates of a higher-ranked result
+# rerank=True re-orders the best rerank_depth BM25 candidates by TF-IDF cosine similarity (index backend only)
+# offset skips that many ranked results, so k results from offset make one page; only offset + k are ranked
+def search_documents(query, db_file, k=None, backend='index', snippets=False, analyzer=None, use_cache=True, collapse=True, rerank=False, offset=0): 
+    # Get keywords from query using the analyzer loaded once per process
+    query_keywords = (analyzer or get_analyzer()).analyze(query)
+    if backend == 'index' and not index_ready(db_file):
+        backend = 'fts'
 
+    # Serve repeated queries from the query cache
+    if use_cache:
+        key = (db_file, backend, k, offset, snippets, collapse, rerank, tuple(query_keywords))
+        generation = query_cache.generation(db_file)
+        cached = query_cache.get(key, generation)
+        if cached is not None:
+            count('searches_total', backend=backend, cached='true')
+            return cached
+        formatted_results = search_documents(query, db_file, k, backend, snippets, analyzer, use_cache=False, collapse=collapse, rerank=rerank, offset=offset)
+        query_cache.put(key, generation, formatted_results)
+        return formatted_results
+
+    count('searches_total', backend=backend, cached='false')
+    with span('search', backend=backend):
+        return rank_documents(query_keywords, db_file, k, backend, snippets, collapse, rerank, offset)
+
+# Number of BM25 candidates re-scored when re-ranking
+rerank_depth = 1000
+
+# Rank stored documents for analyzed query keywords; see search_documents
+def rank_documents(query_keywords, db_file, k, backend, snippets, collapse, rerank=False, offset=0):
     # Get connection 
-    connection = sqlite3.connect(db_file)
+    connection = connect(db_file)
     # Get cursor for executing commands with SQL DB 
     cursor = connection.cursor()
-    # Query 
-    cursor.execute('''SELECT title, description 
-                      FROM search_results 
-                      WHERE description LIKE ?''', ('%' + query + '%',))
-    # Get all results
-    results = cursor.fetchall()
-    
-    # Perform keyword operations and formatting on results 
-    formatted_results = []
-    for title, description in results:
-        # Combine title and description for text processing
-        text = title + ' ' + description
-        # Calculate keyword count
-        keyword_counts = keyword_count(query_keywords, text)
-        # Convert keyword count to tuple for sorting
-        keyword_counts_tuple, total_count = dict_to_tuple(keyword_counts)
-        # Append formatted result to list
-        formatted_results.append((title, description, keyword_counts_tuple, total_count))
+    # Results up to the end of the requested page; earlier pages are ranked too, but only this page's text is read
+    depth = offset + k if k is not None else None
+    # Rank extra candidates when collapsing, so near-duplicates don't leave the page short
+    candidates = depth * 2 if collapse and depth is not None else depth
+    # Fingerprint buckets of the results kept so far
+    duplicate_filter = NearDuplicateFilter()
+
+    # The document store holds the full text; only the results kept for display are decompressed
+    store = get_doc_store(db_file, cursor)
+
+    # Get the inverted index for this database, picking up any rows added since the last search
+    index = get_index(db_file, cursor, wait=False) if backend == 'index' else None
+
+    if index is None:
+        # Let SQLite rank with bm25() over the FTS5 index created by the schema migration
+        keywords = tokenize(' '.join(query_keywords))
+        fts_rows = fts_search(cursor, keywords, candidates)
+        fingerprints = load_fingerprints(cursor, [row[0] for row in fts_rows]) if collapse else {}
+        kept = [row for row in fts_rows if duplicate_filter.check(fingerprints.get(row[0]), row[0]) is None][offset:depth]
+        formatted_results = format_fts_results(cursor, store, kept, query_keywords, keywords, snippets)
+        cursor.close()
+        connection.close()
+        return formatted_results
+
+    # Hold the index's read lock until the results are formatted, so a refresh can't change it mid-query
+    with index.reading():
+        # Score documents from the postings lists of the query terms with BM25
+        terms = tokenize(' '.join(query_keywords))
+        if rerank:
+            # Re-score the BM25 candidates together, in one sparse matrix-vector product
+            shortlist = [doc_id for _, doc_id in index.top_k(terms, max(rerank_depth, candidates or 0))]
+            ranked = reranker.rerank(index, terms, candidates, shortlist)
+        else:
+            ranked = index.top_k(terms, candidates)
+
+        # Fetch URL and title only for the ranked documents
+        ids = [doc_id for _, doc_id in ranked]
+        rows = load_titles(cursor, ids)
+        fingerprints = load_fingerprints(cursor, ids) if collapse else {}
 
-    # Sort by descending total keyword count
-    formatted_results = sorted(formatted_results, key=lambda x: -x[3])
+        # Keep results in BM25 order, skipping near-duplicates of a higher-ranked result
+        kept = [doc_id for doc_id in ids if doc_id in rows and duplicate_filter.check(fingerprints.get(doc_id), doc_id) is None][offset:depth]
+        formatted_results = format_index_results(cursor, store, index, kept, rows, query_keywords, terms, snippets)
 
     # Close cursor and connection
     cursor.close()
     connection.close()
     
     # Return results 
-    return formatted_results
\ No newline at end of file
+    return formatted_results
+
+# Get {doc_id: (url, title)} for document ids
+def load_titles(cursor, ids):
+    rows = {}
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        cursor.execute('SELECT id, url, title FROM documents WHERE id IN (%s)' % ','.join('?' * len(chunk)), chunk)
+        for doc_id, url, title in cursor:
+            rows[doc_id] = (url, title)
+    return rows
+
+# Get {url: 'Engine, Engine'} naming the search engines whose results pages listed each URL
+# Pages that only came from an ingest or a recrawl have no engine and are left out
+def result_engines(db_file, urls):
+    connection = connect(db_file)
+    engines = {}
+    for i in range(0, len(urls), 500):
+        chunk = urls[i:i + 500]
+        rows = connection.execute('''SELECT DISTINCT documents.url, searches.search_engine FROM documents
+                                     JOIN search_hits ON search_hits.doc_id = documents.id
+                                     JOIN searches ON searches.id = search_hits.search_id
+                                     WHERE documents.url IN (%s) ORDER BY searches.search_engine''' % ','.join('?' * len(chunk)), chunk)
+        for url, engine in rows:
+            engines.setdefault(url, []).append(engine)
+    connection.close()
+    return {url: ', '.join(names) for url, names in engines.items()}
+
+# Format indexed documents as (url, title, description, keyword_counts, total) results, in the order of ids
+# rows is {doc_id: (url, title)} from load_titles; only these documents' text is read from the store
+def format_index_results(cursor, store, index, ids, rows, query_keywords, terms, snippets):
+    texts = store.get_many(cursor, ids)
+
+    # Perform keyword operations and formatting on results
+    formatted_results = []
+    for doc_id in ids:
+        url, title = rows[doc_id]
+        # Keyword counts come straight from the postings term frequencies
+        keyword_counts = {term: index.term_frequency(term.lower(), doc_id) for term in query_keywords}
+        # Convert keyword count to tuple for sorting
+        keyword_counts_tuple, total_count = dict_to_tuple(keyword_counts)
+        text = texts.get(doc_id, '')
+        if snippets:
+            # Match positions come from the postings; title words come first, so shift them out
+            title_length = len(tokenize(title or ''))
+            matches = [(position - title_length, term) for term in set(terms)
+                       for position in index.positions(term, doc_id) if position >= title_length]
+            text = build_snippet(text, terms, matches)
+        # Append formatted result to list
+        formatted_results.append((url, title, text, keyword_counts_tuple, total_count))
+    return formatted_results
+
+# Format FTS5 matches as (url, title, description, keyword_counts, total) results, in the order of rows
+# rows are (doc_id, url, title); only these documents' text is read from the store
+def format_fts_results(cursor, store, rows, query_keywords, keywords, snippets):
+    texts = store.get_many(cursor, [doc_id for doc_id, _, _ in rows])
+    formatted_results = []
+    for doc_id, url, title in rows:
+        description = texts.get(doc_id, '')
+        # Keyword counts are only computed for the rows shown
+        keyword_counts_tuple, total_count = dict_to_tuple(keyword_count(query_keywords, (title or '') + ' ' + description))
+        formatted_results.append((url, title, build_snippet(description, keywords) if snippets else description, keyword_counts_tuple, total_count))
+    return formatted_results
+
+# Function for performing search, returning (title, description, keyword_counts, total) tuples
+def search(query, db_file, k=None, backend='index', snippets=False, analyzer=None, use_cache=True, rerank=False, offset=0): 
+    return [result[1:] for result in search_documents(query, db_file, k, backend, snippets, analyzer, use_cache, rerank=rerank, offset=offset)]
@@ -0,0 +1,28 @@
+import sqlite3
+import threading
+from schema import migrate
+
+# Connection settings for the search engine database
+# WAL lets searches read while a crawl is writing, and with synchronous=NORMAL
+# a commit doesn't fsync until checkpoint
+pragmas = {'journal_mode': 'WAL',
+           'synchronous': 'NORMAL',
+           'cache_size': -64000,  # Negative values are KiB, so this is 64 MB of page cache
+           'temp_store': 'MEMORY'}
+
+# Database files already migrated by this process
+migrated = set()
+migrated_lock = threading.Lock()
+
+# Open a connection to the SQLite database with the pragmas above applied
+# The first connection to each file in a process brings its schema up to date (see schema.py)
+def connect(db_file, timeout=30):
+    connection = sqlite3.connect(db_file, timeout=timeout)
+    for name, value in pragmas.items():
+        connection.execute('PRAGMA %s = %s' % (name, value))
+    if db_file not in migrated:
+        with migrated_lock:
+            if db_file not in migrated:
+                migrate(connection)
+                migrated.add(db_file)
+    return connection
@@ -0,0 +1,386 @@
+import os
+import sys
+import mmap
+import zlib
+import fcntl
+import random
+import itertools
+import threading
+import contextlib
+
+# Use zstd when the zstandard package is installed; blocks written with zlib stay readable either way
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compressed, append-only store for the full extracted text of documents
+# Texts are packed into blocks of about block_size bytes and each block is compressed on its own, with
+# zstd (optionally with a dictionary trained on stored pages) or zlib. Blocks live in one file next to
+# the database, read through mmap; document_text maps each document to its block and its slice of it,
+# so a search only decompresses the blocks of the documents it shows.
+# Rewritten documents and rolled back writes leave dead blocks behind, which compact() reclaims by copying
+# the live text into a new file. Appends take an exclusive lock on the file and reads a shared one, and
+# both reopen the file when they find compaction replaced it.
+
+# Uncompressed bytes packed into one block
+block_size = 65536
+# Codecs recorded per block
+codec_zlib = 0
+codec_zstd = 1
+# Compression levels
+zlib_level = 6
+zstd_level = 3
+
+# Tables for block locations and trained dictionaries, created by schema version 5
+doc_store_schema = [
+    '''CREATE TABLE document_text (
+         doc_id INTEGER PRIMARY KEY REFERENCES documents (id) ON DELETE CASCADE,
+         block_offset INTEGER NOT NULL,
+         block_length INTEGER NOT NULL,
+         codec INTEGER NOT NULL,
+         dictionary_id INTEGER,
+         start INTEGER NOT NULL,
+         length INTEGER NOT NULL)''',
+    '''CREATE TABLE document_dictionaries (
+         id INTEGER PRIMARY KEY AUTOINCREMENT,
+         data BLOB NOT NULL)''',
+]
+
+# Schema version 7: compactions done so far, committed with the new locations so that a compaction
+# interrupted between its commit and the file swap can be finished (see recover_compaction)
+compaction_schema = [
+    'CREATE TABLE document_store_state (id INTEGER PRIMARY KEY CHECK (id = 1), compactions INTEGER NOT NULL)',
+    'INSERT INTO document_store_state (id, compactions) VALUES (1, 0)',
+]
+
+# Record where a document's text is stored
+upsert_location = '''INSERT OR REPLACE INTO document_text (doc_id, block_offset, block_length, codec, dictionary_id, start, length)
+                     VALUES (?, ?, ?, ?, ?, ?, ?)'''
+
+# Path of the block file for a database file
+def store_path(db_file):
+    return os.path.splitext(db_file)[0] + '.docs'
+
+# Whether an open file is no longer the one at path, because compaction replaced it
+def replaced(f, path):
+    return os.fstat(f.fileno()).st_ino != os.stat(path).st_ino
+
+# flock an open block file, reopening it first if compaction replaced it; returns the locked file
+def lock_current(f, path, mode, operation):
+    while True:
+        fcntl.flock(f, operation)
+        if not replaced(f, path):
+            return f
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+        f = open(path, mode)
+
+# Block file for one database
+class DocumentStore:
+    def __init__(self, path):
+        self.path = path
+        # Appends go through file; reads through a map of reader, which also holds the shared lock
+        self.file = open(path, 'ab')
+        self.reader = open(path, 'rb')
+        # Read-only map of the file, remapped when a read goes past its end
+        self.map = None
+        # Threads of this process inside reading(); the first takes the shared lock and the last releases it
+        self.readers = 0
+        # Dictionary id -> zstd dictionary; writes use the newest one
+        self.dictionaries = {}
+        self.dictionary_id = None
+        # lock guards the reader and the map; append_lock serializes appends, which wait on other
+        # processes' readers while holding it
+        self.lock = threading.Lock()
+        self.append_lock = threading.Lock()
+
+    # Load trained dictionaries from the database; the newest is used for new blocks
+    def load_dictionaries(self, cursor):
+        if zstandard is None:
+            return
+        cursor.execute('SELECT id, data FROM document_dictionaries ORDER BY id')
+        for dictionary_id, data in cursor.fetchall():
+            self.dictionaries[dictionary_id] = zstandard.ZstdCompressionDict(data)
+            self.dictionary_id = dictionary_id
+
+    # Compress a block; returns (codec, dictionary_id, compressed bytes)
+    def compress(self, data):
+        if zstandard is None:
+            return codec_zlib, None, zlib.compress(data, zlib_level)
+        dictionary = self.dictionaries.get(self.dictionary_id)
+        compressor = zstandard.ZstdCompressor(level=zstd_level, dict_data=dictionary) if dictionary else zstandard.ZstdCompressor(level=zstd_level)
+        return codec_zstd, self.dictionary_id if dictionary else None, compressor.compress(data)
+
+    # Decompress a block, loading its dictionary if another process trained it
+    def decompress(self, codec, dictionary_id, data, cursor):
+        if codec == codec_zlib:
+            return zlib.decompress(data)
+        if zstandard is None:
+            raise RuntimeError('zstandard is needed to read zstd blocks from ' + self.path)
+        if dictionary_id is not None and dictionary_id not in self.dictionaries:
+            self.load_dictionaries(cursor)
+        dictionary = self.dictionaries.get(dictionary_id)
+        decompressor = zstandard.ZstdDecompressor(dict_data=dictionary) if dictionary else zstandard.ZstdDecompressor()
+        return decompressor.decompress(data)
+
+    # Compress (doc_id, bytes) pairs into blocks of at least block_size bytes, written to f from offset;
+    # a large text gets a block to itself. Returns upsert_location parameters for the pairs
+    def write_blocks(self, f, texts, offset):
+        locations, block, size = [], [], 0
+        for doc_id, data in itertools.chain(texts, [(None, None)]):
+            if data is not None:
+                block.append((doc_id, data))
+                size += len(data)
+                if size < block_size:
+                    continue
+            if not block:
+                continue
+            codec, dictionary_id, compressed = self.compress(b''.join(data for _, data in block))
+            f.write(compressed)
+            start = 0
+            for block_doc_id, data in block:
+                locations.append((block_doc_id, offset, len(compressed), codec, dictionary_id, start, len(data)))
+                start += len(data)
+            offset += len(compressed)
+            block, size = [], 0
+        return locations
+
+    # Append (doc_id, text) pairs and return upsert_location parameters for them
+    # The caller stores the locations in the same transaction as the documents; bytes from a rolled
+    # back transaction are never referenced, and are dropped by the next compaction
+    def append(self, texts):
+        texts = [(doc_id, (text or '').encode('utf-8')) for doc_id, text in texts]
+        with self.append_lock:
+            # Other processes may append to the same file, so take an exclusive lock and write at its end
+            self.file = lock_current(self.file, self.path, 'ab', fcntl.LOCK_EX)
+            try:
+                locations = self.write_blocks(self.file, texts, self.file.seek(0, os.SEEK_END))
+                self.file.flush()
+                # On disk before the database commit that references it
+                os.fsync(self.file.fileno())
+            finally:
+                fcntl.flock(self.file, fcntl.LOCK_UN)
+        return locations
+
+    # Hold a shared lock on the block file while locations are looked up and read, so compaction
+    # can't swap the file in between
+    @contextlib.contextmanager
+    def reading(self):
+        with self.lock:
+            if not self.readers:
+                reader = lock_current(self.reader, self.path, 'rb', fcntl.LOCK_SH)
+                if reader is not self.reader:
+                    # Compaction replaced the file; the old map points into the old one
+                    if self.map is not None:
+                        self.map.close()
+                        self.map = None
+                    self.reader = reader
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.readers -= 1
+                if not self.readers:
+                    fcntl.flock(self.reader, fcntl.LOCK_UN)
+
+    # Read a compressed block through the memory map; called inside reading()
+    def read_block(self, offset, length):
+        with self.lock:
+            if self.map is None or offset + length > len(self.map):
+                if self.map is not None:
+                    self.map.close()
+                self.map = mmap.mmap(self.reader.fileno(), 0, access=mmap.ACCESS_READ)
+            return self.map[offset:offset + length]
+
+    # Get {doc_id: text} for a list of document ids; documents without stored text are left out
+    # Blocks are read in file order and each is decompressed once, however many of the documents it holds
+    def get_many(self, cursor, ids):
+        locations = []
+        ids = list(ids)
+        texts = {}
+        with self.reading():
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                cursor.execute('''SELECT doc_id, block_offset, block_length, codec, dictionary_id, start, length
+                                  FROM document_text WHERE doc_id IN (%s)''' % ','.join('?' * len(chunk)), chunk)
+                locations.extend(cursor.fetchall())
+            locations.sort(key=lambda location: (location[1], location[5]))
+            block_offset, block = None, None
+            for doc_id, offset, length, codec, dictionary_id, start, text_length in locations:
+                if offset != block_offset:
+                    block_offset, block = offset, self.decompress(codec, dictionary_id, self.read_block(offset, length), cursor)
+                texts[doc_id] = block[start:start + text_length].decode('utf-8')
+        return texts
+
+    # Get the text of one document, or '' if none is stored
+    def get(self, cursor, doc_id):
+        return self.get_many(cursor, [doc_id]).get(doc_id, '')
+
+    # Sizes for judging compression: (documents, text bytes, file bytes)
+    def stats(self, cursor):
+        cursor.execute('SELECT COUNT(*), COALESCE(SUM(length), 0) FROM document_text')
+        documents, text_bytes = cursor.fetchone()
+        return documents, text_bytes, os.path.getsize(self.path)
+
+    # Bytes of the file in blocks no document references any more
+    def dead_bytes(self, cursor):
+        cursor.execute('SELECT COALESCE(SUM(block_length), 0) FROM (SELECT DISTINCT block_offset, block_length FROM document_text)')
+        return os.path.getsize(self.path) - cursor.fetchone()[0]
+
+    # Close the file and the memory map
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+            self.reader.close()
+            self.file.close()
+
+# Live (doc_id, bytes) texts of the blocks at locations, which are in file order
+def live_texts(store, cursor, data, locations):
+    block_offset, block = None, None
+    for doc_id, offset, length, codec, dictionary_id, start, text_length in locations:
+        if offset != block_offset:
+            block_offset, block = offset, store.decompress(codec, dictionary_id, data[offset:offset + length], cursor)
+        yield doc_id, block[start:start + text_length]
+
+# Rewrite a store's block file with only the text document_text references, recompressed with the newest
+# dictionary, and swap it in; returns (bytes before, bytes after)
+# Holds the database write lock and an exclusive lock on the block file throughout, so writers and readers
+# in every process wait until it is done
+def compact(connection, store):
+    cursor = connection.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    current = lock_current(open(store.path, 'rb'), store.path, 'rb', fcntl.LOCK_EX)
+    data, temp, committed = None, None, False
+    try:
+        before = os.fstat(current.fileno()).st_size
+        compactions = cursor.execute('SELECT compactions FROM document_store_state WHERE id = 1').fetchone()[0] + 1
+        temp = '%s.compact%d' % (store.path, compactions)
+        data = mmap.mmap(current.fileno(), 0, access=mmap.ACCESS_READ) if before else b''
+        # The sort materializes the rows, so locations can be rewritten while they are read
+        reader = connection.cursor()
+        reader.execute('''SELECT doc_id, block_offset, block_length, codec, dictionary_id, start, length
+                          FROM document_text ORDER BY block_offset, start''')
+        with open(temp, 'wb') as f:
+            offset = 0
+            while True:
+                locations = reader.fetchmany(5000)
+                if not locations:
+                    break
+                # Blocks can span fetches, so texts from a block cut short here are packed into new blocks like any other
+                cursor.executemany(upsert_location, store.write_blocks(f, live_texts(store, cursor, data, locations), offset))
+                offset = f.tell()
+            f.flush()
+            os.fsync(f.fileno())
+        reader.close()
+        cursor.execute('UPDATE document_store_state SET compactions = ? WHERE id = 1', (compactions,))
+        connection.commit()
+        committed = True
+        # The database now points into the new file; a crash before the swap is finished by recover_compaction
+        os.replace(temp, store.path)
+        return before, offset
+    finally:
+        if not committed:
+            connection.rollback()
+            if temp is not None and os.path.exists(temp):
+                os.remove(temp)
+        if isinstance(data, mmap.mmap):
+            data.close()
+        fcntl.flock(current, fcntl.LOCK_UN)
+        current.close()
+        cursor.close()
+
+# Compact a database's store once at least min_dead of its file is dead blocks
+# Returns (bytes before, bytes after), or None when it wasn't worth it
+def compact_if_needed(connection, store, min_dead=0.5):
+    cursor = connection.cursor()
+    dead = store.dead_bytes(cursor)
+    cursor.close()
+    size = os.path.getsize(store.path)
+    if not size or dead < min_dead * size:
+        return None
+    return compact(connection, store)
+
+# Finish a compaction that committed but crashed before swapping in its file, and remove any others' files
+def recover_compaction(store, cursor):
+    directory, name = os.path.split(store.path)
+    if not any(entry.startswith(name + '.compact') for entry in os.listdir(directory)):
+        return
+    # A compaction still running holds this lock until it has swapped its file in
+    current = lock_current(open(store.path, 'rb'), store.path, 'rb', fcntl.LOCK_EX)
+    try:
+        compactions = cursor.execute('SELECT compactions FROM document_store_state WHERE id = 1').fetchone()[0]
+        for entry in os.listdir(directory):
+            if entry == '%s.compact%d' % (name, compactions):
+                os.replace(os.path.join(directory, entry), store.path)
+            elif entry.startswith(name + '.compact'):
+                os.remove(os.path.join(directory, entry))
+    finally:
+        fcntl.flock(current, fcntl.LOCK_UN)
+        current.close()
+
+# Train a zstd dictionary on a sample of stored texts; blocks written afterwards use it
+# Returns the new dictionary id, or None without zstandard or text to train on
+def train_dictionary(cursor, store, samples=2000, size=112640):
+    if zstandard is None:
+        print('zstandard not available, blocks are compressed with zlib without a dictionary')
+        return None
+    cursor.execute('SELECT doc_id FROM document_text')
+    ids = [row[0] for row in cursor.fetchall()]
+    texts = [text.encode('utf-8') for text in store.get_many(cursor, random.sample(ids, min(samples, len(ids)))).values() if text]
+    if not texts:
+        return None
+    try:
+        data = zstandard.train_dictionary(size, texts).as_bytes()
+    except zstandard.ZstdError as e:
+        # Too little text to train on
+        print('Dictionary training failed: %s' % e)
+        return None
+    cursor.execute('INSERT INTO document_dictionaries (data) VALUES (?)', (data,))
+    dictionary_id = cursor.lastrowid
+    store.dictionaries[dictionary_id] = zstandard.ZstdCompressionDict(data)
+    store.dictionary_id = dictionary_id
+    return dictionary_id
+
+# One store per database file, shared by every reader and writer in the process
+stores = {}
+stores_lock = threading.Lock()
+
+# Get the store for a database file; when the store is first opened, dictionaries are loaded and an
+# interrupted compaction is finished
+def get_doc_store(db_file, cursor=None):
+    path = store_path(os.path.abspath(db_file))
+    with stores_lock:
+        store = stores.get(path)
+        if store is None:
+            store = stores[path] = DocumentStore(path)
+            if cursor is not None:
+                store.load_dictionaries(cursor)
+                recover_compaction(store, cursor)
+    return store
+
+# Show store sizes, train a dictionary or compact the store: python doc_store.py [train|compact] [db_file]
+if __name__ == '__main__':
+    from database import connect
+    args = sys.argv[1:]
+    command = args.pop(0) if args[:1] in (['train'], ['compact']) else None
+    db_file = args[0] if args else 'custom_search_engine.db'
+    connection = connect(db_file)
+    cursor = connection.cursor()
+    store = get_doc_store(db_file, cursor)
+    if command == 'train':
+        with connection:
+            dictionary_id = train_dictionary(cursor, store)
+        if dictionary_id is not None:
+            print('Trained dictionary %d; new blocks will use it' % dictionary_id)
+    elif command == 'compact':
+        before, after = compact(connection, store)
+        print('Compacted %s from %d to %d bytes' % (store.path, before, after))
+    documents, text_bytes, file_bytes = store.stats(cursor)
+    print('%d documents, %d bytes of text stored in %d bytes (%.1fx), %d bytes dead'
+          % (documents, text_bytes, file_bytes, text_bytes / file_bytes if file_bytes else 0, store.dead_bytes(cursor)))
+    cursor.close()
+    connection.close()
@@ -0,0 +1,23 @@
+from url_filter import get_url_filter
+
+# Search engines the crawler scrapes, and the rules for which links scraped from their results pages are kept
+# Kept apart from search_functions.py and engines.py so both can import it
+
+# Define search engines and block lists
+search_engines = {'Google': 'https://www.google.com/search?q=',
+                  'DuckDuckGo': 'https://html.duckduckgo.com/html/?q=',
+                  'Bing': 'https://www.bing.com/search?q=',
+                  'Yahoo': 'https://search.yahoo.com/search?p=',
+                  'Yandex': 'https://yandex.com/search/?text='}
+js_engines = []  # Engines that require JavaScript rendering, loaded through the browser pool (DuckDuckGo uses its static HTML endpoint)
+block_list = ['cdn-cgi', '/cdn-cgi/', 'javascript:', '#', '.pdf', '.doc', '.docx', '.ppt', '.pptx', '.xls', '.xlsx', '.svg', '.jpg', '.jpeg', '.png', '.gif']
+ad_block_list = ['ad', 'ads', 'banner', 'popup', 'doubleclick']  # Common ad-related words to block, matched as whole words
+
+# Filter function to clean up URL scrape results 
+# The lists are compiled once into a URL filter (see url_filter.py), so a check costs the same however long they grow
+def filter_function(url, block_list, ad_block_list):
+    # Check for "http"
+    if 'http' not in url: 
+        return False
+    # Check against the compiled block_list and ad_block_list rules
+    return get_url_filter(block_list, ad_block_list).allows(url)
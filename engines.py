@@ -0,0 +1,150 @@
+import re
+import time
+import asyncio
+import threading
+import urllib.parse
+from collections import OrderedDict
+from bs4 import BeautifulSoup
+from browser_pool import get_browser_pool
+from engine_config import search_engines, js_engines, block_list, ad_block_list, filter_function
+from metrics import span, count
+
+# Engine results pages: one parser per engine, a short-lived cache of parsed results pages, and
+# fetching on the shared fetcher's session. Engines that render results with JavaScript are loaded
+# through the shared browser pool instead; none of the built-in ones need it.
+
+# Headers sent with engine results page requests
+serp_headers = {'user-agent': 'my-app/0.0.1'}
+
+# Turns an engine results page into the result URLs on it, in rank order
+# Subclasses pick the result links out of the page's markup; when that finds nothing (the markup
+# changed, or a recorded page), every link on the page is used instead, as before
+class EngineParser:
+    # Whether the engine needs a browser to render its results
+    js = False
+
+    # Results page URL for a query
+    def url(self, engine, query):
+        return search_engines[engine] + urllib.parse.quote_plus(query)
+
+    # Hrefs of the result links on a page
+    def result_links(self, soup):
+        return []
+
+    # The destination of a link, for engines that wrap results in redirect URLs
+    def unwrap(self, href):
+        return href
+
+    # Result URLs on a page that pass the URL filter
+    def parse(self, html):
+        soup = BeautifulSoup(html, 'html.parser')
+        hrefs = self.result_links(soup) or [a.get('href') for a in soup.find_all('a', href=True)]
+        return [url for url in map(self.unwrap, hrefs) if url and filter_function(url, block_list, ad_block_list)]
+
+# Google's basic HTML wraps results in /url?q=<url>&sa=...
+class GoogleParser(EngineParser):
+    def result_links(self, soup):
+        return [a['href'] for a in soup.find_all('a', href=True) if a['href'].startswith('/url?')]
+
+    def unwrap(self, href):
+        if href.startswith('/url?'):
+            return urllib.parse.parse_qs(urllib.parse.urlsplit(href).query).get('q', [''])[0]
+        return href
+
+class BingParser(EngineParser):
+    def result_links(self, soup):
+        return [a['href'] for a in soup.select('li.b_algo h2 a[href]')]
+
+# Yahoo links go through r.search.yahoo.com/.../RU=<url>/RK=...
+class YahooParser(EngineParser):
+    def result_links(self, soup):
+        return [a['href'] for a in soup.select('div.algo h3 a[href]')]
+
+    def unwrap(self, href):
+        match = re.search(r'/RU=([^/]+)/', href)
+        return urllib.parse.unquote(match.group(1)) if match else href
+
+# DuckDuckGo's static HTML endpoint, which needs no browser; links go through /l/?uddg=<url>
+class DuckDuckGoParser(EngineParser):
+    def result_links(self, soup):
+        return [a['href'] for a in soup.select('a.result__a[href]')]
+
+    def unwrap(self, href):
+        if 'uddg=' in href:
+            return urllib.parse.parse_qs(urllib.parse.urlsplit(href).query).get('uddg', [''])[0]
+        return href
+
+# Engine name -> parser; engines without one use the generic parser
+parsers = {}
+default_parser = EngineParser()
+
+# Register the parser for an engine
+def register_parser(engine, parser):
+    parsers[engine] = parser
+
+# Get the parser for an engine
+def get_parser(engine):
+    return parsers.get(engine, default_parser)
+
+register_parser('Google', GoogleParser())
+register_parser('Bing', BingParser())
+register_parser('Yahoo', YahooParser())
+register_parser('DuckDuckGo', DuckDuckGoParser())
+
+# Parsed results pages by (engine, normalized query), kept for ttl seconds
+# Repeating a query across the results page, the live page and their pages doesn't hit the engines again
+class SerpCache:
+    def __init__(self, ttl=300, maxsize=256):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    # Queries that only differ in case or spacing share an entry
+    def key(self, engine, query):
+        return engine, ' '.join(query.lower().split())
+
+    # Cached result URLs for an engine and query, or None
+    def get(self, engine, query):
+        key = self.key(engine, query)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.time():
+                self.entries.pop(key, None)
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    # Cache result URLs, evicting the least recently used entries beyond maxsize
+    def put(self, engine, query, urls):
+        with self.lock:
+            self.entries[self.key(engine, query)] = (time.time() + self.ttl, urls)
+            self.entries.move_to_end(self.key(engine, query))
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+serp_cache = SerpCache()
+
+# Get an engine's result URLs for a query on the fetcher's event loop
+# Static engines are one request on the pooled session; parsing runs on the default thread pool so it
+# doesn't hold up other fetches. Empty results (blocked or failed requests) are not cached.
+async def engine_results(fetcher, query, engine):
+    urls = serp_cache.get(engine, query)
+    if urls is not None:
+        count('serp_cache_total', engine=engine, outcome='hit')
+        return urls
+    count('serp_cache_total', engine=engine, outcome='miss')
+    parser = get_parser(engine)
+    loop = asyncio.get_running_loop()
+    with span('serp_fetch', engine=engine):
+        if parser.js or engine in js_engines:
+            # Browser-rendered engines block, so run them on the default thread pool
+            html = await loop.run_in_executor(None, get_browser_pool().render, parser.url(engine, query))
+        else:
+            async with fetcher.session.get(parser.url(engine, query), headers=serp_headers) as response:
+                html = await response.text()
+    with span('serp_parse', engine=engine):
+        urls = await loop.run_in_executor(None, parser.parse, html)
+    if urls:
+        serp_cache.put(engine, query, urls)
+    return urls
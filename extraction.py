@@ -0,0 +1,114 @@
+import os
+import time
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from bs4 import BeautifulSoup
+from metrics import observe
+
+# Pick the fastest HTML parser available: selectolax, then lxml, then Python's html.parser
+try:
+    from selectolax.parser import HTMLParser
+    html_parser = 'selectolax'
+except ImportError:
+    HTMLParser = None
+    try:
+        import lxml
+        html_parser = 'lxml'
+    except ImportError:
+        html_parser = 'html.parser'
+
+# Tags whose contents are never page text
+strip_tags = ['script', 'style', 'template', 'TemplateString', 'ProcessingInstruction', 'Declaration', 'Doctype']
+
+# Get raw text from HTML resulting from engine scrape and get first title object in HTML
+# Paragraph text is joined in one pass, giving the same ' p1 p2 ...' string as before
+def get_raw_text(text):
+    if HTMLParser is not None:
+        tree = HTMLParser(text)
+        title_node = tree.css_first('title')
+        title = title_node.text() if title_node is not None else "N/A"
+        tree.strip_tags(strip_tags)
+        paragraphs = [node.text().strip().replace(u'\xa0', u' ') for node in tree.css('p')]
+    else:
+        soup = BeautifulSoup(text, html_parser)
+        try:
+            title = soup.title.get_text()
+        except AttributeError:
+            title = "N/A"
+        for script in soup(strip_tags):
+            script.extract()
+        paragraphs = [item.text.strip().replace(u'\xa0', u' ') for item in soup.find_all('p')]
+    return ''.join(' ' + paragraph for paragraph in paragraphs), title
+
+# Worker function: extract one fetched page, keeping its URL and the time spent parsing it
+def extract_page(html, url):
+    start = time.perf_counter()
+    result = get_raw_text(html)
+    return result, url, time.perf_counter() - start
+
+# Runs get_raw_text on a process pool and keeps throughput stats for sizing the pool
+class ExtractionPool:
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(self.workers)
+        # Pages extracted, wall-clock seconds spent in extract() and seconds spent parsing in workers
+        self.pages = 0
+        self.seconds = 0.0
+        self.parse_seconds = 0.0
+
+    # Extract (html, url) pages as they arrive, yielding ((text, title), url) as each finishes
+    # Pages are submitted as soon as the input yields them, so a streaming fetch keeps the pool busy
+    # With a page cache, text already extracted from an unchanged page is reused instead of parsed; only a
+    # fresh cached copy counts (see PageCache.get_extracted), since a stale one means this fetch failed or changed
+    def extract(self, pages, cache=None):
+        start = time.perf_counter()
+        pending = set()
+        try:
+            for html, url in pages:
+                extracted = cache.get_extracted(url) if cache is not None else None
+                if extracted is not None:
+                    yield tuple(extracted), url
+                    continue
+                pending.add(self.executor.submit(extract_page, html, url))
+                done = {future for future in pending if future.done()}
+                pending -= done
+                for future in done:
+                    yield self.collect(future, cache)
+            for future in as_completed(pending):
+                yield self.collect(future, cache)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+    # Record stats for a finished extraction and return ((text, title), url)
+    def collect(self, future, cache=None):
+        result, url, parse_seconds = future.result()
+        self.pages += 1
+        self.parse_seconds += parse_seconds
+        observe('extract_seconds', parse_seconds)
+        if cache is not None:
+            cache.put_extracted(url, *result)
+        return result, url
+
+    # Pages per second across the whole pool, including time spent waiting for input
+    def pages_per_second(self):
+        return self.pages / self.seconds if self.seconds else 0.0
+
+    # Pages per second a single worker can parse; workers needed ~= arrival rate / this
+    def worker_pages_per_second(self):
+        return self.pages / self.parse_seconds if self.parse_seconds else 0.0
+
+    # Shut down the worker processes
+    def close(self):
+        self.executor.shutdown()
+
+# Shared extraction pool, created on first use
+extraction_pool = None
+extraction_pool_lock = threading.Lock()
+
+# Get the shared extraction pool; the worker count only applies when it is first created
+def get_extraction_pool(workers=None):
+    global extraction_pool
+    with extraction_pool_lock:
+        if extraction_pool is None:
+            extraction_pool = ExtractionPool(workers)
+    return extraction_pool
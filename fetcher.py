@@ -0,0 +1,93 @@
+import time
+import asyncio
+import queue
+import threading
+import urllib.parse
+import aiohttp
+from metrics import record_fetch
+
+# Long-lived page fetcher shared across crawls
+# Owns one event loop (on a background thread) and one pooled aiohttp session, so keep-alive
+# connections and cached DNS lookups survive between populate_database calls
+class Fetcher:
+    def __init__(self, fetch_page, max_connections=50, per_domain=4, dns_ttl=300, keepalive_timeout=30, headers=None):
+        # Coroutine called as fetch_page(session, url), returning (html, url)
+        self.fetch_page = fetch_page
+        self.max_connections = max_connections
+        self.per_domain = per_domain
+        self.dns_ttl = dns_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.headers = headers
+        # Run the event loop on a daemon thread for the life of the process
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.session = self.run(self.create_session())
+        # Global and per-domain limits, applied before the request timeout starts
+        self.global_limit = asyncio.Semaphore(max_connections)
+        self.domain_limits = {}
+
+    # Create the pooled session inside the fetcher's event loop
+    async def create_session(self):
+        try:
+            # Use the c-ares resolver when aiodns is installed
+            resolver = aiohttp.AsyncResolver()
+        except RuntimeError:
+            resolver = aiohttp.ThreadedResolver()
+        connector = aiohttp.TCPConnector(limit=self.max_connections,
+                                         limit_per_host=self.per_domain,
+                                         use_dns_cache=True,
+                                         ttl_dns_cache=self.dns_ttl,
+                                         keepalive_timeout=self.keepalive_timeout,
+                                         resolver=resolver)
+        return aiohttp.ClientSession(connector=connector, headers=self.headers)
+
+    # Run a coroutine on the fetcher's loop from synchronous code and wait for the result
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    # Get the semaphore limiting concurrent requests to one domain
+    def domain_limit(self, url):
+        domain = urllib.parse.urlparse(url).netloc
+        if domain not in self.domain_limits:
+            self.domain_limits[domain] = asyncio.Semaphore(self.per_domain)
+        return self.domain_limits[domain]
+
+    # Fetch one URL within the global and per-domain limits
+    # Latency is measured from when the request starts, not from when it was queued
+    async def fetch(self, url):
+        async with self.global_limit:
+            async with self.domain_limit(url):
+                start = time.perf_counter()
+                try:
+                    result = await self.fetch_page(self.session, url)
+                # Any other client error is reported like the ones fetch_page handles
+                except Exception as e:
+                    result = 'Error: ' + type(e).__name__, url
+                record_fetch(result[0], time.perf_counter() - start)
+                return result
+
+    # Fetch URLs concurrently, yielding (html, url) tuples in completion order
+    async def fetch_as_completed(self, urls):
+        for task in asyncio.as_completed([self.fetch(url) for url in urls]):
+            yield await task
+
+    # Synchronous version of fetch_as_completed: yields each page as soon as it arrives,
+    # so parsing and inserting can start before the slowest page is done
+    def iter_fetch(self, urls):
+        urls = list(urls)
+        results = queue.Queue()
+
+        async def produce():
+            async for result in self.fetch_as_completed(urls):
+                results.put(result)
+
+        asyncio.run_coroutine_threadsafe(produce(), self.loop)
+        for _ in urls:
+            yield results.get()
+
+    # Close the session and stop the event loop
+    def close(self):
+        self.run(self.session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
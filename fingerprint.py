@@ -0,0 +1,104 @@
+import hashlib
+from collections import Counter
+from tokenizer import tokenize
+
+# SimHash fingerprints for near-duplicate detection
+# Two pages are near-duplicates when their 64-bit fingerprints differ in at most max_distance bits
+fingerprint_bits = 64
+max_distance = 3
+# Splitting the fingerprint into max_distance + 1 bands guarantees that near-duplicates share at
+# least one band exactly, so candidates can be found with indexed equality lookups (LSH banding)
+band_count = max_distance + 1
+band_bits = fingerprint_bits // band_count
+# Words per shingle
+shingle_size = 3
+
+# 8-byte hash of a feature string
+def feature_hash(feature):
+    return hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest()
+
+# Compute the SimHash of a page's text as a signed 64-bit integer (fits an SQLite INTEGER)
+# Returns None for text with no words
+def simhash(text):
+    terms = tokenize(text)
+    if not terms:
+        return None
+    shingles = [' '.join(terms[i:i + shingle_size]) for i in range(max(1, len(terms) - shingle_size + 1))]
+    digests = [feature_hash(shingle) for shingle in shingles]
+    # Count byte values per byte position, then turn those counts into per-bit votes, so the
+    # per-shingle work stays in C regardless of the fingerprint width
+    value = 0
+    for position, column in enumerate(zip(*digests)):
+        byte_counts = Counter(column)
+        for bit in range(8):
+            ones = sum(count for byte, count in byte_counts.items() if byte >> bit & 1)
+            if 2 * ones > len(digests):
+                value |= 1 << (position * 8 + bit)
+    return value - (1 << fingerprint_bits) if value >= 1 << (fingerprint_bits - 1) else value
+
+# Split a fingerprint into its LSH bands
+def bands(fingerprint):
+    value = fingerprint & ((1 << fingerprint_bits) - 1)
+    mask = (1 << band_bits) - 1
+    return [(value >> (band * band_bits)) & mask for band in range(band_count)]
+
+# Number of differing bits between two fingerprints
+def hamming(a, b):
+    return bin((a ^ b) & ((1 << fingerprint_bits) - 1)).count('1')
+
+# Find a stored document that is a near-duplicate of a fingerprint; returns its url_hash or None
+def find_near_duplicate(cursor, fingerprint):
+    band_values = bands(fingerprint)
+    cursor.execute('''SELECT documents.url_hash, document_fingerprints.simhash
+                      FROM document_fingerprints JOIN documents ON documents.id = document_fingerprints.doc_id
+                      WHERE band0 = ? OR band1 = ? OR band2 = ? OR band3 = ?''', band_values)
+    for candidate_hash, candidate in cursor.fetchall():
+        if hamming(fingerprint, candidate) <= max_distance:
+            return candidate_hash
+    return None
+
+# In-memory near-duplicate lookup over a set of fingerprints, bucketed by band
+# Used to collapse duplicates within an ingest batch and within a page of search results
+class NearDuplicateFilter:
+    def __init__(self):
+        # (band number, band value) -> [(fingerprint, key)]
+        self.buckets = {}
+
+    # Return the key of a remembered near-duplicate of a fingerprint, or None
+    def find(self, fingerprint):
+        for band, value in enumerate(bands(fingerprint)):
+            for candidate, candidate_key in self.buckets.get((band, value), ()):
+                if hamming(fingerprint, candidate) <= max_distance:
+                    return candidate_key
+        return None
+
+    # Remember a fingerprint under a key
+    def add(self, fingerprint, key):
+        for band, value in enumerate(bands(fingerprint)):
+            self.buckets.setdefault((band, value), []).append((fingerprint, key))
+
+    # Return the key of an earlier near-duplicate, or remember this fingerprint under key and return None
+    def check(self, fingerprint, key):
+        if fingerprint is None:
+            return None
+        duplicate = self.find(fingerprint)
+        if duplicate is None:
+            self.add(fingerprint, key)
+        return duplicate
+
+# Get {doc_id: simhash} for a list of document ids
+def load_fingerprints(cursor, ids):
+    fingerprints = {}
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        cursor.execute('SELECT doc_id, simhash FROM document_fingerprints WHERE doc_id IN (%s)' % ','.join('?' * len(chunk)), chunk)
+        fingerprints.update(cursor.fetchall())
+    return fingerprints
+
+# Insert or replace the fingerprint of a document, identified by URL hash
+upsert_fingerprint = '''INSERT OR REPLACE INTO document_fingerprints (doc_id, simhash, band0, band1, band2, band3)
+                        SELECT id, ?, ?, ?, ?, ? FROM documents WHERE url_hash = ?'''
+
+# Parameters for upsert_fingerprint
+def fingerprint_row(fingerprint, url_hash):
+    return [fingerprint] + bands(fingerprint) + [url_hash]
@@ -0,0 +1,47 @@
+# Contentless FTS5 index over documents(title, text), created by the schema migrations (see schema.py)
+# Document text lives in the compressed document store (doc_store.py), so the table only holds the index, and
+# rows are added and removed by write_documents in schema.py
+contentless_fts_schema = ["CREATE VIRTUAL TABLE documents_fts USING fts5(title, description, content='')"]
+fts_triggers = ['documents_fts_ai', 'documents_fts_ad', 'documents_fts_au']
+
+# Add (doc_id, title, text) rows to the FTS index
+def fts_insert(cursor, rows):
+    cursor.executemany('INSERT INTO documents_fts (rowid, title, description) VALUES (?, ?, ?)', rows)
+
+# Remove (doc_id, title, text) rows from the FTS index; a contentless table needs the indexed values to do so
+def fts_delete(cursor, rows):
+    cursor.executemany("INSERT INTO documents_fts (documents_fts, rowid, title, description) VALUES ('delete', ?, ?, ?)", rows)
+
+# Column weights for bm25(): title matches count more than description matches
+title_weight = 2.0
+description_weight = 1.0
+
+# Build the MATCH expression for a list of keywords, matching any of them
+def fts_query(keywords):
+    return ' OR '.join('"' + keyword.replace('"', '""') + '"' for keyword in keywords)
+
+# Run a ranked FTS5 query and return (id, url, title) rows in bm25 order
+# Contentless tables have no snippet(), so callers read text for the rows they show from the document store
+# and build snippets with snippets.py
+def fts_search(cursor, keywords, k=None):
+    if not keywords:
+        return []
+    cursor.execute('''SELECT documents.id, documents.url, documents.title
+                      FROM documents_fts
+                      JOIN documents ON documents.id = documents_fts.rowid
+                      WHERE documents_fts MATCH ?
+                      ORDER BY bm25(documents_fts, ?, ?)
+                      LIMIT ?''', (fts_query(keywords), title_weight, description_weight, -1 if k is None else k))
+    return cursor.fetchall()
+
+# Run a ranked FTS5 query and return (score, id) rows, best first, with bm25() negated so higher scores are better
+# Scores use the database's own collection statistics (see shards.py for how they are merged)
+def fts_scores(cursor, keywords, k=None):
+    if not keywords:
+        return []
+    cursor.execute('''SELECT -bm25(documents_fts, ?, ?) AS score, rowid
+                      FROM documents_fts
+                      WHERE documents_fts MATCH ?
+                      ORDER BY score DESC
+                      LIMIT ?''', (title_weight, description_weight, fts_query(keywords), -1 if k is None else k))
+    return cursor.fetchall()
@@ -0,0 +1,308 @@
+import os
+import re
+import gzip
+import json
+import zlib
+import time
+import argparse
+import itertools
+import collections
+import pathlib
+from concurrent.futures import ProcessPoolExecutor
+from database import connect
+from schema import url_hash, write_documents, upsert_frontier, frontier_row
+from doc_store import get_doc_store, compact_if_needed
+from fingerprint import simhash, upsert_fingerprint, fingerprint_row
+from extraction import get_raw_text
+from query_cache import bump_generation
+from search_functions import data_filter
+from shards import shard_files, shard_of
+from metrics import count
+
+# Bulk offline ingestion: stream documents from HTML directories, JSONL files or WARC archives into the database
+# Records are extracted in chunks on a process pool and written in batches through write_documents, the same
+# path live crawls use. Each batch commits together with a checkpoint of how many records of its source are
+# done (ingest_checkpoints, see schema.py), so an interrupted run picks up after the last committed batch.
+# Near-duplicates are not collapsed at write time as in store_pages; their fingerprints are stored, so
+# searches still collapse them.
+
+# Suffixes read from HTML directories
+html_suffixes = ('.html', '.htm', '.html.gz', '.htm.gz')
+# Records per chunk sent to a worker, and chunks in flight per worker
+chunk_size = 50
+pending_per_worker = 4
+
+# Open a source file for reading, decompressing .gz files (multi-member gzip, as WARC files use, included)
+def open_source(path, mode='rb'):
+    return gzip.open(path, mode) if path.endswith('.gz') else open(path, mode)
+
+# Records are (url, html, title, text): html for pages still to extract, or title and text already extracted
+
+# Read every HTML file under a directory in sorted order; URLs are base_url plus the relative path, or file:// URIs
+def read_html_dir(path, base_url=None):
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if not name.lower().endswith(html_suffixes):
+                continue
+            file_path = os.path.join(root, name)
+            with open_source(file_path) as f:
+                html = f.read().decode('utf-8', errors='replace')
+            if base_url:
+                url = base_url.rstrip('/') + '/' + pathlib.Path(os.path.relpath(file_path, path)).as_posix()
+            else:
+                url = pathlib.Path(os.path.abspath(file_path)).as_uri()
+            yield url, html, None, None
+
+# Read JSON lines with a url and either html or title and text
+def read_jsonl(path):
+    with open_source(path, 'rt') as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError:
+                print('%s:%d: not valid JSON, skipped' % (path, number))
+                continue
+            if not item.get('url'):
+                continue
+            if item.get('html') is not None:
+                yield item['url'], item['html'], None, None
+            else:
+                yield item['url'], None, item.get('title') or 'N/A', item.get('text') or ''
+
+# Read header lines up to a blank line into a dict with lowercase names
+def read_headers(lines):
+    headers = {}
+    for line in lines:
+        line = line.decode('utf-8', errors='replace').strip()
+        if not line:
+            break
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return headers
+
+# Undo chunked transfer encoding
+def dechunk(body):
+    data, position = [], 0
+    while position < len(body):
+        end = body.find(b'\r\n', position)
+        if end < 0:
+            break
+        size = int(body[position:end].split(b';')[0] or b'0', 16)
+        if size == 0:
+            break
+        data.append(body[end + 2:end + 2 + size])
+        position = end + 2 + size + 2
+    return b''.join(data)
+
+# HTML of an HTTP response stored in a WARC record, or None for errors, redirects and other content types
+def http_html(block):
+    head, _, body = block.partition(b'\r\n\r\n')
+    lines = head.split(b'\r\n')
+    status = lines[0].split()
+    if len(status) < 2 or status[1] != b'200':
+        return None
+    headers = read_headers(lines[1:] + [b''])
+    content_type = headers.get('content-type', '')
+    if 'html' not in content_type.lower():
+        return None
+    try:
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            body = dechunk(body)
+        if headers.get('content-encoding', '').lower() in ('gzip', 'deflate'):
+            # wbits 47 accepts both gzip and zlib headers
+            body = zlib.decompress(body, 47)
+    except (ValueError, zlib.error):
+        return None
+    charset = re.search(r'charset=["\']?([\w-]+)', content_type, re.IGNORECASE)
+    try:
+        return body.decode(charset.group(1) if charset else 'utf-8', errors='replace')
+    except LookupError:
+        return body.decode('utf-8', errors='replace')
+
+# Read HTML responses from a WARC file (.warc or .warc.gz); other records are skipped
+def read_warc(path):
+    with open_source(path) as f:
+        while True:
+            line = f.readline()
+            if not line:
+                return
+            if not line.strip():
+                continue
+            if not line.startswith(b'WARC/'):
+                raise ValueError('%s: expected a WARC record at byte %d' % (path, f.tell() - len(line)))
+            headers = read_headers(iter(f.readline, b''))
+            block = f.read(int(headers.get('content-length', 0)))
+            if headers.get('warc-type') != 'response' or not headers.get('warc-target-uri'):
+                continue
+            html = http_html(block)
+            if html is not None:
+                yield headers['warc-target-uri'].strip('<>'), html, None, None
+
+# Read records from a source, picking the reader by its type
+def read_source(path, base_url=None):
+    if os.path.isdir(path):
+        return read_html_dir(path, base_url)
+    name = path.lower()
+    if name.endswith(('.jsonl', '.jsonl.gz', '.ndjson', '.ndjson.gz')):
+        return read_jsonl(path)
+    if name.endswith(('.warc', '.warc.gz')):
+        return read_warc(path)
+    raise ValueError('%s: not a directory, JSONL file or WARC file' % path)
+
+# Worker function: extract and fingerprint a chunk of records into (url, title, text, fingerprint) rows
+def extract_records(records):
+    rows = []
+    for url, html, title, text in records:
+        if html is not None:
+            text, title = get_raw_text(html)
+        rows.append((url, title, text, simhash(title + ' ' + text)))
+    return rows
+
+# Split records into lists of up to size
+def chunks(records, size):
+    records = iter(records)
+    while True:
+        chunk = list(itertools.islice(records, size))
+        if not chunk:
+            return
+        yield chunk
+
+# Extract chunks on the pool, yielding (records in chunk, rows) in input order
+# At most max_pending chunks are in flight, so memory stays bounded however large the source is
+def extract_in_order(pool, record_chunks, max_pending):
+    pending = collections.deque()
+    for chunk in record_chunks:
+        pending.append((len(chunk), pool.submit(extract_records, chunk)))
+        if len(pending) >= max_pending:
+            size, future = pending.popleft()
+            yield size, future.result()
+    while pending:
+        size, future = pending.popleft()
+        yield size, future.result()
+
+# Records of a source already ingested, and documents written from them
+def get_checkpoint(cursor, source):
+    row = cursor.execute('SELECT position, documents FROM ingest_checkpoints WHERE source = ?', (source,)).fetchone()
+    return row or (0, 0)
+
+# Write rows under a new generation, with their fingerprints and, if recrawl, frontier entries
+def write_rows(cursor, store, rows, recrawl, now):
+    generation = bump_generation(cursor)
+    write_documents(cursor, store, [(url_hash(url), url, title, text) for url, title, text, _ in rows], generation)
+    cursor.executemany(upsert_fingerprint, [fingerprint_row(fingerprint, url_hash(url))
+                                            for url, _, _, fingerprint in rows if fingerprint is not None])
+    # Only web pages can be recrawled
+    if recrawl:
+        cursor.executemany(upsert_frontier, [frontier_row(url, title, text, now) for url, title, text, _ in rows
+                                             if url.startswith(('http://', 'https://'))])
+
+# Write a batch of rows and move the source's checkpoint forward
+# Rows are filtered like crawled pages; returns the number of documents written
+# Without shards the documents and the checkpoint commit in one transaction. With shards, a list of
+# (connection, store) pairs (see shards.py), each shard commits its rows first; a batch interrupted before
+# its checkpoint is simply written again on resume, upserting the same documents
+def write_batch(connection, store, source, position, documents, rows, recrawl=False, shards=None):
+    now = time.time()
+    rows = [row for row in rows if not data_filter('', row[1], row[2])]
+    for shard, (shard_connection, shard_store) in enumerate(shards or ()):
+        shard_rows = [row for row in rows if shard_of(url_hash(row[0]), len(shards)) == shard]
+        if shard_rows:
+            shard_cursor = shard_connection.cursor()
+            with shard_connection:
+                write_rows(shard_cursor, shard_store, shard_rows, recrawl, now)
+            shard_cursor.close()
+    cursor = connection.cursor()
+    with connection:
+        if rows and not shards:
+            write_rows(cursor, store, rows, recrawl, now)
+        cursor.execute('INSERT OR REPLACE INTO ingest_checkpoints (source, position, documents, updated_at) VALUES (?, ?, ?, ?)',
+                       (source, position, documents + len(rows), now))
+    cursor.close()
+    count('documents_stored_total', len(rows))
+    return len(rows)
+
+# Ingest one source from its checkpoint on; returns the number of documents written
+def ingest_source(connection, store, pool, workers, path, batch_size=1000, base_url=None, recrawl=False, restart=False, shards=None):
+    source = os.path.abspath(path)
+    cursor = connection.cursor()
+    position, documents = (0, 0) if restart else get_checkpoint(cursor, source)
+    cursor.close()
+    if position:
+        print('%s: resuming after %d records' % (path, position))
+    # Records before the checkpoint are read again but not extracted
+    records = itertools.islice(read_source(path, base_url), position, None)
+    start = time.perf_counter()
+    written = 0
+    batch, consumed = [], 0
+    for size, rows in extract_in_order(pool, chunks(records, chunk_size), workers * pending_per_worker):
+        batch.extend(rows)
+        consumed += size
+        if len(batch) >= batch_size:
+            position += consumed
+            stored = write_batch(connection, store, source, position, documents, batch, recrawl, shards)
+            documents += stored
+            written += stored
+            batch, consumed = [], 0
+            print('%s: %d records, %d documents, %.1f docs/sec' % (path, position, documents, written / (time.perf_counter() - start)))
+    if consumed:
+        position += consumed
+        stored = write_batch(connection, store, source, position, documents, batch, recrawl, shards)
+        documents += stored
+        written += stored
+    print('%s: done, %d records, %d documents' % (path, position, documents))
+    return written
+
+# Ingest sources into a database, or into shard_count shards of it; returns (documents written, seconds)
+# Checkpoints are kept in db_file either way
+def ingest(sources, db_file='custom_search_engine.db', batch_size=1000, workers=None, base_url=None, recrawl=False, restart=False, shard_count=None):
+    connection = connect(db_file)
+    cursor = connection.cursor()
+    store = get_doc_store(db_file, cursor)
+    cursor.close()
+    shards = []
+    for shard_file in shard_files(db_file, shard_count or 0):
+        shard_connection = connect(shard_file)
+        shards.append((shard_connection, get_doc_store(shard_file, shard_connection.cursor())))
+    workers = workers or os.cpu_count() or 1
+    pool = ProcessPoolExecutor(workers)
+    start = time.perf_counter()
+    written = 0
+    try:
+        for path in sources:
+            written += ingest_source(connection, store, pool, workers, path, batch_size, base_url, recrawl, restart, shards)
+        # Re-ingested documents leave their old text behind in the document store
+        for target_connection, target_store in shards or [(connection, store)]:
+            compacted = compact_if_needed(target_connection, target_store)
+            if compacted:
+                print('Compacted %s from %d to %d bytes' % ((target_store.path,) + compacted))
+    finally:
+        seconds = time.perf_counter() - start
+        print('Ingested %d documents in %.1fs (%.1f docs/sec)' % (written, seconds, written / seconds if seconds else 0))
+        pool.shutdown(cancel_futures=True)
+        for shard_connection, _ in shards:
+            shard_connection.close()
+        connection.close()
+    return written, seconds
+
+# python ingest.py [--db custom_search_engine.db] SOURCE [SOURCE ...]
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bulk-load HTML directories, JSONL files and WARC archives into the search database')
+    parser.add_argument('sources', nargs='+', help='directories of .html files, .jsonl files ({"url", "html"} or {"url", "title", "text"} per line) or .warc files, optionally gzipped')
+    parser.add_argument('--db', default='custom_search_engine.db', help='database file')
+    parser.add_argument('--batch-size', type=int, default=1000, help='documents per transaction')
+    parser.add_argument('--workers', type=int, help='extraction processes (default: CPU count)')
+    parser.add_argument('--base-url', help='URL prefix for files in HTML directories (default: file:// URIs)')
+    parser.add_argument('--recrawl', action='store_true', help='add http(s) pages to the recrawl frontier')
+    parser.add_argument('--restart', action='store_true', help='ignore checkpoints and ingest every source from the start')
+    parser.add_argument('--shards', type=int, help='split documents by URL hash across this many shard databases (see shards.py)')
+    args = parser.parse_args()
+    # The recrawler works on db_file itself, so it can't keep sharded documents fresh
+    if args.shards and args.recrawl:
+        parser.error('--recrawl only works without --shards')
+    try:
+        ingest(args.sources, args.db, args.batch_size, args.workers, args.base_url, args.recrawl, args.restart, args.shards)
+    except KeyboardInterrupt:
+        print('Interrupted; run the same command again to resume from the last checkpoint')
@@ -0,0 +1,270 @@
+import os
+import math
+import heapq
+import threading
+import contextlib
+from collections import Counter
+from tokenizer import tokenize
+from database import connect
+from doc_store import get_doc_store
+from metrics import span
+
+# Lock shared by any number of readers or held by one writer
+# A waiting writer holds back new readers, so a steady stream of searches can't keep a refresh out forever
+class ReadWriteLock:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writing = False
+        self.writers_waiting = 0
+
+    # Hold the lock for reading
+    @contextlib.contextmanager
+    def read(self):
+        with self.condition:
+            while self.writing or self.writers_waiting:
+                self.condition.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if not self.readers:
+                    self.condition.notify_all()
+
+    # Hold the lock for writing
+    @contextlib.contextmanager
+    def write(self):
+        with self.condition:
+            self.writers_waiting += 1
+            while self.writing or self.readers:
+                self.condition.wait()
+            self.writers_waiting -= 1
+            self.writing = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+# In-memory inverted index over the documents table, scored with BM25
+# refresh() changes the tables in place under the write lock; searches hold the read lock from their
+# first lookup to their last (see reading), so they never see a postings list change under them
+class InvertedIndex:
+    def __init__(self, k1=1.5, b=0.75):
+        # BM25 parameters
+        self.k1 = k1
+        self.b = b
+        # Term -> {doc_id: [positions]}
+        self.postings = {}
+        # Doc_id -> number of terms in title + description
+        self.doc_lengths = {}
+        # Doc_id -> distinct terms, so a rewritten document's old postings can be removed
+        self.doc_terms = {}
+        # Doc_id -> length of the document's log-tf vector, for cosine scoring (see reranker.py)
+        self.doc_norms = {}
+        self.total_length = 0
+        # Database generation the index reflects; documents written at later generations get (re)indexed
+        self.generation = -1
+        self.lock = ReadWriteLock()
+
+    # Add a single document to the postings lists, replacing any earlier version of it
+    def add_document(self, doc_id, title, description):
+        if doc_id in self.doc_lengths:
+            self.remove_document(doc_id)
+        terms = tokenize((title or '') + ' ' + (description or ''))
+        for position, term in enumerate(terms):
+            self.postings.setdefault(term, {}).setdefault(doc_id, []).append(position)
+        counts = Counter(terms)
+        self.doc_lengths[doc_id] = len(terms)
+        self.doc_terms[doc_id] = tuple(counts)
+        self.doc_norms[doc_id] = math.sqrt(sum((1 + math.log(tf)) ** 2 for tf in counts.values()))
+        self.total_length += len(terms)
+
+    # Remove a document from the postings lists
+    def remove_document(self, doc_id):
+        for term in self.doc_terms.pop(doc_id, ()):
+            postings = self.postings[term]
+            del postings[doc_id]
+            if not postings:
+                del self.postings[term]
+        self.doc_norms.pop(doc_id, None)
+        self.total_length -= self.doc_lengths.pop(doc_id, 0)
+
+    # Drop every document and posting
+    def clear(self):
+        self.postings = {}
+        self.doc_lengths = {}
+        self.doc_terms = {}
+        self.doc_norms = {}
+        self.total_length = 0
+        self.generation = -1
+
+    # Bring the index up to date with the database, reading text from the document store
+    # When the generation has moved on, documents written since are (re)indexed. Returns False without
+    # changing the index when it should be rebuilt instead: rows were deleted, so the counts no longer
+    # match, or more than limit documents changed
+    def refresh(self, cursor, store, limit=None):
+        cursor.execute('SELECT generation FROM index_generation WHERE id = 1')
+        generation = cursor.fetchone()[0]
+        # Most searches find nothing new and don't wait for the write lock
+        if generation == self.generation:
+            return True
+        with self.lock.write():
+            if generation <= self.generation:
+                return True
+            cursor.execute('SELECT id, title FROM documents WHERE generation > ? ORDER BY id', (self.generation,))
+            rows = cursor.fetchall()
+            cursor.execute('SELECT COUNT(*) FROM documents')
+            documents = cursor.fetchone()[0]
+            if limit is not None and len(rows) > limit:
+                return False
+            if documents != len(self.doc_lengths) + sum(1 for doc_id, _ in rows if doc_id not in self.doc_lengths):
+                return False
+            self.add_documents(cursor, store, rows)
+            self.generation = generation
+            return True
+
+    # Hold off refreshes while a search reads the index
+    def reading(self):
+        return self.lock.read()
+
+    # Index (doc_id, title) rows, reading their text from the document store a chunk at a time
+    def add_documents(self, cursor, store, rows):
+        for i in range(0, len(rows), 500):
+            chunk = rows[i:i + 500]
+            texts = store.get_many(cursor, [doc_id for doc_id, _ in chunk])
+            for doc_id, title in chunk:
+                self.add_document(doc_id, title, texts.get(doc_id, ''))
+
+    # Inverse document frequency of a term, from this index or from (documents, total length, {term: df}) stats
+    def idf(self, term, stats=None):
+        n = stats[0] if stats else len(self.doc_lengths)
+        df = stats[2].get(term, 0) if stats else len(self.postings.get(term, ()))
+        return math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+    # Collection statistics BM25 needs for some terms: (documents, total length, {term: df})
+    # Summed over shards, they let every shard score with the same idf and average length (see shards.py)
+    def term_stats(self, terms):
+        return len(self.doc_lengths), self.total_length, {term: len(self.postings.get(term, ())) for term in set(terms)}
+
+    # Number of times a term appears in a document
+    def term_frequency(self, term, doc_id):
+        return len(self.postings.get(term, {}).get(doc_id, ()))
+
+    # Positions of a term in a document
+    def positions(self, term, doc_id):
+        return self.postings.get(term, {}).get(doc_id, [])
+
+    # Score every document in the query terms' postings lists and return the best k as (score, doc_id)
+    # Only the postings of the query terms are visited, so cost does not depend on corpus size
+    # stats from term_stats, summed over several indexes, replace this index's own collection statistics
+    def top_k(self, terms, k=None, stats=None):
+        if not self.doc_lengths:
+            return []
+        avg_length = stats[1] / stats[0] if stats else self.total_length / len(self.doc_lengths)
+        scores = {}
+        for term in set(terms):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = self.idf(term, stats)
+            for doc_id, positions in postings.items():
+                tf = len(positions)
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / avg_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        if k is None:
+            return sorted(((score, doc_id) for doc_id, score in scores.items()), reverse=True)
+        return heapq.nlargest(k, ((score, doc_id) for doc_id, score in scores.items()))
+
+# Largest number of documents held in the in-memory index; it keeps every position of every term, at
+# tens of KB per document, so bigger databases are searched with FTS5 instead (see data_processing.py)
+max_documents = int(os.environ.get('INDEX_MAX_DOCUMENTS', 50000))
+
+# Most changed documents indexed by a search itself; after bigger writes, such as a bulk ingest, the index
+# is rebuilt in the background
+max_refresh = 2000
+
+# Times a build reads the documents table before giving up on a database being written to continuously
+build_attempts = 3
+
+# One index per database file, shared by every search in the process; None marks a database too big to index
+indexes = {}
+# Threads building an index, by database file
+builds = {}
+indexes_lock = threading.Lock()
+
+# Build the index for a database file on a background thread, unless it is already built or being built
+# rebuild=True replaces an existing index, which keeps serving searches until the new one is ready
+# Returns the building thread, or None when there is nothing to wait for
+def start_index(db_file, rebuild=False):
+    with indexes_lock:
+        if db_file in builds or (db_file in indexes and not rebuild):
+            return builds.get(db_file)
+        thread = builds[db_file] = threading.Thread(target=build_index, args=(db_file,), daemon=True)
+    thread.start()
+    return thread
+
+# Build a complete index for a database file and publish it for searches
+def build_index(db_file):
+    connection = connect(db_file)
+    cursor = connection.cursor()
+    index = None
+    try:
+        cursor.execute('SELECT COUNT(*) FROM documents')
+        documents = cursor.fetchone()[0]
+        if documents > max_documents:
+            print('%s has %d documents, over INDEX_MAX_DOCUMENTS=%d; searching it with FTS5' % (db_file, documents, max_documents))
+        else:
+            with span('index_build'):
+                index = InvertedIndex()
+                store = get_doc_store(db_file, cursor)
+                # refresh() declines when rows are written between its two reads; retry a few times, then
+                # leave searches on FTS5 (or the previous index) until the next build rather than publish an empty index
+                for attempt in range(build_attempts):
+                    if index.refresh(cursor, store):
+                        break
+                else:
+                    print('Error: index build for %s kept changing under it; searching with FTS5 until the next build' % db_file)
+                    return
+        with indexes_lock:
+            indexes[db_file] = index
+    except Exception as e:
+        # A later search starts another build
+        print('Error: index build for %s failed: %r' % (db_file, e))
+    finally:
+        cursor.close()
+        connection.close()
+        with indexes_lock:
+            del builds[db_file]
+
+# Whether searches can use the index for a database file right now, starting its first build if needed
+def index_ready(db_file):
+    return start_index(db_file) is None and indexes.get(db_file) is not None
+
+# Get the index for a database file, refreshed against the current table contents
+# The first build, and rebuilds, run on a background thread (see start_index); wait=False returns None instead
+# of waiting for one, so a search can use FTS5 meanwhile. Also None when the database is too big to index
+# Searches read the index inside index.reading()
+def get_index(db_file, cursor, wait=True):
+    index = None
+    for attempt in range(2):
+        thread = start_index(db_file)
+        if thread is not None:
+            if not wait:
+                return None
+            thread.join()
+        index = indexes.get(db_file)
+        if index is None or index.refresh(cursor, get_doc_store(db_file, cursor), None if wait else max_refresh):
+            break
+        # Rows were deleted, or too many changed for a search to index them itself
+        start_index(db_file, rebuild=True)
+    if index is not None and len(index.doc_lengths) > max_documents:
+        # Grown past the limit; drop it to free the memory
+        print('%s has grown past INDEX_MAX_DOCUMENTS=%d; searching it with FTS5' % (db_file, max_documents))
+        with indexes_lock:
+            indexes[db_file] = None
+        return None
+    return index
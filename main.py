@@ -1,50 +1,162 @@
 import os
-import sys
-import sqlite3
-import requests
-import urllib.parse
-from flask import Flask, request, render_template
-from search_functions import get_js_soup, filter_function, google_transformer, remove_dup, get_raw_text, get_all, async_main, sql_execute, data_filter, populate_database
-from data_processing import remove_stop_words, keyword_count, dict_to_tuple, search
-from configuration import add_search_query, add_search_result, get_info
-
-# Define the search engines and their corresponding URLs
-browsers = {'Google': 'https://www.google.com/search?q=',
-            'DuckDuckGo': 'https://duckduckgo.com/html/?q=',
-            'Bing': 'https://www.bing.com/search?q=',
-            'Yahoo': 'https://search.yahoo.com/search?p=',
-            'Yandex': 'https://yandex.com/search/?text='}
+import json
+import logging
+from flask import Flask, request, render_template, redirect, url_for, Response, stream_with_context, g
+from engine_config import search_engines
+from search_functions import store_pages
+from data_processing import search_documents, result_engines
+from snippets import snippet_segments
+from inverted_index import start_index
+from query_analyzer import get_analyzer
+from orchestrator import populate_all, crawl_engines
+from shards import get_sharded_index
+from recrawl import RecrawlScheduler, query_is_fresh, mark_query_crawled
+from metrics import registry, start_trace, end_trace, start_profile, dump_profile
 
 # Define the database file path relative to the current file
 db_file = "custom_search_engine.db"
 
+# Load the query analyzer once at startup so searches don't pay for it
+analyzer = get_analyzer()
+
+# Seconds each engine gets before its results are used as they stand
+engine_timeout = 15
+
+# Number of ranked results streamed for a query, and shown per page of the results page
+max_results = 50
+page_size = 20
+
+# Number of shard databases to search (see shards.py), or 0 to search the main database
+# Set SEARCH_SHARDS to the count the collection was split or ingested into
+search_shards = int(os.environ.get('SEARCH_SHARDS', '0'))
+
+# Per-request stage timings are logged at DEBUG; run with logging.basicConfig(level=logging.DEBUG) to see them
+logger = logging.getLogger(__name__)
+
+# Background recrawler keeping stored pages fresh; started with the app unless RECRAWL=0
+recrawler = None
+
 # Define the Flask app
 app = Flask(__name__)
 
 # Enable debug mode
 app.debug = True
 
+# Time every request by pipeline stage; with SEARCH_PROFILE_DIR set, ?profile=1 also dumps a cProfile of the request
+@app.before_request
+def before_request():
+    start_trace()
+    g.profiler = start_profile() if request.args.get('profile') else None
+
+# Log the stage breakdown of the request and write its profile, if one was taken
+@app.after_request
+def after_request(response):
+    spans = end_trace()
+    if spans and logger.isEnabledFor(logging.DEBUG):
+        logger.debug('%s %s: %s', request.method, request.path, ', '.join('%s=%.3fs' % span for span in spans))
+    if g.profiler is not None:
+        print('Profile written to ' + dump_profile(g.profiler, request.endpoint or 'request'))
+    return response
+
 # Define the route for the search page
+# POST crawls the engines for the query and shows the first page; GET with ?query=&page= pages through the stored results
 @app.route('/', methods=['GET', 'POST'])
 def index():
     # Get the search query from the form
     if request.method == 'POST':
         search_query = request.form['query']
 
-        # Loop through each engine and populate the database based on the query and engine
-        for engine, url in browsers.items():
-            print('Populating database for ' + engine + '...')
-            add_search_query(search_query, engine)
-            search_results = get_info(search_query, engine)
-            for url in search_results:
-                add_search_result(url, search_query, '', '')  # Add website title and raw text as needed
+        # Scrape every engine concurrently; engines slower than engine_timeout contribute what they have
+        # A query crawled recently is answered from the index while the recrawler keeps its pages fresh
+        status = {}
+        if recrawler is None or not query_is_fresh(db_file, search_query):
+            print('Populating database for ' + ', '.join(search_engines) + '...')
+            status = populate_all(search_query, search_engines.keys(), timeout=engine_timeout, db_file=db_file)
+            if all(status.values()):
+                mark_query_crawled(db_file, search_query)
+
+        return results_page(search_query, 1, status)
 
-        # Render the search results template
-        return render_template("results.html", query=search_query, rows=search_results)
+    # Later pages of a query are read from the index without crawling again
+    if request.args.get('query'):
+        return results_page(request.args['query'], request.args.get('page', 1, type=int))
 
     # If the request method is GET, render the search page
     # Render the search page template
-    return render_template("search.html", engines=browsers.keys())
+    return render_template("search.html", engines=search_engines.keys())
+
+# Rank the stored documents for a query, through the shards when SEARCH_SHARDS is set
+def find(search_query, **options):
+    if search_shards:
+        return get_sharded_index(db_file, search_shards).search(search_query, **options)
+    return search_documents(search_query, db_file, **options)
+
+# Render one page of ranked results for a query
+def results_page(search_query, page, status=None):
+    page = max(1, page)
+    # Rank the stored documents for the query, one extra to tell whether there is a next page
+    search_results = find(search_query, k=page_size + 1, snippets=True, offset=(page - 1) * page_size)
+    # Name the engines that returned each shown page
+    engines = result_engines(db_file, [result[0] for result in search_results[:page_size]])
+    # Rows in the (url, title, description, info_type, engine, score) layout results.html expects; descriptions are HTML snippets
+    rows = [(url, title, description, None, engines.get(url, ''), total) for url, title, description, _, total in search_results[:page_size]]
+
+    # Render the search results template
+    return render_template("results.html", query=search_query, rows=rows, status=status or {},
+                           page=page, has_next=len(search_results) > page_size, start=(page - 1) * page_size + 1)
+
+# Define the route for the live results page, which fills in from /stream as engines finish
+@app.route('/live')
+def live():
+    search_query = request.args.get('query', '').strip()
+    if not search_query:
+        return redirect(url_for('index'))
+    return render_template("stream.html", query=search_query)
+
+# Define the server-sent events route streaming ranked results for a query
+# Each engine's pages are stored as soon as that engine finishes, then the whole result list is
+# re-ranked and pushed, so the first results arrive after the fastest engine rather than the slowest
+# Like a POST to /, a query crawled recently is answered from the index without crawling
+@app.route('/stream')
+def stream():
+    search_query = request.args.get('query', '').strip()
+    if not search_query:
+        return Response('Error: empty query', status=400, mimetype='text/plain')
+
+    # Ranked results for the query as JSON-ready dicts; descriptions are [text, highlighted] segments, so the
+    # page builds them from text nodes rather than parsing HTML
+    def ranked():
+        return [{'url': url, 'title': title, 'description': snippet_segments(description), 'score': total}
+                for url, title, description, _, total in find(search_query, k=max_results, snippets=True)]
+
+    def events():
+        status = {}
+        if recrawler is None or not query_is_fresh(db_file, search_query):
+            for engine, pages, ranks, complete in crawl_engines(search_query, search_engines.keys(), timeout=engine_timeout):
+                store_pages(search_query, engine, pages, db_file, ranks=ranks)
+                status[engine] = complete
+                # Re-rank everything stored so far for the query
+                yield 'event: results\ndata: ' + json.dumps({'engine': engine, 'status': status, 'results': ranked()}) + '\n\n'
+            if all(status.values()):
+                mark_query_crawled(db_file, search_query)
+        else:
+            yield 'event: results\ndata: ' + json.dumps({'engine': None, 'status': status, 'results': ranked()}) + '\n\n'
+        yield 'event: done\ndata: ' + json.dumps({'status': status}) + '\n\n'
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Define the route exposing pipeline metrics in the Prometheus text format
+@app.route('/metrics')
+def metrics():
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
-    app.run()
+    # With the debug reloader, only the child process that serves requests builds the index and runs the recrawler
+    if not app.debug or os.environ.get('WERKZEUG_RUN_MAIN'):
+        # Build the search index in the background; searches use FTS5 until it is ready
+        start_index(db_file)
+        if os.environ.get('RECRAWL', '1') != '0':
+            recrawler = RecrawlScheduler(db_file).start()
+    # Threaded so a streaming response doesn't block other requests
+    app.run(threaded=True)
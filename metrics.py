@@ -0,0 +1,194 @@
+import os
+import time
+import bisect
+import cProfile
+import threading
+import contextlib
+import contextvars
+
+# In-process metrics for the crawl and search pipeline, rendered in the Prometheus text format
+# Counters and histograms are keyed by (name, labels); every update takes the registry lock
+# Gauges are functions read when the metrics are rendered, for state other modules already keep
+
+# Histogram buckets for durations in seconds and for page sizes in bytes
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+size_buckets = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# Help text for the metrics the pipeline records
+descriptions = {
+    'stage_seconds': 'Time spent in each pipeline stage',
+    'fetch_seconds': 'Time to download one result page',
+    'page_size_bytes': 'Size of downloaded result pages',
+    'extract_seconds': 'Time a worker spent parsing one page',
+    'fetch_errors_total': 'Result page fetches that failed, by error',
+    'pages_fetched_total': 'Result pages downloaded',
+    'documents_stored_total': 'Documents written to the database',
+    'searches_total': 'Searches served, by backend and cache use',
+    'engine_crawls_total': 'Engine crawls, by engine and outcome',
+    'recrawls_total': 'Background page recrawls, by outcome',
+    'serp_cache_total': 'Engine results page lookups, by engine and cache outcome',
+    'urls_blocked_total': 'Scraped links rejected by the URL filter, by kind of rule',
+    'page_cache_total': 'Page fetches through the on-disk page cache, by outcome (hit, revalidated or miss)',
+    'page_cache_bytes': 'Compressed page bodies held in the on-disk page cache',
+    'query_cache_hits': 'Searches answered from the in-process query cache',
+    'query_cache_disk_hits': 'Searches answered from the on-disk query cache tier',
+    'query_cache_misses': 'Searches not found in the query cache',
+    'query_cache_evictions': 'Results evicted from the in-process query cache',
+    'query_cache_size': 'Results held in the in-process query cache',
+}
+
+# Counters, histograms and gauges for one process
+class Registry:
+    def __init__(self):
+        # (name, labels) -> value
+        self.counters = {}
+        # (name, labels) -> function returning the current value
+        self.gauges = {}
+        # (name, labels) -> [bucket counts, sum, count]; buckets are per name
+        self.histograms = {}
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    # Add value to a counter
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    # Record one observation in a histogram
+    def observe(self, name, value, buckets=latency_buckets, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            buckets = self.buckets.setdefault(name, buckets)
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(buckets), 0.0, 0]
+            # Counts are stored per bucket and made cumulative when rendered
+            position = bisect.bisect_left(buckets, value)
+            if position < len(buckets):
+                histogram[0][position] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    # Register a gauge whose value is read from read() whenever the metrics are rendered
+    def gauge(self, name, read, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = read
+
+    # Render every metric in the Prometheus text exposition format
+    def render(self):
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(counts), total, number)) for key, (counts, total, number) in self.histograms.items())
+            gauges = sorted(self.gauges.items(), key=lambda item: item[0])
+        seen = set()
+        for (name, labels), value in counters:
+            if name not in seen:
+                seen.add(name)
+                lines.append('# HELP %s %s' % (name, descriptions.get(name, name)))
+                lines.append('# TYPE %s counter' % name)
+            lines.append('%s%s %s' % (name, format_labels(labels), value))
+        for (name, labels), (counts, total, number) in histograms:
+            if name not in seen:
+                seen.add(name)
+                lines.append('# HELP %s %s' % (name, descriptions.get(name, name)))
+                lines.append('# TYPE %s histogram' % name)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets[name], counts):
+                cumulative += bucket_count
+                lines.append('%s_bucket%s %d' % (name, format_labels(labels + (('le', repr(float(bound))),)), cumulative))
+            lines.append('%s_bucket%s %d' % (name, format_labels(labels + (('le', '+Inf'),)), number))
+            lines.append('%s_sum%s %r' % (name, format_labels(labels), total))
+            lines.append('%s_count%s %d' % (name, format_labels(labels), number))
+        # Gauges are read outside the registry lock, since they take their owners' locks
+        for (name, labels), read in gauges:
+            if name not in seen:
+                seen.add(name)
+                lines.append('# HELP %s %s' % (name, descriptions.get(name, name)))
+                lines.append('# TYPE %s gauge' % name)
+            lines.append('%s%s %s' % (name, format_labels(labels), read()))
+        return '\n'.join(lines) + '\n'
+
+    # Forget every counter and histogram; gauges stay registered
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+# Format a sorted label tuple as {name="value",...}
+def format_labels(labels):
+    if not labels:
+        return ''
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join('%s="%s"' % (name, escape(value)) for name, value in labels) + '}'
+
+# Process-wide registry
+registry = Registry()
+
+# Spans finished since start_trace(), for per-request timing breakdowns
+# A context variable rather than a thread-local: coroutines submitted to the fetcher's event loop run in a copy
+# of the submitting thread's context, so crawl spans recorded on the loop thread land in the request's trace
+trace = contextvars.ContextVar('trace', default=None)
+
+# Start collecting finished spans in this context
+def start_trace():
+    trace.set([])
+
+# Stop collecting spans in this context and return them as (stage, seconds) in finishing order
+def end_trace():
+    spans = trace.get() or []
+    trace.set(None)
+    return spans
+
+# Time a pipeline stage: records stage_seconds{stage=...} and adds the span to the current trace
+@contextlib.contextmanager
+def span(stage, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(stage, time.perf_counter() - start, **labels)
+
+# Record a stage duration measured elsewhere, e.g. time summed over many small calls
+def record_span(stage, seconds, **labels):
+    registry.observe('stage_seconds', seconds, stage=stage, **labels)
+    spans = trace.get()
+    if spans is not None:
+        spans.append((stage, seconds))
+
+# Module-level shortcuts for the shared registry
+def count(name, value=1, **labels):
+    registry.count(name, value, **labels)
+
+def observe(name, value, buckets=latency_buckets, **labels):
+    registry.observe(name, value, buckets, **labels)
+
+# Record the outcome of one page fetch: an error counter for 'Error: ...' results, otherwise size and latency
+def record_fetch(html, seconds):
+    if html.startswith('Error: '):
+        count('fetch_errors_total', error=html[len('Error: '):])
+        return
+    count('pages_fetched_total')
+    observe('fetch_seconds', seconds)
+    observe('page_size_bytes', len(html), size_buckets)
+
+# Directory for per-request cProfile dumps; profiling is off unless this is set
+profile_dir = os.environ.get('SEARCH_PROFILE_DIR')
+
+# Start profiling the current request when profiling is enabled; returns the profiler or None
+def start_profile():
+    if not profile_dir:
+        return None
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+# Stop a profiler from start_profile() and dump its stats to profile_dir/<name>-<milliseconds>.prof
+def dump_profile(profiler, name):
+    profiler.disable()
+    os.makedirs(profile_dir, exist_ok=True)
+    path = os.path.join(profile_dir, '%s-%d.prof' % (name, time.time() * 1000))
+    profiler.dump_stats(path)
+    return path
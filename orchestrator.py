@@ -0,0 +1,54 @@
+import asyncio
+import concurrent.futures
+from metrics import count
+from engine_config import search_engines
+from search_functions import remove_dup, get_fetcher, store_pages
+from engines import engine_results
+
+# Seconds each engine gets to return its results page and result pages
+engine_timeout = 15
+
+# Scrape one engine and fetch its result pages, appending (html, url) to pages as they arrive
+# ranks is filled with each URL's position on the results page
+async def crawl_engine(fetcher, query, engine, pages, ranks):
+    # Get scraped URLs from the engine's parser, while removing duplicate pages
+    url_list = remove_dup(await engine_results(fetcher, query, engine))
+    ranks.update((url, rank) for rank, url in enumerate(url_list))
+    async for page in fetcher.fetch_as_completed(url_list):
+        pages.append(page)
+
+# Crawl one engine under a timeout; returns (engine, pages, ranks, complete)
+# Pages fetched before the timeout are kept, so a slow engine still contributes partial results
+async def crawl_engine_with_timeout(fetcher, query, engine, timeout):
+    pages = []
+    ranks = {}
+    try:
+        await asyncio.wait_for(crawl_engine(fetcher, query, engine, pages, ranks), timeout)
+        count('engine_crawls_total', engine=engine, outcome='complete')
+        return engine, pages, ranks, True
+    except asyncio.TimeoutError:
+        print('%s timed out after %ss with %d pages' % (engine, timeout, len(pages)))
+        count('engine_crawls_total', engine=engine, outcome='timeout')
+    except Exception as e:
+        print('%s failed: %r' % (engine, e))
+        count('engine_crawls_total', engine=engine, outcome='error')
+    return engine, pages, ranks, False
+
+# Crawl several engines concurrently on the shared fetcher's event loop
+# Yields (engine, pages, ranks, complete) as each engine finishes or times out
+def crawl_engines(query, engines=None, timeout=engine_timeout):
+    fetcher = get_fetcher()
+    futures = [asyncio.run_coroutine_threadsafe(crawl_engine_with_timeout(fetcher, query, engine, timeout), fetcher.loop)
+               for engine in (engines or search_engines)]
+    for future in concurrent.futures.as_completed(futures):
+        yield future.result()
+
+# Populate the database from every engine at once
+# Each engine is stored as soon as it finishes, while slower engines keep crawling
+# Returns {engine: complete} so callers can tell which engines only gave partial results
+def populate_all(query, engines=None, timeout=engine_timeout, db_file='custom_search_engine.db', verbose=False):
+    status = {}
+    for engine, pages, ranks, complete in crawl_engines(query, engines, timeout):
+        store_pages(query, engine, pages, db_file, verbose, ranks)
+        status[engine] = complete
+    return status
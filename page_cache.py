@@ -0,0 +1,133 @@
+import time
+import zlib
+import sqlite3
+import threading
+from metrics import registry
+
+# On-disk cache of fetched pages keyed by URL
+# Bodies are zlib-compressed; validators (ETag/Last-Modified) are kept for conditional revalidation,
+# along with the extracted text so an unchanged page is never parsed twice
+# Every method does blocking I/O, so the fetcher calls them on its executor rather than on the event loop
+class PageCache:
+    def __init__(self, path='page_cache.db', ttl=3600, max_bytes=256 * 1024 * 1024):
+        # Seconds a page is served without revalidating, and the size limit for stored bodies
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        # The fetcher's loop thread and request threads share one connection
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS pages (
+                                     url TEXT PRIMARY KEY,
+                                     etag TEXT,
+                                     last_modified TEXT,
+                                     fetched_at REAL,
+                                     accessed_at REAL,
+                                     size INTEGER,
+                                     body BLOB,
+                                     text TEXT,
+                                     title TEXT)''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS pages_accessed_at ON pages (accessed_at)')
+        self.connection.commit()
+        self.total_bytes = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM pages').fetchone()[0]
+        # URL -> access time of cache hits not yet written; they only matter for eviction order, so they are
+        # written with the next put or touch, or once flush_every of them have built up
+        self.accessed = {}
+        self.flush_every = 100
+
+    # Get (html, etag, last_modified, fresh) for a URL, or None if it isn't cached
+    def get(self, url):
+        with self.lock:
+            row = self.connection.execute('SELECT body, etag, last_modified, fetched_at FROM pages WHERE url = ?', (url,)).fetchone()
+            if row is None:
+                return None
+            self.accessed[url] = time.time()
+            if len(self.accessed) >= self.flush_every:
+                self.flush_accessed()
+                self.connection.commit()
+        body, etag, last_modified, fetched_at = row
+        return zlib.decompress(body).decode('utf-8'), etag, last_modified, time.time() - fetched_at < self.ttl
+
+    # Headers for revalidating a cached copy
+    def conditional_headers(self, etag, last_modified):
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    # Store a freshly downloaded page, dropping any text extracted from an older copy
+    def put(self, url, html, etag=None, last_modified=None):
+        body = zlib.compress(html.encode('utf-8'))
+        now = time.time()
+        with self.lock:
+            old = self.connection.execute('SELECT size FROM pages WHERE url = ?', (url,)).fetchone()
+            self.connection.execute('''INSERT OR REPLACE INTO pages (url, etag, last_modified, fetched_at, accessed_at, size, body, text, title)
+                                       VALUES (?, ?, ?, ?, ?, ?, ?, NULL, NULL)''', (url, etag, last_modified, now, now, len(body), body))
+            self.total_bytes += len(body) - (old[0] if old else 0)
+            self.accessed.pop(url, None)
+            self.flush_accessed()
+            self.evict()
+            self.connection.commit()
+
+    # Mark a cached page as revalidated (the server answered 304)
+    def touch(self, url):
+        now = time.time()
+        with self.lock:
+            self.accessed.pop(url, None)
+            self.flush_accessed()
+            self.connection.execute('UPDATE pages SET fetched_at = ?, accessed_at = ? WHERE url = ?', (now, now, url))
+            self.connection.commit()
+
+    # Get (text, title) previously extracted from the cached copy of a URL, or None
+    # Only a fresh copy counts: a fetch returned the cached body only if it was a fresh hit, a 304 (touch) or a
+    # stored 200 (put), which all leave the copy fresh. A failed or non-200 refetch leaves it stale, so its old
+    # text isn't passed off as current, and put_extracted doesn't store text parsed from the error page with it
+    def get_extracted(self, url):
+        with self.lock:
+            row = self.connection.execute('SELECT text, title FROM pages WHERE url = ? AND text IS NOT NULL AND fetched_at > ?',
+                                          (url, time.time() - self.ttl)).fetchone()
+        return row
+
+    # Save the text extracted from the cached copy of a URL
+    def put_extracted(self, url, text, title):
+        with self.lock:
+            self.connection.execute('UPDATE pages SET text = ?, title = ? WHERE url = ? AND fetched_at > ?',
+                                    (text, title, url, time.time() - self.ttl))
+            self.connection.commit()
+
+    # Write the access times of pages served since the last flush
+    # Called with the lock held, inside the caller's transaction
+    def flush_accessed(self):
+        if self.accessed:
+            self.connection.executemany('UPDATE pages SET accessed_at = ? WHERE url = ?', [(accessed_at, url) for url, accessed_at in self.accessed.items()])
+            self.accessed = {}
+
+    # Remove least recently used pages until the stored bodies fit in max_bytes
+    # Called with the lock held
+    def evict(self):
+        while self.total_bytes > self.max_bytes:
+            rows = self.connection.execute('SELECT url, size FROM pages ORDER BY accessed_at LIMIT 100').fetchall()
+            if not rows:
+                self.total_bytes = 0
+                break
+            for url, size in rows:
+                self.connection.execute('DELETE FROM pages WHERE url = ?', (url,))
+                self.total_bytes -= size
+                if self.total_bytes <= self.max_bytes:
+                    break
+
+# Shared page cache, created on first use
+page_cache = None
+page_cache_lock = threading.Lock()
+
+# Get the shared page cache; settings only apply when it is first created
+def get_page_cache(path='page_cache.db', ttl=3600, max_bytes=256 * 1024 * 1024):
+    global page_cache
+    with page_cache_lock:
+        if page_cache is None:
+            page_cache = PageCache(path, ttl, max_bytes)
+            registry.gauge('page_cache_bytes', lambda: page_cache.total_bytes)
+    return page_cache
@@ -0,0 +1,90 @@
+import os
+import re
+import threading
+
+# English stopwords used by the regex analyzer, matching NLTK's 'english' list
+english_stop_words = frozenset('''
+i me my myself we our ours ourselves you you're you've you'll you'd your yours yourself yourselves
+he him his himself she she's her hers herself it it's its itself they them their theirs themselves
+what which who whom this that that'll these those am is are was were be been being have has had
+having do does did doing a an the and but if or because as until while of at by for with about
+against between into through during before after above below to from up down in out on off over
+under again further then once here there when where why how all any both each few more most other
+some such no nor not only own same so than too very s t can will just don don't should should've
+now d ll m o re ve y ain aren aren't couldn couldn't didn didn't doesn doesn't hadn hadn't hasn
+hasn't haven haven't isn isn't ma mightn mightn't mustn mustn't needn needn't shan shan't shouldn
+shouldn't wasn wasn't weren weren't won won't wouldn wouldn't
+'''.split())
+
+# Word pattern for the regex tokenizer, keeping contractions such as "don't" together
+word_pattern = re.compile(r"\w+(?:'\w+)*")
+
+# Tokenizer that needs nothing beyond the standard library
+def regex_tokenize(text):
+    return word_pattern.findall(text)
+
+# Load the NLTK tokenizer and stopwords once, downloading only the resources that are missing
+# NLTK 3.8.2 and later tokenize with punkt_tab, older releases with punkt, so both are fetched
+# The tokenizer is run once here, so missing data raises LookupError now rather than on the first search
+def load_nltk():
+    import nltk
+    for resource, path in (('stopwords', 'corpora/stopwords'), ('punkt', 'tokenizers/punkt'), ('punkt_tab', 'tokenizers/punkt_tab')):
+        try:
+            nltk.data.find(path)
+        except LookupError:
+            nltk.download(resource, quiet=True)
+    from nltk.corpus import stopwords
+    from nltk.tokenize import word_tokenize
+    word_tokenize('Loading the tokenizer.')
+    return word_tokenize, frozenset(stopwords.words('english'))
+
+# Query analyzer: tokenizer -> token filters -> stopword removal
+# Build it once and reuse it; every step can be swapped out
+class QueryAnalyzer:
+    def __init__(self, tokenizer, stop_words, filters=()):
+        self.tokenizer = tokenizer
+        self.stop_words = frozenset(stop_words)
+        # Callables applied to the token list in order, e.g. stemming or lowercasing
+        self.filters = list(filters)
+
+    # Split text into tokens and run the token filters
+    def tokenize(self, text):
+        tokens = self.tokenizer(text)
+        for token_filter in self.filters:
+            tokens = token_filter(tokens)
+        return tokens
+
+    # Get query keywords: tokens that are not stopwords
+    def analyze(self, text):
+        return [w for w in self.tokenize(text) if w.lower() not in self.stop_words]
+
+# Build an analyzer for a mode: 'nltk' (word_tokenize + NLTK stopwords) or 'regex' (no NLTK needed)
+# Falls back to 'regex' if NLTK is not installed or its data can't be found or downloaded (e.g. offline)
+def build_analyzer(mode='nltk'):
+    if mode == 'nltk':
+        try:
+            tokenizer, stop_words = load_nltk()
+            return QueryAnalyzer(tokenizer, stop_words)
+        except (ImportError, LookupError, OSError) as e:
+            print('NLTK not available (%r), using regex query analyzer' % e)
+    elif mode != 'regex':
+        raise ValueError('Unknown query analyzer mode: ' + mode)
+    return QueryAnalyzer(regex_tokenize, english_stop_words)
+
+# Shared analyzers, one per mode, built on first use
+analyzers = {}
+analyzers_lock = threading.Lock()
+
+# Default mode can be set with the QUERY_ANALYZER environment variable
+default_mode = os.environ.get('QUERY_ANALYZER', 'nltk')
+
+# Get the shared analyzer for a mode, building it the first time it is asked for
+def get_analyzer(mode=None):
+    mode = mode or default_mode
+    analyzer = analyzers.get(mode)
+    if analyzer is None:
+        with analyzers_lock:
+            analyzer = analyzers.get(mode)
+            if analyzer is None:
+                analyzer = analyzers[mode] = build_analyzer(mode)
+    return analyzer
@@ -0,0 +1,118 @@
+import os
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict
+from metrics import registry
+
+# Generation counter for the search tables, bumped by every write that changes search results
+generation_schema = ['CREATE TABLE IF NOT EXISTS index_generation (id INTEGER PRIMARY KEY CHECK (id = 1), generation INTEGER NOT NULL)',
+                     'INSERT OR IGNORE INTO index_generation (id, generation) VALUES (1, 0)']
+
+# Create the generation table if it is missing
+def create_generation_table(cursor):
+    for statement in generation_schema:
+        cursor.execute(statement)
+
+# Bump the generation inside the caller's write transaction, invalidating cached results
+# Returns the new generation, which writers also store on the rows they change
+def bump_generation(cursor):
+    create_generation_table(cursor)
+    cursor.execute('UPDATE index_generation SET generation = generation + 1 WHERE id = 1')
+    cursor.execute('SELECT generation FROM index_generation WHERE id = 1')
+    return cursor.fetchone()[0]
+
+# LRU cache of query -> ranked results, invalidated whenever the database generation changes
+# An optional on-disk tier lets results survive restarts and be shared between processes
+class QueryCache:
+    def __init__(self, maxsize=1024, disk_path=None):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Per-thread connections for reading the generation, so a hit costs one indexed SELECT
+        self.local = threading.local()
+        self.disk = None
+        if disk_path is not None:
+            self.disk = sqlite3.connect(disk_path, check_same_thread=False)
+            self.disk.execute('PRAGMA journal_mode = WAL')
+            self.disk.execute('CREATE TABLE IF NOT EXISTS query_results (key BLOB PRIMARY KEY, generation INTEGER, results BLOB)')
+            self.disk.commit()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Read the current generation of a database
+    def generation(self, db_file):
+        connections = getattr(self.local, 'connections', None)
+        if connections is None:
+            connections = self.local.connections = {}
+        connection = connections.get(db_file)
+        if connection is None:
+            connection = connections[db_file] = sqlite3.connect(db_file)
+        try:
+            return connection.execute('SELECT generation FROM index_generation WHERE id = 1').fetchone()[0]
+        except sqlite3.OperationalError:
+            # No writes have gone through the generation-aware insert path yet
+            return 0
+
+    # Get cached results for a key if they were computed at the given (current) generation
+    def get(self, key, generation):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == generation:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+        if self.disk is not None:
+            with self.lock:
+                row = self.disk.execute('SELECT results FROM query_results WHERE key = ? AND generation = ?', (pickle.dumps(key), generation)).fetchone()
+            if row is not None:
+                results = pickle.loads(row[0])
+                self.put_memory(key, generation, results)
+                with self.lock:
+                    self.disk_hits += 1
+                return results
+        with self.lock:
+            self.misses += 1
+        return None
+
+    # Store results computed at a given generation
+    def put(self, key, generation, results):
+        self.put_memory(key, generation, results)
+        if self.disk is not None:
+            with self.lock:
+                self.disk.execute('INSERT OR REPLACE INTO query_results (key, generation, results) VALUES (?, ?, ?)',
+                                  (pickle.dumps(key), generation, pickle.dumps(results)))
+                self.disk.commit()
+
+    # Store results in the in-process LRU, evicting the least recently used entries
+    def put_memory(self, key, generation, results):
+        with self.lock:
+            self.entries[key] = (generation, results)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    # Hit/miss/eviction counters
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'size': len(self.entries)}
+
+    # Drop every cached result
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            if self.disk is not None:
+                self.disk.execute('DELETE FROM query_results')
+                self.disk.commit()
+
+# Shared query cache used by data_processing.search
+# Set QUERY_CACHE_PATH to also keep results in an on-disk tier shared between processes
+query_cache = QueryCache(disk_path=os.environ.get('QUERY_CACHE_PATH'))
+
+# Export the shared cache's hit/miss/eviction counters and size at /metrics
+for stat in ('hits', 'disk_hits', 'misses', 'evictions', 'size'):
+    registry.gauge('query_cache_' + stat, lambda stat=stat: query_cache.stats()[stat])
@@ -0,0 +1,247 @@
+import sys
+import time
+import asyncio
+import threading
+import urllib.parse
+import urllib.robotparser
+from database import connect
+from doc_store import get_doc_store, compact_if_needed
+from schema import url_hash, write_documents, content_hash, recrawl_delay, min_interval, max_interval
+from fingerprint import upsert_fingerprint, fingerprint_row
+from query_cache import bump_generation
+from search_functions import get_fetcher, extract_pages
+from engines import serp_headers
+from metrics import span, count
+
+# Background recrawls of stored pages, so searches are answered from a fresh index instead of a live crawl
+# The frontier (crawl_frontier, see schema.py) keeps every stored page with the time it is next due. The due
+# time combines staleness, popularity and change rate: each page has a recrawl interval that halves when a
+# recrawl finds it changed and grows when it didn't, divided by how often searches have returned the page.
+
+# User agent matched against robots.txt rules: the one the shared fetcher sends
+robots_user_agent = serp_headers['user-agent']
+# Seconds between requests to one domain when robots.txt doesn't set a Crawl-delay
+default_crawl_delay = 1.0
+# Seconds a domain's robots.txt is trusted before it is fetched again, and after a failed fetch
+robots_ttl = 86400
+robots_retry = 600
+# Seconds between checks for dead space in the document store; changed pages leave their old text behind
+compact_every = 6 * 3600
+
+# Keeps the frontier moving: picks due pages, fetches them politely and stores the ones that changed
+class RecrawlScheduler:
+    def __init__(self, db_file, batch_size=200, per_domain=10, poll_seconds=60):
+        self.db_file = db_file
+        # Due pages taken from the frontier per round, and at most per_domain of them from any one domain
+        self.batch_size = batch_size
+        self.per_domain = per_domain
+        # Seconds to wait when nothing is due
+        self.poll_seconds = poll_seconds
+        # Domain -> (RobotFileParser or None, expires_at); None means the domain is skipped until it expires
+        self.robots = {}
+        # Domain -> earliest time of the next request to it
+        self.domain_ready = {}
+        self.stopped = threading.Event()
+        self.thread = None
+        self.compacted_at = time.time()
+
+    # Due pages from the frontier, most overdue first, as (url, domain)
+    # The per-domain cap is applied before the batch limit, so one domain with a large backlog
+    # can't fill the batch and hold every other domain back
+    def due(self, now):
+        connection = connect(self.db_file)
+        rows = connection.execute('''SELECT url, domain FROM (
+                                       SELECT url, domain, next_crawl_at,
+                                              ROW_NUMBER() OVER (PARTITION BY domain ORDER BY next_crawl_at) AS position
+                                       FROM crawl_frontier WHERE next_crawl_at <= ?)
+                                     WHERE position <= ? ORDER BY next_crawl_at LIMIT ?''',
+                                  (now, self.per_domain, self.batch_size)).fetchall()
+        connection.close()
+        return rows
+
+    # Get the robots.txt rules for a domain, fetching them on the fetcher's event loop when missing or expired
+    async def get_robots(self, fetcher, scheme, domain):
+        rules, expires_at = self.robots.get(domain, (None, 0))
+        if expires_at > time.time():
+            return rules
+        rules, ttl = None, robots_retry
+        try:
+            async with fetcher.session.get('%s://%s/robots.txt' % (scheme, domain), timeout=10) as response:
+                if response.status == 200:
+                    rules = urllib.robotparser.RobotFileParser()
+                    rules.parse((await response.text()).splitlines())
+                    ttl = robots_ttl
+                elif response.status in (401, 403):
+                    # Access to robots.txt denied: treat the whole site as disallowed
+                    rules = urllib.robotparser.RobotFileParser()
+                    rules.disallow_all = True
+                    ttl = robots_ttl
+                elif response.status < 500:
+                    # No robots.txt: everything is allowed
+                    rules = urllib.robotparser.RobotFileParser()
+                    rules.allow_all = True
+                    ttl = robots_ttl
+        # Network errors and server errors skip the domain until robots_retry has passed
+        except Exception as e:
+            print('robots.txt for %s failed: %r' % (domain, e))
+        self.robots[domain] = (rules, time.time() + ttl)
+        return rules
+
+    # Fetch one domain's due pages one at a time, waiting out its crawl delay between requests
+    # Returns (pages, disallowed, skipped): fetched (html, url) pages, URLs robots.txt forbids, and URLs
+    # left unfetched because the domain's robots.txt couldn't be read
+    async def crawl_domain(self, fetcher, domain, urls):
+        pages, disallowed = [], []
+        rules = await self.get_robots(fetcher, urllib.parse.urlparse(urls[0]).scheme or 'http', domain)
+        if rules is None:
+            return pages, disallowed, list(urls)
+        delay = rules.crawl_delay(robots_user_agent) or default_crawl_delay
+        for url in urls:
+            if not rules.can_fetch(robots_user_agent, url):
+                disallowed.append(url)
+                continue
+            wait = self.domain_ready.get(domain, 0) - time.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self.domain_ready[domain] = time.time() + delay
+            pages.append(await fetcher.fetch(url))
+        return pages, disallowed, []
+
+    # Fetch due pages across domains concurrently; each domain is crawled politely on its own
+    async def crawl(self, fetcher, by_domain):
+        results = await asyncio.gather(*[self.crawl_domain(fetcher, domain, urls) for domain, urls in by_domain.items()])
+        pages = [page for domain_pages, _, _ in results for page in domain_pages]
+        disallowed = [url for _, domain_urls, _ in results for url in domain_urls]
+        skipped = [url for _, _, domain_urls in results for url in domain_urls]
+        return pages, disallowed, skipped
+
+    # Run one round: recrawl up to batch_size due pages; returns the number of pages fetched
+    def run_once(self):
+        now = time.time()
+        by_domain = {}
+        for url, domain in self.due(now):
+            by_domain.setdefault(domain, []).append(url)
+        if not by_domain:
+            return 0
+        fetcher = get_fetcher()
+        with span('recrawl_fetch'):
+            pages, disallowed, skipped = asyncio.run_coroutine_threadsafe(self.crawl(fetcher, by_domain), fetcher.loop).result()
+        # Send the pages through the same extraction and filtering as a live crawl
+        fetched = [url for _, url in pages]
+        rows = extract_pages('', pages)
+        with span('recrawl_store'):
+            self.store(rows, fetched, disallowed, skipped)
+        return len(pages)
+
+    # Write a round's results: changed pages are stored under a new generation and every page gets its next due time
+    # skipped pages, on domains whose robots.txt couldn't be read, back off like failed fetches
+    def store(self, rows, fetched, disallowed, skipped=()):
+        now = time.time()
+        connection = connect(self.db_file)
+        cursor = connection.cursor()
+        with connection:
+            extracted = {url: (title, text, fingerprint) for url, title, text, fingerprint in rows}
+            changed, schedule = [], []
+            for url in list(fetched) + list(skipped):
+                row = cursor.execute('SELECT interval, popularity, content_hash, failures FROM crawl_frontier WHERE url_hash = ?',
+                                     (url_hash(url),)).fetchone()
+                if row is None:
+                    continue
+                interval, popularity, old_hash, failures = row
+                if url not in extracted:
+                    # Fetch error, page filtered out or robots.txt unavailable: back off exponentially, keep the stored copy
+                    # Skipped pages wait at least until their domain's robots.txt is tried again
+                    failures += 1
+                    delay = min(max_interval, recrawl_delay(interval, popularity) * 2 ** failures)
+                    if url in skipped:
+                        delay = max(delay, robots_retry)
+                        schedule.append((now + delay, None, None, 0, failures, interval, url_hash(url)))
+                        count('recrawls_total', outcome='skipped')
+                    else:
+                        schedule.append((now + delay, now, old_hash, 0, failures, interval, url_hash(url)))
+                        count('recrawls_total', outcome='failed')
+                    continue
+                title, text, fingerprint = extracted[url]
+                new_hash = content_hash(title, text)
+                if new_hash != old_hash:
+                    changed.append((url, title, text, fingerprint))
+                    interval = max(min_interval, interval / 2)
+                else:
+                    interval = min(max_interval, interval * 1.5)
+                schedule.append((now + recrawl_delay(interval, popularity), now, new_hash, int(new_hash != old_hash), 0, interval, url_hash(url)))
+                count('recrawls_total', outcome='changed' if new_hash != old_hash else 'unchanged')
+            # Pages robots.txt forbids are left alone for the longest interval
+            schedule.extend((now + max_interval, None, None, 0, 0, max_interval, url_hash(url)) for url in disallowed)
+            cursor.executemany('''UPDATE crawl_frontier SET next_crawl_at = ?, last_crawled_at = coalesce(?, last_crawled_at),
+                                  content_hash = coalesce(?, content_hash), crawl_count = crawl_count + 1,
+                                  change_count = change_count + ?, failures = ?, interval = ? WHERE url_hash = ?''', schedule)
+            # Only changed pages invalidate cached results and get re-indexed
+            if changed:
+                generation = bump_generation(cursor)
+                write_documents(cursor, get_doc_store(self.db_file, cursor), [(url_hash(url), url, title, text) for url, title, text, _ in changed], generation)
+                cursor.executemany(upsert_fingerprint, [fingerprint_row(fingerprint, url_hash(url))
+                                                        for url, _, _, fingerprint in changed if fingerprint is not None])
+        cursor.close()
+        connection.close()
+        print('Recrawl: %d pages fetched, %d changed, %d disallowed by robots.txt, %d skipped without robots.txt'
+              % (len(fetched), len(changed), len(disallowed), len(skipped)))
+
+    # Compact the document store if recrawls have left enough dead text in it
+    def compact(self):
+        self.compacted_at = time.time()
+        connection = connect(self.db_file)
+        cursor = connection.cursor()
+        store = get_doc_store(self.db_file, cursor)
+        cursor.close()
+        with span('recrawl_compact'):
+            compacted = compact_if_needed(connection, store)
+        connection.close()
+        if compacted:
+            print('Recrawl: compacted %s from %d to %d bytes' % ((store.path,) + compacted))
+
+    # Run rounds until stopped, sleeping while nothing is due
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                fetched = self.run_once()
+                if time.time() - self.compacted_at > compact_every:
+                    self.compact()
+            except Exception as e:
+                print('Recrawl round failed: %r' % e)
+                fetched = 0
+            if not fetched:
+                self.stopped.wait(self.poll_seconds)
+
+    # Start recrawling on a daemon thread
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    # Stop after the current round
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+# Whether a query was crawled live recently enough that the recrawler can be trusted to keep its pages fresh
+def query_is_fresh(db_file, query, max_age=min_interval):
+    connection = connect(db_file)
+    row = connection.execute('SELECT crawled_at FROM crawled_queries WHERE search_query = ?', (query,)).fetchone()
+    connection.close()
+    return row is not None and time.time() - row[0] < max_age
+
+# Remember that a query was just crawled live
+def mark_query_crawled(db_file, query):
+    connection = connect(db_file)
+    with connection:
+        connection.execute('INSERT OR REPLACE INTO crawled_queries (search_query, crawled_at) VALUES (?, ?)', (query, time.time()))
+    connection.close()
+
+# Run the recrawler in the foreground: python recrawl.py [db_file]
+if __name__ == '__main__':
+    scheduler = RecrawlScheduler(sys.argv[1] if len(sys.argv) > 1 else 'custom_search_engine.db')
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,75 @@
+import math
+
+# Re-rank candidate documents by TF-IDF cosine similarity in one sparse matrix-vector product
+# Documents are weighted 1 + log(tf) and cosine-normalized, the query 1 + log(tf) times idf (SMART lnc.ltc),
+# so document norms don't depend on corpus statistics and are kept by the inverted index as documents arrive
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = None
+    print('NumPy/SciPy not available, results keep their BM25 order')
+
+# Build the candidates x query-terms term-frequency matrix from the index postings
+# Returns (doc_ids, matrix), with doc_ids sorted and matching the matrix rows
+def term_matrix(index, terms, doc_ids=None):
+    ids, columns, frequencies = [], [], []
+    for column, term in enumerate(terms):
+        postings = index.postings.get(term)
+        if not postings:
+            continue
+        # Postings are read with C-level iteration rather than a Python loop per document
+        ids.append(np.fromiter(postings.keys(), np.int64, len(postings)))
+        frequencies.append(np.fromiter(map(len, postings.values()), np.float64, len(postings)))
+        columns.append(np.full(len(postings), column, np.int64))
+    if not ids:
+        return np.empty(0, np.int64), sparse.csr_matrix((0, len(terms)))
+    ids, columns, frequencies = np.concatenate(ids), np.concatenate(columns), np.concatenate(frequencies)
+    if doc_ids is not None:
+        keep = np.isin(ids, np.asarray(doc_ids, np.int64))
+        ids, columns, frequencies = ids[keep], columns[keep], frequencies[keep]
+    row_ids, rows = np.unique(ids, return_inverse=True)
+    return row_ids, sparse.csr_matrix((frequencies, (rows, columns)), shape=(len(row_ids), len(terms)))
+
+# Query vector weights for distinct query terms: (1 + log tf) * idf, normalized to unit length
+def query_weights(index, terms, counts):
+    n = len(index.doc_lengths)
+    weights = np.array([(1 + math.log(counts[term])) * math.log(1 + n / max(1, len(index.postings.get(term, ()))))
+                        for term in terms])
+    norm = np.linalg.norm(weights)
+    return weights / norm if norm else weights
+
+# Indices of the k largest scores, best first
+def top_k_indices(scores, k):
+    if k is not None and k < len(scores):
+        # argpartition finds the top k in linear time; only those k are sorted
+        best = np.argpartition(-scores, k - 1)[:k]
+    else:
+        best = np.arange(len(scores))
+    return best[np.argsort(-scores[best], kind='stable')]
+
+# Score candidate documents against the query terms by cosine similarity and return the best k as (score, doc_id)
+# doc_ids=None scores every document containing a query term
+def rerank(index, terms, k=None, doc_ids=None):
+    if not terms or not index.doc_lengths:
+        return []
+    counts = {}
+    for term in terms:
+        counts[term] = counts.get(term, 0) + 1
+    distinct = list(counts)
+    if np is None:
+        # Without NumPy, fall back to BM25 order over the same candidates
+        ranked = index.top_k(distinct)
+        if doc_ids is not None:
+            candidates = set(doc_ids)
+            ranked = [(score, doc_id) for score, doc_id in ranked if doc_id in candidates]
+        return ranked[:k]
+    row_ids, matrix = term_matrix(index, distinct, doc_ids)
+    if not len(row_ids):
+        return []
+    # Log-scale term frequencies in place, then score every candidate at once
+    matrix.data = 1 + np.log(matrix.data)
+    norms = np.fromiter(map(index.doc_norms.__getitem__, row_ids.tolist()), np.float64, len(row_ids))
+    scores = matrix.dot(query_weights(index, distinct, counts)) / norms
+    best = top_k_indices(scores, k)
+    return list(zip(scores[best].tolist(), row_ids[best].tolist()))
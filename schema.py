@@ -0,0 +1,279 @@
+import sys
+import time
+import hashlib
+import urllib.parse
+from fts_index import contentless_fts_schema, fts_triggers, fts_insert, fts_delete
+from doc_store import doc_store_schema, compaction_schema, upsert_location, get_doc_store
+from query_cache import create_generation_table
+from fingerprint import simhash, upsert_fingerprint, fingerprint_row
+
+# 64-bit key for a URL, stored as documents.url_hash
+def url_hash(url):
+    return int.from_bytes(hashlib.sha1(url.encode('utf-8')).digest()[:8], 'big', signed=True)
+
+# 64-bit hash of a page's extracted title and text, for telling whether a recrawled page changed
+def content_hash(title, text):
+    return url_hash((title or '') + '\n' + (text or ''))
+
+# Version 1: the original tables, created for fresh databases
+schema_v1 = [
+    '''CREATE TABLE IF NOT EXISTS searches (
+         id INTEGER PRIMARY KEY AUTOINCREMENT,
+         search_query TEXT,
+         search_engine TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS recent_searches (
+         id INTEGER PRIMARY KEY AUTOINCREMENT,
+         search_query TEXT,
+         search_id INTEGER REFERENCES searches (id))''',
+    '''CREATE TABLE IF NOT EXISTS search_results (
+         url TEXT NOT NULL,
+         id INTEGER PRIMARY KEY AUTOINCREMENT,
+         title TEXT,
+         description TEXT,
+         search_id INTEGER REFERENCES searches (id))''',
+]
+
+# Version 2: one row per unique page in documents, linked to searches through search_hits
+schema_v2 = [
+    '''CREATE TABLE documents (
+         id INTEGER PRIMARY KEY AUTOINCREMENT,
+         url_hash INTEGER NOT NULL UNIQUE,
+         url TEXT NOT NULL,
+         title TEXT,
+         description TEXT,
+         generation INTEGER NOT NULL DEFAULT 0)''',
+    '''CREATE TABLE search_hits (
+         search_id INTEGER NOT NULL REFERENCES searches (id),
+         doc_id INTEGER NOT NULL REFERENCES documents (id),
+         rank INTEGER,
+         PRIMARY KEY (search_id, doc_id))''',
+    'CREATE INDEX search_hits_doc_id ON search_hits (doc_id)',
+    'CREATE INDEX documents_generation ON documents (generation)',
+    'CREATE INDEX searches_search_query ON searches (search_query)',
+    'CREATE INDEX recent_searches_search_id ON recent_searches (search_id)',
+]
+
+# FTS5 table mirroring documents(title, description), kept in sync by triggers until version 5 replaces it
+fts_schema_v2 = [
+    '''CREATE VIRTUAL TABLE documents_fts
+       USING fts5(title, description, content='documents', content_rowid='id')''',
+    '''CREATE TRIGGER documents_fts_ai AFTER INSERT ON documents BEGIN
+         INSERT INTO documents_fts(rowid, title, description) VALUES (new.id, new.title, new.description);
+       END''',
+    '''CREATE TRIGGER documents_fts_ad AFTER DELETE ON documents BEGIN
+         INSERT INTO documents_fts(documents_fts, rowid, title, description) VALUES ('delete', old.id, old.title, old.description);
+       END''',
+    '''CREATE TRIGGER documents_fts_au AFTER UPDATE OF title, description ON documents BEGIN
+         INSERT INTO documents_fts(documents_fts, rowid, title, description) VALUES ('delete', old.id, old.title, old.description);
+         INSERT INTO documents_fts(rowid, title, description) VALUES (new.id, new.title, new.description);
+       END''',
+]
+
+# Insert a page or refresh the stored copy of it, keyed by URL hash
+upsert_document = '''INSERT INTO documents (url_hash, url, title, description, generation) VALUES (?, ?, ?, ?, ?)
+                     ON CONFLICT (url_hash) DO UPDATE SET title = excluded.title, description = excluded.description,
+                                                          generation = excluded.generation'''
+
+# Write (url_hash, url, title, text) documents at a generation, inside the caller's transaction
+# Text goes to the document store in full; the FTS index entries of rewritten documents are replaced
+def write_documents(cursor, store, rows, generation):
+    # One row per page, the last one winning
+    rows = list({row[0]: row for row in rows}.values())
+    hashes = [row[0] for row in rows]
+    old = []
+    for i in range(0, len(hashes), 500):
+        chunk = hashes[i:i + 500]
+        cursor.execute('SELECT id, title FROM documents WHERE url_hash IN (%s)' % ','.join('?' * len(chunk)), chunk)
+        old.extend(cursor.fetchall())
+    old_texts = store.get_many(cursor, [doc_id for doc_id, _ in old])
+    fts_delete(cursor, [(doc_id, title or '', old_texts.get(doc_id, '')) for doc_id, title in old])
+    cursor.executemany(upsert_document, [(document_hash, url, title, None, generation) for document_hash, url, title, _ in rows])
+    ids = {}
+    for i in range(0, len(hashes), 500):
+        chunk = hashes[i:i + 500]
+        cursor.execute('SELECT url_hash, id FROM documents WHERE url_hash IN (%s)' % ','.join('?' * len(chunk)), chunk)
+        ids.update(cursor.fetchall())
+    cursor.executemany(upsert_location, store.append((ids[row[0]], row[3]) for row in rows))
+    fts_insert(cursor, [(ids[document_hash], title or '', text or '') for document_hash, _, title, text in rows])
+
+# Link a search to a stored page by URL hash
+insert_search_hit = '''INSERT OR IGNORE INTO search_hits (search_id, doc_id, rank)
+                       SELECT ?, id, ? FROM documents WHERE url_hash = ?'''
+
+# Move search_results rows into documents/search_hits and drop the old table and its FTS index
+def migrate_v2(connection, cursor):
+    for statement in schema_v2:
+        cursor.execute(statement)
+    create_generation_table(cursor)
+    # Older code wrote the search id into search_results.id, so fall back to it when search_id is empty
+    cursor.execute('SELECT id, url, title, description, search_id FROM search_results ORDER BY id')
+    for row_id, url, title, description, search_id in cursor.fetchall():
+        cursor.execute('''INSERT INTO documents (url_hash, url, title, description) VALUES (?, ?, ?, ?)
+                          ON CONFLICT (url_hash) DO UPDATE SET title = excluded.title, description = excluded.description''',
+                       (url_hash(url), url, title, description))
+        cursor.execute('''INSERT OR IGNORE INTO search_hits (search_id, doc_id)
+                          SELECT searches.id, documents.id FROM searches, documents
+                          WHERE searches.id = ? AND documents.url_hash = ?''', (search_id or row_id, url_hash(url)))
+    for trigger in ('search_results_fts_ai', 'search_results_fts_ad', 'search_results_fts_au'):
+        cursor.execute('DROP TRIGGER IF EXISTS ' + trigger)
+    cursor.execute('DROP TABLE IF EXISTS search_results_fts')
+    cursor.execute('DROP TABLE search_results')
+    # Build the FTS index over the documents just copied; later rows are added by the triggers
+    for statement in fts_schema_v2:
+        cursor.execute(statement)
+    cursor.execute("INSERT INTO documents_fts(documents_fts) VALUES ('rebuild')")
+
+# Version 3: SimHash fingerprints with one indexed column per LSH band
+schema_v3 = [
+    '''CREATE TABLE document_fingerprints (
+         doc_id INTEGER PRIMARY KEY REFERENCES documents (id) ON DELETE CASCADE,
+         simhash INTEGER NOT NULL,
+         band0 INTEGER NOT NULL,
+         band1 INTEGER NOT NULL,
+         band2 INTEGER NOT NULL,
+         band3 INTEGER NOT NULL)''',
+    'CREATE INDEX document_fingerprints_band0 ON document_fingerprints (band0)',
+    'CREATE INDEX document_fingerprints_band1 ON document_fingerprints (band1)',
+    'CREATE INDEX document_fingerprints_band2 ON document_fingerprints (band2)',
+    'CREATE INDEX document_fingerprints_band3 ON document_fingerprints (band3)',
+]
+
+# Add the fingerprint table and fingerprint every stored document
+def migrate_v3(connection, cursor):
+    for statement in schema_v3:
+        cursor.execute(statement)
+    cursor.execute('SELECT url_hash, title, description FROM documents')
+    rows = []
+    for document_hash, title, description in cursor.fetchall():
+        fingerprint = simhash((title or '') + ' ' + (description or ''))
+        if fingerprint is not None:
+            rows.append(fingerprint_row(fingerprint, document_hash))
+    cursor.executemany(upsert_fingerprint, rows)
+
+# Version 4: the recrawl frontier (see recrawl.py) and the time each query was last crawled live
+schema_v4 = [
+    '''CREATE TABLE crawl_frontier (
+         url_hash INTEGER PRIMARY KEY,
+         url TEXT NOT NULL,
+         domain TEXT NOT NULL,
+         popularity INTEGER NOT NULL DEFAULT 0,
+         interval REAL NOT NULL,
+         next_crawl_at REAL NOT NULL,
+         last_crawled_at REAL,
+         content_hash INTEGER,
+         crawl_count INTEGER NOT NULL DEFAULT 0,
+         change_count INTEGER NOT NULL DEFAULT 0,
+         failures INTEGER NOT NULL DEFAULT 0)''',
+    'CREATE INDEX crawl_frontier_next_crawl_at ON crawl_frontier (next_crawl_at)',
+    '''CREATE TABLE crawled_queries (
+         search_query TEXT PRIMARY KEY,
+         crawled_at REAL NOT NULL)''',
+]
+
+# Seconds between recrawls of a page: new pages start at default_interval, which halves when a
+# recrawl finds the page changed and grows by half when it didn't, within these bounds
+min_interval = 3600
+default_interval = 86400
+max_interval = 30 * 86400
+
+# Seconds until the next recrawl for a page's interval, shortened for pages that searches keep returning
+def recrawl_delay(interval, popularity):
+    return max(min_interval, interval / (1 + popularity))
+
+# Add a stored page to the frontier, or count another search hit for it
+# Parameters come from frontier_row
+upsert_frontier = '''INSERT INTO crawl_frontier (url_hash, url, domain, popularity, interval, next_crawl_at, last_crawled_at, content_hash, crawl_count)
+                     VALUES (?, ?, ?, 1, ?, ?, ?, ?, 1)
+                     ON CONFLICT (url_hash) DO UPDATE SET popularity = popularity + 1, last_crawled_at = excluded.last_crawled_at,
+                                                          content_hash = excluded.content_hash, crawl_count = crawl_count + 1,
+                                                          next_crawl_at = excluded.last_crawled_at + max(?, interval / (popularity + 2))'''
+
+# Parameters for upsert_frontier for a page crawled at time now
+def frontier_row(url, title, text, now):
+    return (url_hash(url), url, urllib.parse.urlparse(url).netloc.lower(), default_interval,
+            now + recrawl_delay(default_interval, 1), now, content_hash(title, text), min_interval)
+
+# Add the frontier tables and seed the frontier with every stored page, due now, most searched first
+def migrate_v4(connection, cursor):
+    for statement in schema_v4:
+        cursor.execute(statement)
+    cursor.execute('''SELECT documents.url_hash, documents.url, documents.title, documents.description, COUNT(search_hits.search_id)
+                      FROM documents LEFT JOIN search_hits ON search_hits.doc_id = documents.id GROUP BY documents.id''')
+    now = time.time()
+    rows = [(document_hash, url, urllib.parse.urlparse(url).netloc.lower(), popularity, default_interval,
+             now - popularity, content_hash(title, description))
+            for document_hash, url, title, description, popularity in cursor.fetchall()]
+    cursor.executemany('''INSERT INTO crawl_frontier (url_hash, url, domain, popularity, interval, next_crawl_at, content_hash)
+                          VALUES (?, ?, ?, ?, ?, ?, ?)''', rows)
+
+# Version 5: document text moves to the compressed document store and the FTS index becomes contentless
+def migrate_v5(connection, cursor):
+    for statement in doc_store_schema:
+        cursor.execute(statement)
+    db_file = cursor.execute('PRAGMA database_list').fetchone()[2]
+    store = get_doc_store(db_file, cursor)
+    cursor.execute('SELECT id, title, description FROM documents ORDER BY id')
+    rows = cursor.fetchall()
+    cursor.executemany(upsert_location, store.append((doc_id, description) for doc_id, _, description in rows))
+    for trigger in fts_triggers:
+        cursor.execute('DROP TRIGGER IF EXISTS ' + trigger)
+    cursor.execute('DROP TABLE IF EXISTS documents_fts')
+    for statement in contentless_fts_schema:
+        cursor.execute(statement)
+    fts_insert(cursor, [(doc_id, title or '', description or '') for doc_id, title, description in rows])
+    cursor.execute('UPDATE documents SET description = NULL')
+
+# Version 6: how far bulk ingestion (see ingest.py) got through each source; committed with the documents
+# themselves, so an interrupted run resumes after the last batch that was written
+schema_v6 = [
+    '''CREATE TABLE ingest_checkpoints (
+         source TEXT PRIMARY KEY,
+         position INTEGER NOT NULL,
+         documents INTEGER NOT NULL,
+         updated_at REAL NOT NULL)''',
+]
+
+# Version 7: the document store's compaction counter (see doc_store.compact)
+schema_v7 = compaction_schema
+
+# Ordered migrations: (version, list of statements or function(connection, cursor))
+migrations = [(1, schema_v1), (2, migrate_v2), (3, migrate_v3), (4, migrate_v4), (5, migrate_v5), (6, schema_v6), (7, schema_v7)]
+
+# Migrations that free enough space for a VACUUM afterwards to be worth it
+vacuum_after = {5}
+
+# Latest schema version
+schema_version = migrations[-1][0]
+
+# Bring a database up to the latest schema version, one migration per transaction
+def migrate(connection):
+    cursor = connection.cursor()
+    version = cursor.execute('PRAGMA user_version').fetchone()[0]
+    for target, step in migrations:
+        if target <= version:
+            continue
+        with connection:
+            # Explicit BEGIN so the DDL is part of the transaction too; IMMEDIATE takes the write
+            # lock up front, then the version is re-read in case another process just migrated
+            cursor.execute('BEGIN IMMEDIATE')
+            if cursor.execute('PRAGMA user_version').fetchone()[0] >= target:
+                continue
+            if callable(step):
+                step(connection, cursor)
+            else:
+                for statement in step:
+                    cursor.execute(statement)
+            cursor.execute('PRAGMA user_version = %d' % target)
+    # VACUUM can't run inside a transaction, so it follows the migrations
+    if any(version < target <= schema_version for target in vacuum_after):
+        cursor.execute('VACUUM')
+    cursor.close()
+    return version
+
+# Migrate a database file from the command line: python schema.py [db_file]
+if __name__ == '__main__':
+    from database import connect
+    db_file = sys.argv[1] if len(sys.argv) > 1 else 'custom_search_engine.db'
+    connection = connect(db_file)
+    print('%s is at schema version %d' % (db_file, connection.execute('PRAGMA user_version').fetchone()[0]))
+    connection.close()
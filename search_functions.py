@@ -1,103 +1,71 @@
-import requests
 from bs4 import BeautifulSoup
-import sqlite3
+from database import connect
+from schema import url_hash, write_documents, insert_search_hit, upsert_frontier, frontier_row
+from doc_store import get_doc_store
+from fingerprint import simhash, find_near_duplicate, NearDuplicateFilter, upsert_fingerprint, fingerprint_row
+from fetcher import Fetcher
+from extraction import get_raw_text, get_extraction_pool
+from page_cache import get_page_cache
+from browser_pool import get_browser_pool
+from query_cache import bump_generation
+from metrics import span, record_span, count
+from engines import engine_results, serp_headers
 import aiohttp
 import asyncio
 import async_timeout
 import urllib.parse
-import sys
+import threading
+import functools
+import time
 import copy 
-from functools import reduce 
-
-# Define search engines and block lists
-search_engines = {'Google': 'https://www.google.com/search?q=',
-                  'DuckDuckGo': 'https://duckduckgo.com/html/?q=',
-                  'Bing': 'https://www.bing.com/search?q=',
-                  'Yahoo': 'https://search.yahoo.com/search?p=',
-                  'Yandex': 'https://yandex.com/search/?text='}
-js_engines = ['DuckDuckGo']  # Engines that require JavaScript rendering
-block_list = ['cdn-cgi', '/cdn-cgi/', 'javascript:', '#', '.pdf', '.doc', '.docx', '.ppt', '.pptx', '.xls', '.xlsx', '.svg', '.jpg', '.jpeg', '.png', '.gif']
-ad_block_list = ['ad', 'ads', 'banner', 'popup', 'doubleclick']  # Common ad-related terms to block
-
-# Special logic for JavaScript handling in DuckDuckGo
+
+# Render a page that needs JavaScript in a pooled browser and parse it
+# Raises RuntimeError when the browser fails (Safari's driver is used by default, see browser_pool.py)
 def get_js_soup(url):
-    # Import selenium only for search engines that load URLs via JavaScript
-    import selenium
-    from selenium import webdriver
-    try: 
-        # Define browser using Safari driver 
-        browser = webdriver.Safari()
-        # Request URL
-        browser.get(url)
-        # Get HTML from webpage
-        soup = BeautifulSoup(browser.page_source, 'html.parser')
-        # Quit browser 
-        browser.quit()
-        return soup
-    except selenium.common.exceptions.WebDriverException:
-        print('\nWebdriver Exception. Search engine option compatible with Safari only.\n')
-        sys.exit(1) 
-
-# Filter function to clean up URL scrape results 
-def filter_function(url, block_list, ad_block_list):
-    # Check for "http"
-    if 'http' not in url: 
-        return False
-    # Check if included in block_list and ad_block_list
-    elif any(blocked in url for blocked in block_list) or any(blocked in url for blocked in ad_block_list):
-        return False
-    else:
-        return True
-    
-# Additional data transformations for Google searches 
-def google_transformer(url):
-    return url.split('&sa=')[0]
-
-# Function for finding URLs resulted from search, with associated HTML clean up and filtering 
-# Return list of cleaned up URL 
-def urls(soup, engine):
-    # Find <a> tags used for links, where tags have href attribute from soup object
-    all_href = map(lambda x: x.get('href'), soup.find_all('a', href=True))
-    # Filter to URL links 
-    url = filter(lambda x: filter_function(x, block_list, ad_block_list), all_href)
-    # Additional filter for Google searches
-    if engine == 'Google':
-        url = map(google_transformer, url)
-    # Return cleaned up list of URLs 
-    return list(map(str, map(lambda x: x.strip('/url?q='), url)))
-
-# Remove duplicate domains from scraped URLs
+    return BeautifulSoup(get_browser_pool().render(url), 'html.parser')
+
+# Remove duplicate URLs from scraped URLs
+# Distinct pages on the same domain are kept; duplicate content is collapsed by fingerprint at insert time
 def remove_dup(urls):
-    # Dictionary to hold domain key and URL value 
+    # Dictionary to hold normalized URL key and URL value 
     new_urls = {}
-    # For each URL, check if domain is in dictionary 
+    # For each URL, check if the page (ignoring fragment and trailing slash) is in dictionary 
     for url in urls:
         parts = urllib.parse.urlparse(url)
-        if parts.netloc not in new_urls:
-            # Add domain and URL into dictionary 
-            new_urls[parts.netloc] = url
+        key = (parts.netloc.lower(), parts.path.rstrip('/'), parts.params, parts.query)
+        if key not in new_urls:
+            # Add page and URL into dictionary 
+            new_urls[key] = url
     # Return filtered URLs as a list 
     return list(new_urls.values())
 
-# Get raw text from HTML resulting from engine scrape and get first title object in HTML
-def get_raw_text(text):
-    soup = BeautifulSoup(text, 'html.parser')
-    try: 
-        title = soup.title.get_text()
-    except AttributeError:
-        title = "N/A"
-    for script in soup(['script', 'style', 'template', 'TemplateString', 'ProcessingInstruction', 'Declaration', 'Doctype']):
-        script.extract()
-    text = [item.text.strip().replace(u'\xa0', u' ') for item in soup.find_all('p')]
-    return reduce(lambda x, y: x + ' ' + y, text, ''), title 
-
-# Async function to get HTML from URL 
-async def get_html(session, url):
-    # Get HTML text from session object 
+# Async function to get HTML from URL through the on-disk page cache
+# Fresh copies are served without a request; stale ones are revalidated with If-None-Match/If-Modified-Since
+# Cache reads and writes (SQLite and zlib) run on the loop's default executor, so they don't hold up other fetches
+async def get_html_cached(session, url, cache):
+    loop = asyncio.get_running_loop()
+    cached = await loop.run_in_executor(None, cache.get, url)
+    if cached is not None:
+        html, etag, last_modified, fresh = cached
+        if fresh:
+            count('page_cache_total', outcome='hit')
+            return html, url
+        headers = cache.conditional_headers(etag, last_modified)
+    else:
+        headers = {}
     try:
         async with async_timeout.timeout(10):
-            async with session.get(url) as response:
-                return await response.text(), url
+            async with session.get(url, headers=headers) as response:
+                # Not modified: reuse the cached body and whatever was extracted from it
+                if response.status == 304 and cached is not None:
+                    count('page_cache_total', outcome='revalidated')
+                    await loop.run_in_executor(None, cache.touch, url)
+                    return html, url
+                text = await response.text()
+                count('page_cache_total', outcome='miss')
+                if response.status == 200:
+                    await loop.run_in_executor(None, cache.put, url, text, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+                return text, url
     # If timeout, return "TimeoutError" and URL as tuple 
     except asyncio.exceptions.TimeoutError:
         return "Error: Timeout", url
@@ -111,32 +79,28 @@ async def get_html(session, url):
         return 'Error: UnicodeDecodeError', url
     except aiohttp.client_exceptions.ClientConnectorError:
         return 'Error: ClientConnectorError', url
-    
-# Define tasks for the URLs 
-async def get_all(session, urls):
-    tasks = []
-    # For each URL, create a task to get HTML for the defined session object and URL 
-    for url in urls:
-        task = asyncio.create_task(get_html(session, url))
-        tasks.append(task)
-    # Return all the tasks 
-    results = await asyncio.gather(*tasks)
-    return results 
-
-# Define function to call async functions 
-async def async_main(urls):
-    # Context manager for aiohttp session object 
-    async with aiohttp.ClientSession() as session:
-        # Get data obtained from get_all with defined session object and URLs 
-        data = await get_all(session, urls)
-        # Return list of data, where each element is a tuple containing HTML, URL 
-        return data
+
+# Shared fetcher, created on first use and reused by every crawl in the process
+fetcher = None
+fetcher_lock = threading.Lock()
+
+# Get the shared fetcher; limits only apply when it is first created
+def get_fetcher(max_connections=50, per_domain=4):
+    global fetcher
+    with fetcher_lock:
+        if fetcher is None:
+            fetch_page = functools.partial(get_html_cached, cache=get_page_cache())
+            # Every request goes out with the user agent recrawl.py checks robots.txt rules for
+            fetcher = Fetcher(fetch_page, max_connections=max_connections, per_domain=per_domain, headers=serp_headers)
+    return fetcher
 
 # Function for executing SQL queries
-def sql_execute(cursor, query, input, get_lastrowid=False):
+def sql_execute(cursor, query, input, get_lastrowid=False, fetchone=False):
     cursor.execute(query, input)
     if get_lastrowid: 
         return cursor.lastrowid
+    if fetchone:
+        return cursor.fetchone()
 
 # Data filter to ensure content going into database is clean 
 def data_filter(query, title, text):
@@ -160,54 +124,100 @@ def data_filter(query, title, text):
     else:
         return False 
 
-def populate_database(input_query, engine):
-    if engine not in js_engines:
-        # Request HTML from web search
-        r = requests.get(search_engines[engine] + input_query, headers={'user-agent': 'my-app/0.0.1'})
-        # Create BeautifulSoup object 
-        soup = BeautifulSoup(r.text, 'html.parser')
-    else:
-        # Use special handling for JavaScript 
-        soup = get_js_soup(search_engines[engine] + input_query)
-
-    # Get scraped URLs, while removing duplicate domains 
-    url_list = remove_dup(urls(soup, engine))
+# Set verbose=True to print every inserted row
+def populate_database(input_query, engine, db_file='custom_search_engine.db', verbose=False):
+    # Get scraped URLs from the engine's results page (or the results page cache), while removing duplicate pages
+    url_list = remove_dup(get_fetcher().run(engine_results(get_fetcher(), input_query, engine)))
 
     # Asynchronously get HTML text from URLs obtained via search engine scrape
-    text_url = asyncio.run(async_main(url_list))
-
-    # Return cleaned up text as a tuple with the URL
-    cleaned_text_url = map(lambda x: (get_raw_text(x[0]), x[1]), text_url)
-
-    # Opening connection to SQLite database
-    connection = sqlite3.connect('custom_search_engine.db')
-    # Creating cursor handler for inserting data 
-    cursor = connection.cursor()
-
-    # Query for adding search info
-    last_search_id = sql_execute(cursor, 'INSERT INTO searches (search_query, search_engine) VALUES (?, ?)', (input_query, engine), get_lastrowid=True)
-
-    # Inserting URL info
+    # Pages are yielded as they complete, so parsing and inserting start on the first response
+    text_url = get_fetcher().iter_fetch(url_list)
+
+    # Extract, filter and store the fetched pages, keeping their results page order
+    store_pages(input_query, engine, text_url, db_file, verbose, ranks={url: rank for rank, url in enumerate(url_list)})
+
+# Extract text from fetched (html, url) pages on the extraction pool and filter it for a query
+# Returns (url, title, text, fingerprint) rows ready to store; set verbose=True to print every row
+def extract_pages(input_query, text_url, verbose=False):
+    # Return cleaned up text as a tuple with the URL, parsed on the extraction process pool
+    extraction_pool = get_extraction_pool()
+    # Pages whose cached copy was already extracted skip the pool
+    cleaned_text_url = extraction_pool.extract(text_url, cache=get_page_cache())
+
+    # Collect rows to insert, filtering as pages finish extraction
+    # Pages are extracted as they arrive, so the extract stage includes waiting on fetches
+    rows = []
+    extract_start = time.perf_counter()
+    filter_seconds = 0.0
     for text_title, url in cleaned_text_url:
         # Unpack text_title 
         text, title = text_title
         # Additional filtering 
-        if data_filter(input_query, title, text):
+        filter_start = time.perf_counter()
+        filtered = data_filter(input_query, title, text)
+        filter_seconds += time.perf_counter() - filter_start
+        if filtered:
             continue
-        print("\nInserting URL info into 'search_results' table:")
-        print("URL:", url)
-        print("Last Search ID:", last_search_id)
-        print("Title:", title)
-        print("Description:", text)
-        # Restricting size of text for database constraint
-        if len(text) > 60000:
-            text = text[:60000]
-        # Execute query to add info to search engine tables
-        sql_execute(cursor, 'INSERT INTO search_results (url, id, title, description) VALUES (?, ?, ?, ?)', (url, last_search_id, title, text))
-            
-    # Commit data to database 
-    connection.commit()
+        if verbose:
+            print("\nInserting URL info into 'documents' table:")
+            print("URL:", url)
+            print("Title:", title)
+            print("Description:", text)
+        # Fingerprint outside the write transaction
+        rows.append((url, title, text, simhash(title + ' ' + text)))
+    record_span('extract', time.perf_counter() - extract_start - filter_seconds)
+    record_span('data_filter', filter_seconds)
+    # Report extraction throughput for sizing the pool
+    print('Extraction: %.1f pages/sec overall, %.1f pages/sec per worker (%d workers)' % (extraction_pool.pages_per_second(), extraction_pool.worker_pages_per_second(), extraction_pool.workers))
+    return rows
+
+# Extract text from fetched (html, url) pages and write them for a search in one transaction
+# ranks maps URL -> position on the engine's results page; set verbose=True to print every inserted row
+def store_pages(input_query, engine, text_url, db_file='custom_search_engine.db', verbose=False, ranks=None):
+    rows = extract_pages(input_query, text_url, verbose)
+
+    # Opening connection to SQLite database (WAL journaling, schema migrated on first connect, see database.py)
+    connection = connect(db_file)
+    # Creating cursor handler for inserting data 
+    cursor = connection.cursor()
+
+    # Write the search and all of its results in a single transaction
+    with span('store'), connection:
+        # Query for adding search info
+        last_search_id = sql_execute(cursor, 'INSERT INTO searches (search_query, search_engine) VALUES (?, ?)', (input_query, engine), get_lastrowid=True)
+        sql_execute(cursor, 'INSERT INTO recent_searches (search_query, search_id) VALUES (?, ?)', (input_query, last_search_id))
+        # Invalidate cached query results; rows written now are tagged with the new generation
+        generation = bump_generation(cursor)
+        ranks = ranks or {row[0]: rank for rank, row in enumerate(rows)}
+        # Collapse near-duplicate pages: a page whose content matches a stored document or an earlier
+        # page in this batch is linked to that document instead of being stored again
+        documents, fingerprints, hits, frontier = [], [], [], []
+        now = time.time()
+        batch_filter = NearDuplicateFilter()
+        for url, title, text, fingerprint in rows:
+            document_hash = url_hash(url)
+            canonical_hash = None
+            if fingerprint is not None:
+                # A URL that is already stored is refreshed in place rather than collapsed
+                if sql_execute(cursor, 'SELECT 1 FROM documents WHERE url_hash = ?', (document_hash,), fetchone=True) is None:
+                    canonical_hash = batch_filter.find(fingerprint) or find_near_duplicate(cursor, fingerprint)
+                if canonical_hash is None:
+                    batch_filter.add(fingerprint, document_hash)
+                    fingerprints.append(fingerprint_row(fingerprint, document_hash))
+            if canonical_hash is None:
+                documents.append((document_hash, url, title, text))
+                frontier.append(frontier_row(url, title, text, now))
+            elif verbose:
+                print("Near-duplicate collapsed:", url)
+            hits.append((last_search_id, ranks.get(url), document_hash if canonical_hash is None else canonical_hash))
+        # Upsert each page once, then link it to this search
+        write_documents(cursor, get_doc_store(db_file, cursor), documents, generation)
+        cursor.executemany(upsert_fingerprint, fingerprints)
+        cursor.executemany(insert_search_hit, hits)
+        # Schedule stored pages for background recrawls (see recrawl.py)
+        cursor.executemany(upsert_frontier, frontier)
+    count('documents_stored_total', len(documents))
 
     # Closing cursor and connection 
     cursor.close()
-    connection.close()
\ No newline at end of file
+    connection.close()
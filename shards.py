@@ -0,0 +1,242 @@
+import os
+import sys
+import heapq
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from database import connect
+from schema import write_documents
+from doc_store import get_doc_store
+from inverted_index import get_index, start_index, tokenize
+from fingerprint import NearDuplicateFilter, load_fingerprints, upsert_fingerprint, fingerprint_row
+from query_analyzer import get_analyzer
+from query_cache import query_cache, bump_generation
+from data_processing import load_titles, format_index_results, format_fts_results
+from fts_index import fts_scores
+from metrics import span, count
+
+# Sharded search: documents are split by URL hash across shard databases, each with its own document
+# store, and every shard is served by its own worker process that keeps the shard's inverted index in memory.
+# A query is scattered to all shards in three rounds:
+#   stats  each shard reports its document count, total length and the query terms' document frequencies;
+#          the sums are the global BM25 statistics, so a document scores the same as in one big index
+#   query  each shard scores its postings with the global statistics and returns its best candidates
+#   fetch  after merging by score and collapsing near-duplicates across shards, only the shards holding
+#          the requested page read titles and text and build snippets
+# Shards are filled with `python ingest.py --shards N` or split from an existing database with
+# `python shards.py split`.
+# A shard with more than INDEX_MAX_DOCUMENTS documents has no in-memory index. While any shard is in that
+# state, every shard ranks with FTS5 and bm25() instead, as data_processing.search_documents does for a
+# single database. bm25() only knows its own shard's statistics, but shards split by URL hash are random
+# samples of the collection, so their statistics, and the scores, stay close.
+
+# Paths of the shard databases for a database file split count ways
+def shard_files(db_file, count):
+    base = os.path.splitext(db_file)[0]
+    return ['%s.shard%dof%d.db' % (base, shard, count) for shard in range(count)]
+
+# Shard a document belongs to, by its URL hash
+def shard_of(document_hash, count):
+    return document_hash % count
+
+# Shard worker functions; each runs in the shard's own process, where get_index keeps its index
+
+# A shard's index, waiting for it to be built; None when the shard is too big to index
+def shard_index(db_file, cursor):
+    return get_index(db_file, cursor)
+
+# Start building a shard's index in the background, so it is ready by the first query
+def shard_start(db_file):
+    start_index(db_file)
+
+# Global BM25 statistics contributed by a shard for query terms (see InvertedIndex.term_stats)
+# None when the shard has no index, so the query is answered with FTS5
+def shard_stats(db_file, terms):
+    connection = connect(db_file)
+    cursor = connection.cursor()
+    index = shard_index(db_file, cursor)
+    stats = None
+    if index is not None:
+        with index.reading():
+            stats = index.term_stats(terms)
+    cursor.close()
+    connection.close()
+    return stats
+
+# A shard's best depth documents scored with global statistics, as (score, doc_id, fingerprint), best first
+# stats=None ranks with FTS5 and bm25() instead, over the shard's own statistics
+def shard_query(db_file, terms, depth, stats, collapse):
+    connection = connect(db_file)
+    cursor = connection.cursor()
+    index = shard_index(db_file, cursor) if stats is not None else None
+    if index is not None:
+        with index.reading():
+            ranked = index.top_k(terms, depth, stats)
+    else:
+        ranked = fts_scores(cursor, terms, depth)
+    fingerprints = load_fingerprints(cursor, [doc_id for _, doc_id in ranked]) if collapse else {}
+    cursor.close()
+    connection.close()
+    return [(score, doc_id, fingerprints.get(doc_id)) for score, doc_id in ranked]
+
+# Formatted results for some of a shard's documents, as {doc_id: (url, title, description, keyword_counts, total)}
+# indexed=False formats them as FTS5 results, without the index's postings
+def shard_fetch(db_file, query_keywords, terms, ids, snippets, indexed=True):
+    connection = connect(db_file)
+    cursor = connection.cursor()
+    store = get_doc_store(db_file, cursor)
+    index = shard_index(db_file, cursor) if indexed else None
+    rows = load_titles(cursor, ids)
+    ids = [doc_id for doc_id in ids if doc_id in rows]
+    if index is not None:
+        with index.reading():
+            results = format_index_results(cursor, store, index, ids, rows, query_keywords, terms, snippets)
+    else:
+        results = format_fts_results(cursor, store, [(doc_id,) + rows[doc_id] for doc_id in ids], query_keywords, terms, snippets)
+    cursor.close()
+    connection.close()
+    return dict(zip(ids, results))
+
+# Coordinator for a set of shards
+class ShardedIndex:
+    def __init__(self, db_file, count):
+        self.db_files = shard_files(db_file, count)
+        # One single-process pool per shard, so each shard's index is loaded in exactly one process
+        self.pools = [ProcessPoolExecutor(1) for _ in self.db_files]
+        for pool, db_file in zip(self.pools, self.db_files):
+            pool.submit(shard_start, db_file)
+
+    # Run fn(shard db_file, *args) on every shard at once and return the results in shard order
+    def scatter(self, fn, *args):
+        futures = [pool.submit(fn, db_file, *args) for pool, db_file in zip(self.pools, self.db_files)]
+        return [future.result() for future in futures]
+
+    # Search every shard; takes the arguments of data_processing.search_documents (index backend) and
+    # returns results in the same (url, title, description, keyword_counts, total) layout
+    def search(self, query, k=None, snippets=False, analyzer=None, use_cache=True, collapse=True, offset=0):
+        query_keywords = (analyzer or get_analyzer()).analyze(query)
+
+        # Serve repeated queries from the query cache
+        if use_cache:
+            key = (tuple(self.db_files), k, offset, snippets, collapse, tuple(query_keywords))
+            # Shard generations only grow, so their sum changes whenever any shard is written
+            generation = sum(query_cache.generation(db_file) for db_file in self.db_files)
+            cached = query_cache.get(key, generation)
+            if cached is not None:
+                count('searches_total', backend='sharded', cached='true')
+                return cached
+            formatted_results = self.search(query, k, snippets, analyzer, use_cache=False, collapse=collapse, offset=offset)
+            query_cache.put(key, generation, formatted_results)
+            return formatted_results
+
+        count('searches_total', backend='sharded', cached='false')
+        with span('search', backend='sharded'):
+            return self.rank(query_keywords, k, snippets, collapse, offset)
+
+    # Scatter a query over the shards and gather one ranked page of results; see the top of the file
+    def rank(self, query_keywords, k, snippets, collapse, offset=0):
+        terms = tokenize(' '.join(query_keywords))
+        if not terms:
+            return []
+        shard_statistics = self.scatter(shard_stats, terms)
+        # Shards too big to index leave the whole query to FTS5, so every score comes from the same ranking
+        indexed = None not in shard_statistics
+        stats = None
+        if indexed:
+            stats = (sum(documents for documents, _, _ in shard_statistics),
+                     sum(length for _, length, _ in shard_statistics),
+                     {term: sum(frequencies[term] for _, _, frequencies in shard_statistics) for term in set(terms)})
+            if not stats[0]:
+                return []
+
+        # Each shard returns enough candidates to fill the page on its own, with extra when collapsing
+        depth = offset + k if k is not None else None
+        candidates = depth * 2 if collapse and depth is not None else depth
+        ranked = heapq.merge(*[[(score, shard, doc_id, fingerprint) for score, doc_id, fingerprint in hits]
+                               for shard, hits in enumerate(self.scatter(shard_query, terms, candidates, stats, collapse))],
+                             reverse=True)
+        # Keep results in score order, skipping near-duplicates of a higher-ranked result on any shard
+        duplicate_filter = NearDuplicateFilter()
+        kept = [(shard, doc_id) for _, shard, doc_id, fingerprint in ranked
+                if duplicate_filter.check(fingerprint, (shard, doc_id)) is None][offset:depth]
+
+        # Read the page's results from the shards that hold them
+        by_shard = {}
+        for shard, doc_id in kept:
+            by_shard.setdefault(shard, []).append(doc_id)
+        futures = {shard: self.pools[shard].submit(shard_fetch, self.db_files[shard], query_keywords, terms, ids, snippets, indexed)
+                   for shard, ids in by_shard.items()}
+        fetched = {shard: future.result() for shard, future in futures.items()}
+        return [fetched[shard][doc_id] for shard, doc_id in kept if doc_id in fetched[shard]]
+
+    # Shut down the shard processes
+    def close(self):
+        for pool in self.pools:
+            pool.shutdown()
+
+# One coordinator per database file and shard count, shared by every search in the process
+sharded_indexes = {}
+sharded_indexes_lock = threading.Lock()
+
+# Get the coordinator for a database file split count ways
+def get_sharded_index(db_file, count):
+    key = (os.path.abspath(db_file), count)
+    with sharded_indexes_lock:
+        sharded_index = sharded_indexes.get(key)
+        if sharded_index is None:
+            sharded_index = sharded_indexes[key] = ShardedIndex(db_file, count)
+    return sharded_index
+
+# Copy every document of a database into count shards, batch documents at a time per transaction
+# Returns the number of documents copied
+def split_database(db_file, count, batch=5000):
+    connection = connect(db_file)
+    cursor = connection.cursor()
+    store = get_doc_store(db_file, cursor)
+    shards = []
+    for shard_file in shard_files(db_file, count):
+        shard_connection = connect(shard_file)
+        shards.append((shard_connection, get_doc_store(shard_file, shard_connection.cursor())))
+    copied, last_id = 0, 0
+    while True:
+        cursor.execute('''SELECT documents.id, documents.url_hash, documents.url, documents.title, document_fingerprints.simhash
+                          FROM documents LEFT JOIN document_fingerprints ON document_fingerprints.doc_id = documents.id
+                          WHERE documents.id > ? ORDER BY documents.id LIMIT ?''', (last_id, batch))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        texts = store.get_many(cursor, [row[0] for row in rows])
+        for shard, (shard_connection, shard_store) in enumerate(shards):
+            shard_rows = [row for row in rows if shard_of(row[1], count) == shard]
+            if not shard_rows:
+                continue
+            shard_cursor = shard_connection.cursor()
+            with shard_connection:
+                generation = bump_generation(shard_cursor)
+                write_documents(shard_cursor, shard_store, [(document_hash, url, title, texts.get(doc_id, ''))
+                                                            for doc_id, document_hash, url, title, _ in shard_rows], generation)
+                shard_cursor.executemany(upsert_fingerprint, [fingerprint_row(fingerprint, document_hash)
+                                                              for _, document_hash, _, _, fingerprint in shard_rows if fingerprint is not None])
+            shard_cursor.close()
+        copied += len(rows)
+        print('Copied %d documents' % copied)
+    for shard_connection, _ in shards:
+        shard_connection.close()
+    cursor.close()
+    connection.close()
+    return copied
+
+# python shards.py split [db_file] count, or python shards.py search [db_file] count query
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] not in ('split', 'search'):
+        sys.exit('Usage: python shards.py split|search [db_file] count [query]')
+    command, args = sys.argv[1], sys.argv[2:]
+    db_file = args.pop(0) if not args[0].isdigit() else 'custom_search_engine.db'
+    shard_count = int(args.pop(0))
+    if command == 'split':
+        split_database(db_file, shard_count)
+    elif command == 'search':
+        sharded_index = ShardedIndex(db_file, shard_count)
+        for url, title, _, _, total in sharded_index.search(' '.join(args), k=10, use_cache=False):
+            print('%3d  %s  %s' % (total, url, title))
+        sharded_index.close()
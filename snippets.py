@@ -0,0 +1,93 @@
+import re
+import html
+import itertools
+from tokenizer import token_pattern
+
+# Words in each snippet window, and the most windows joined into one snippet
+window_size = 30
+max_windows = 2
+
+# Find (position, term) matches of query terms by scanning a text's words
+# Used when no index positions are available, e.g. for FTS results
+def find_matches(text, terms):
+    terms = set(terms)
+    return [(position, match.group().lower()) for position, match in enumerate(token_pattern.finditer(text))
+            if match.group().lower() in terms]
+
+# Pick up to count windows of size words covering the most distinct query terms,
+# then the most matches; matches are (position, term) sorted by position
+# Returns sorted (start, end) word ranges, with overlapping windows merged
+def best_windows(matches, count=max_windows, size=window_size):
+    windows = []
+    for _ in range(count):
+        remaining = [match for match in matches if not any(start <= match[0] < end for start, end in windows)]
+        if not remaining:
+            break
+        # Slide over the matches, keeping per-term counts for the matches within size words of each other
+        best, first, in_window = None, 0, {}
+        for last, (position, term) in enumerate(remaining):
+            in_window[term] = in_window.get(term, 0) + 1
+            while position - remaining[first][0] >= size:
+                dropped = remaining[first][1]
+                in_window[dropped] -= 1
+                if not in_window[dropped]:
+                    del in_window[dropped]
+                first += 1
+            score = (len(in_window), last - first + 1)
+            if best is None or score > best[0]:
+                best = (score, remaining[first][0], position)
+        # Centre the window on its matches
+        _, low, high = best
+        start = max(0, low - (size - (high - low)) // 2)
+        windows.append((start, start + size))
+    merged = []
+    for start, end in sorted(windows):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+# Build an HTML snippet of text around the query terms, with matches in <mark></mark>
+# matches are (position, term) word positions from the inverted index; without them the text is scanned
+# Only the words up to the end of the last window are tokenized, and everything but the marks is escaped
+def build_snippet(text, terms, matches=None, size=window_size, count=max_windows):
+    if not text:
+        return ''
+    if matches is None:
+        matches = find_matches(text, terms)
+    matches = sorted(matches)
+    windows = best_windows(matches, count, size) or [(0, size)]
+    terms = set(terms)
+    highlighted = set(position for position, _ in matches)
+    words = list(itertools.islice(token_pattern.finditer(text), windows[-1][1] + 1))
+    pieces = []
+    for start, end in windows:
+        window = words[start:end]
+        if not window:
+            continue
+        cursor = window[0].start()
+        piece = []
+        for position, word in enumerate(window, start):
+            piece.append(html.escape(text[cursor:word.start()]))
+            if position in highlighted and word.group().lower() in terms:
+                piece.append('<mark>' + html.escape(word.group()) + '</mark>')
+            else:
+                piece.append(html.escape(word.group()))
+            cursor = word.end()
+        pieces.append(''.join(piece))
+    # Ellipses wherever the windows cut the text
+    snippet = ' &hellip; '.join(pieces)
+    if windows[0][0] > 0:
+        snippet = '&hellip; ' + snippet
+    if windows[-1][1] < len(words):
+        snippet += ' &hellip;'
+    return snippet
+
+# Highlight marks in a snippet built by build_snippet
+mark_pattern = re.compile(r'<mark>(.*?)</mark>')
+
+# Split a snippet into [text, highlighted] pairs of plain text, for clients that build the markup themselves
+def snippet_segments(snippet):
+    parts = mark_pattern.split(snippet)
+    return [[html.unescape(part), i % 2 == 1] for i, part in enumerate(parts) if part]
@@ -0,0 +1,34 @@
+import os
+import sys
+
+# Tests import the search engine modules from the repository root, the legacy scraper's modules from Search Engine/
+# and the recorded engine pages from benchmarks/
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_root)
+sys.path.insert(0, os.path.join(repo_root, 'Search Engine'))
+sys.path.insert(0, os.path.join(repo_root, 'benchmarks'))
+
+import pytest
+from database import connect
+from schema import url_hash, write_documents
+from doc_store import get_doc_store
+from query_cache import bump_generation
+
+# Path of a fresh database file; its schema is created on first connect
+@pytest.fixture
+def db_file(tmp_path):
+    return str(tmp_path / 'search.db')
+
+# Write (url, title, text) pages to a database through the normal write path, under a new generation
+def store(db_file, pages):
+    connection = connect(db_file)
+    cursor = connection.cursor()
+    with connection:
+        generation = bump_generation(cursor)
+        write_documents(cursor, get_doc_store(db_file, cursor), [(url_hash(url), url, title, text) for url, title, text in pages], generation)
+    cursor.close()
+    connection.close()
+
+@pytest.fixture
+def write_pages():
+    return store
@@ -0,0 +1,80 @@
+import os
+import doc_store
+from database import connect
+from doc_store import get_doc_store, compact, compact_if_needed, recover_compaction
+
+pages = [('http://a.test/%d' % i, 'Page %d' % i, 'Text of page %d, ' % i * 200) for i in range(20)]
+
+# Text stored for every document, by URL
+def stored_texts(db_file):
+    connection = connect(db_file)
+    cursor = connection.cursor()
+    ids = dict(cursor.execute('SELECT id, url FROM documents').fetchall())
+    texts = get_doc_store(db_file, cursor).get_many(cursor, list(ids))
+    cursor.close()
+    connection.close()
+    return {ids[doc_id]: text for doc_id, text in texts.items()}
+
+def test_compact_keeps_live_text_only(db_file, write_pages):
+    write_pages(db_file, pages)
+    # Rewriting every page twice leaves the older copies as dead blocks, two thirds of the file
+    write_pages(db_file, [(url, title, 'Old ' + text) for url, title, text in pages])
+    rewritten = [(url, title, 'New ' + text) for url, title, text in pages]
+    write_pages(db_file, rewritten)
+    connection = connect(db_file)
+    store = get_doc_store(db_file, connection.cursor())
+    assert store.dead_bytes(connection.cursor()) > 0
+    before, after = compact_if_needed(connection, store)
+    assert after < before and os.path.getsize(store.path) == after
+    assert store.dead_bytes(connection.cursor()) == 0
+    assert compact_if_needed(connection, store) is None
+    connection.close()
+    assert stored_texts(db_file) == {url: text for url, _, text in rewritten}
+    # Writes after a compaction append to the new file
+    write_pages(db_file, [('http://b.test/', 'Later', 'Written after compaction')])
+    assert stored_texts(db_file)['http://b.test/'] == 'Written after compaction'
+
+def test_recover_compaction_finishes_the_swap(db_file, write_pages, monkeypatch):
+    write_pages(db_file, pages)
+    write_pages(db_file, [(url, title, 'New ' + text) for url, title, text in pages])
+    connection = connect(db_file)
+    cursor = connection.cursor()
+    store = get_doc_store(db_file, cursor)
+    # Crash after the new locations commit but before the file is swapped in
+    def crash(source, destination):
+        raise OSError('crashed')
+    monkeypatch.setattr(doc_store.os, 'replace', crash)
+    try:
+        compact(connection, store)
+    except OSError:
+        pass
+    monkeypatch.undo()
+    leftover = store.path + '.compact1'
+    assert os.path.exists(leftover)
+    # A file from an older compaction that never committed is removed
+    stale = store.path + '.compact0'
+    open(stale, 'wb').close()
+    recover_compaction(store, cursor)
+    assert not os.path.exists(leftover) and not os.path.exists(stale)
+    cursor.close()
+    connection.close()
+    assert stored_texts(db_file) == {url: 'New ' + text for url, _, text in pages}
+
+def test_failed_compaction_rolls_back(db_file, write_pages, monkeypatch):
+    write_pages(db_file, pages)
+    write_pages(db_file, pages[:5])
+    connection = connect(db_file)
+    store = get_doc_store(db_file, connection.cursor())
+    # Fail while writing the new file, before anything commits
+    def fail(*args):
+        raise OSError('disk full')
+    monkeypatch.setattr(doc_store.os, 'fsync', fail)
+    try:
+        compact(connection, store)
+    except OSError:
+        pass
+    monkeypatch.undo()
+    assert not os.path.exists(store.path + '.compact1')
+    assert connection.execute('SELECT compactions FROM document_store_state').fetchone()[0] == 0
+    connection.close()
+    assert stored_texts(db_file) == {url: text for url, _, text in pages}
@@ -0,0 +1,28 @@
+import pytest
+from fixture_server import recorded_results_page
+from engines import get_parser, default_parser
+from engine_config import search_engines
+
+# Result links the recorded pages are pointed at, one per {{url:N}} placeholder
+links = ['https://site%d.example.org/articles/page-%d?id=%d' % (i, i, i) for i in range(10)]
+
+@pytest.mark.parametrize('engine', ['Google', 'Bing', 'Yahoo', 'DuckDuckGo'])
+def test_parser_finds_results_in_order(engine):
+    page = recorded_results_page(engine, 'python web frameworks', links)
+    assert page is not None
+    # Ads, navigation and the engine's own links are left out
+    assert get_parser(engine).parse(page) == links
+
+def test_engines_without_a_parser_use_every_link():
+    assert get_parser('Yandex') is default_parser
+    page = '<html><body><a href="%s">One</a><a href="/ads/x">Ad</a><a href="%s">Two</a></body></html>' % (links[0], links[1])
+    assert default_parser.parse(page) == links[:2]
+
+def test_markup_changes_fall_back_to_every_link():
+    page = '<html><body><a href="/url?q=%s&sa=U">One</a></body></html>' % links[0]
+    assert get_parser('Google').parse(page) == links[:1]
+    page = '<html><body><div class="new"><a href="%s">One</a></div></body></html>' % links[0]
+    assert get_parser('Bing').parse(page) == links[:1]
+
+def test_results_page_urls():
+    assert get_parser('Bing').url('Bing', 'fish & chips') == search_engines['Bing'] + 'fish+%26+chips'
@@ -0,0 +1,70 @@
+import json
+import pytest
+import ingest
+from database import connect
+from doc_store import get_doc_store
+
+# JSONL records: a pre-extracted page, an HTML page and a line to skip, repeated
+def write_source(path, count):
+    with open(path, 'w') as f:
+        for i in range(count):
+            text = 'Page %d body text long enough to pass the data filter, about ingestion' % i
+            if i % 2:
+                f.write(json.dumps({'url': 'http://a.test/%d' % i, 'html': '<title>Page %d</title><p>%s</p>' % (i, text)}) + '\n')
+            else:
+                f.write(json.dumps({'url': 'http://a.test/%d' % i, 'title': 'Page %d' % i, 'text': text}) + '\n')
+        f.write('not json\n')
+
+def stored(db_file):
+    connection = connect(db_file)
+    cursor = connection.cursor()
+    urls = dict(cursor.execute('SELECT id, url FROM documents').fetchall())
+    texts = get_doc_store(db_file, cursor).get_many(cursor, list(urls))
+    checkpoint = cursor.execute('SELECT position, documents FROM ingest_checkpoints').fetchone()
+    cursor.close()
+    connection.close()
+    return {urls[doc_id]: text for doc_id, text in texts.items()}, checkpoint
+
+# Stands in for a crash or Ctrl-C partway through a run
+class Interrupted(Exception):
+    pass
+
+@pytest.fixture
+def small_batches(monkeypatch):
+    monkeypatch.setattr(ingest, 'chunk_size', 2)
+
+def test_ingest_writes_every_record(db_file, tmp_path, small_batches):
+    source = str(tmp_path / 'pages.jsonl')
+    write_source(source, 6)
+    written, _ = ingest.ingest([source], db_file, batch_size=2, workers=1)
+    documents, checkpoint = stored(db_file)
+    assert written == 6 and len(documents) == 6 and checkpoint == (6, 6)
+    assert documents['http://a.test/1'].strip().startswith('Page 1 body text')
+    # A finished source is skipped on the next run
+    assert ingest.ingest([source], db_file, batch_size=2, workers=1)[0] == 0
+
+def test_interrupted_ingest_resumes_after_last_batch(db_file, tmp_path, small_batches, monkeypatch):
+    source = str(tmp_path / 'pages.jsonl')
+    write_source(source, 6)
+    write_batch = ingest.write_batch
+    calls = []
+    # Fail the first run's second batch, after the first committed; args[3] is the batch's end position
+    def interrupted(*args, **kwargs):
+        calls.append(args[3])
+        if calls == [2, 4]:
+            raise Interrupted
+        return write_batch(*args, **kwargs)
+    monkeypatch.setattr(ingest, 'write_batch', interrupted)
+    with pytest.raises(Interrupted):
+        ingest.ingest([source], db_file, batch_size=2, workers=1)
+    documents, checkpoint = stored(db_file)
+    assert set(documents) == {'http://a.test/0', 'http://a.test/1'} and checkpoint == (2, 2)
+
+    # The rerun starts after the checkpoint rather than writing the first batch again
+    written, _ = ingest.ingest([source], db_file, batch_size=2, workers=1)
+    assert written == 4 and calls == [2, 4, 4, 6]
+    documents, checkpoint = stored(db_file)
+    assert len(documents) == 6 and checkpoint == (6, 6)
+
+    # --restart ingests the source from the start
+    assert ingest.ingest([source], db_file, batch_size=2, workers=1, restart=True)[0] == 6
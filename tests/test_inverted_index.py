@@ -0,0 +1,84 @@
+import threading
+import inverted_index
+from inverted_index import InvertedIndex, ReadWriteLock, get_index, start_index
+from database import connect
+from doc_store import get_doc_store
+
+pages = [('http://a.test/1', 'Python web frameworks', 'Flask and Django are Python web frameworks'),
+         ('http://a.test/2', 'Snakes', 'The python is a large snake found in Africa and Asia'),
+         ('http://a.test/3', 'Cooking', 'Recipes for bread and soup')]
+
+def test_bm25_ranks_by_term_frequency_and_rarity():
+    index = InvertedIndex()
+    index.add_document(1, 'python', 'python python tutorial')
+    index.add_document(2, 'python', 'snake')
+    index.add_document(3, 'cooking', 'tutorial bread')
+    ranked = index.top_k(['python'], 10)
+    assert [doc_id for _, doc_id in ranked] == [1, 2]
+    assert ranked[0][0] > ranked[1][0] > 0
+    # A rarer term weighs more than a common one at the same frequency
+    assert index.idf('snake') > index.idf('python')
+    assert index.top_k(['missing']) == []
+    assert index.top_k(['python', 'tutorial'], 1)[0][1] == 1
+
+def test_positions_and_removal():
+    index = InvertedIndex()
+    index.add_document(1, 'a b', 'a c')
+    assert index.positions('a', 1) == [0, 2]
+    assert index.term_frequency('a', 1) == 2
+    index.add_document(1, 'd', '')
+    assert index.positions('a', 1) == [] and 'a' not in index.postings
+    index.remove_document(1)
+    assert index.doc_lengths == {} and index.total_length == 0
+
+def test_refresh_picks_up_inserts(db_file, write_pages):
+    write_pages(db_file, pages[:2])
+    index = get_index(db_file, connect(db_file).cursor())
+    assert len(index.doc_lengths) == 2
+    write_pages(db_file, pages[2:])
+    index = get_index(db_file, connect(db_file).cursor())
+    assert len(index.doc_lengths) == 3
+    assert index.top_k(['bread'])[0][1] in index.doc_lengths
+
+def test_refresh_declines_after_delete_and_index_is_rebuilt(db_file, write_pages):
+    write_pages(db_file, pages)
+    connection = connect(db_file)
+    cursor = connection.cursor()
+    index = get_index(db_file, cursor)
+    with connection:
+        cursor.execute("DELETE FROM documents WHERE url = 'http://a.test/3'")
+        cursor.execute('UPDATE index_generation SET generation = generation + 1')
+    # Counts no longer match, so the index can't be updated in place
+    assert index.refresh(cursor, get_doc_store(db_file, cursor)) is False
+    rebuilt = get_index(db_file, cursor)
+    assert rebuilt is not index
+    assert len(rebuilt.doc_lengths) == 2 and rebuilt.top_k(['bread']) == []
+
+def test_build_that_never_settles_is_not_published(db_file, write_pages, monkeypatch):
+    write_pages(db_file, pages)
+    monkeypatch.setattr(InvertedIndex, 'refresh', lambda self, cursor, store, limit=None: False)
+    start_index(db_file).join()
+    assert db_file not in inverted_index.indexes
+    # Searches keep using FTS5 until a later build succeeds
+    assert get_index(db_file, connect(db_file).cursor(), wait=True) is None
+    monkeypatch.undo()
+    start_index(db_file).join()
+    assert len(inverted_index.indexes[db_file].doc_lengths) == 3
+
+def test_too_big_to_index(db_file, write_pages, monkeypatch):
+    monkeypatch.setattr(inverted_index, 'max_documents', 2)
+    write_pages(db_file, pages)
+    assert get_index(db_file, connect(db_file).cursor()) is None
+    assert inverted_index.indexes[db_file] is None
+
+def test_writer_waits_for_readers_and_blocks_new_ones():
+    lock = ReadWriteLock()
+    events = []
+    with lock.read():
+        writer = threading.Thread(target=lambda: lock.write().__enter__() or events.append('write'))
+        writer.start()
+        writer.join(0.1)
+        # The writer is waiting on this reader
+        assert events == []
+    writer.join(1)
+    assert events == ['write']
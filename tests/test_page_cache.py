@@ -0,0 +1,62 @@
+import time
+import pytest
+from page_cache import PageCache
+from extraction import ExtractionPool
+
+page = '<html><head><title>Cached</title></head><body><p>Cached page text</p></body></html>'
+error_page = '<html><head><title>Not Found</title></head><body><p>No such page</p></body></html>'
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = PageCache(str(tmp_path / 'pages.db'), ttl=60)
+    yield cache
+    cache.connection.close()
+
+@pytest.fixture(scope='module')
+def pool():
+    pool = ExtractionPool(1)
+    yield pool
+    pool.close()
+
+# Age the cached copy of a URL past the cache's ttl
+def make_stale(cache, url):
+    cache.connection.execute('UPDATE pages SET fetched_at = ? WHERE url = ?', (time.time() - 3600, url))
+    cache.connection.commit()
+
+def test_get_and_put(cache):
+    assert cache.get('http://a.test/') is None
+    cache.put('http://a.test/', page, etag='"v1"')
+    html, etag, last_modified, fresh = cache.get('http://a.test/')
+    assert (html, etag, last_modified, fresh) == (page, '"v1"', None, True)
+    assert cache.conditional_headers(etag, last_modified) == {'If-None-Match': '"v1"'}
+
+def test_extracted_text_reused_for_fresh_copy(cache, pool):
+    cache.put('http://a.test/', page)
+    assert list(pool.extract([(page, 'http://a.test/')], cache)) == [((' Cached page text', 'Cached'), 'http://a.test/')]
+    cache.put_extracted('http://a.test/', 'stored text', 'Stored')
+    # A fresh hit reuses the stored text without parsing
+    assert list(pool.extract([(page, 'http://a.test/')], cache)) == [(('stored text', 'Stored'), 'http://a.test/')]
+
+def test_revalidated_copy_reuses_extracted_text(cache):
+    cache.put('http://a.test/', page)
+    cache.put_extracted('http://a.test/', 'stored text', 'Stored')
+    make_stale(cache, 'http://a.test/')
+    cache.touch('http://a.test/')
+    assert cache.get_extracted('http://a.test/') == ('stored text', 'Stored')
+
+def test_failed_refetch_of_stale_copy_is_parsed(cache, pool):
+    cache.put('http://a.test/', page)
+    cache.put_extracted('http://a.test/', 'stored text', 'Stored')
+    make_stale(cache, 'http://a.test/')
+    # The refetch returned a 404 page that was not stored: it is parsed, not replaced by the old text
+    assert list(pool.extract([(error_page, 'http://a.test/')], cache)) == [((' No such page', 'Not Found'), 'http://a.test/')]
+    # and its text is not saved with the cached body
+    assert cache.connection.execute('SELECT text FROM pages WHERE url = ?', ('http://a.test/',)).fetchone() == ('stored text',)
+
+def test_eviction_keeps_under_max_bytes(tmp_path):
+    cache = PageCache(str(tmp_path / 'pages.db'), ttl=60, max_bytes=200)
+    for i in range(20):
+        cache.put('http://a.test/%d' % i, page + str(i) * 100)
+    assert 0 < cache.total_bytes <= 200
+    assert cache.get('http://a.test/19') is not None
+    cache.connection.close()
@@ -0,0 +1,33 @@
+import sys
+import types
+import pytest
+from query_analyzer import build_analyzer, regex_tokenize
+
+def test_regex_analyzer_drops_stopwords_and_keeps_contractions():
+    analyzer = build_analyzer('regex')
+    assert regex_tokenize("don't stop") == ["don't", 'stop']
+    assert analyzer.analyze('What is the best Python web framework') == ['best', 'Python', 'web', 'framework']
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        build_analyzer('stemmed')
+
+# Stand-in for an NLTK install whose tokenizer data is missing and can't be downloaded, as offline
+@pytest.fixture
+def nltk_without_data(monkeypatch):
+    def missing(*args):
+        raise LookupError('Resource punkt_tab not found')
+    nltk = types.ModuleType('nltk')
+    nltk.data = types.SimpleNamespace(find=missing)
+    nltk.download = lambda resource, quiet=False: False
+    tokenize = types.ModuleType('nltk.tokenize')
+    tokenize.word_tokenize = missing
+    corpus = types.ModuleType('nltk.corpus')
+    corpus.stopwords = types.SimpleNamespace(words=lambda language: ['the'])
+    for name, module in (('nltk', nltk), ('nltk.tokenize', tokenize), ('nltk.corpus', corpus)):
+        monkeypatch.setitem(sys.modules, name, module)
+
+def test_nltk_mode_falls_back_to_regex_without_data(nltk_without_data):
+    analyzer = build_analyzer('nltk')
+    assert analyzer.tokenizer is regex_tokenize
+    assert analyzer.analyze('the quick fox') == ['quick', 'fox']
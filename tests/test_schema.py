@@ -0,0 +1,51 @@
+import sqlite3
+import schema
+from database import connect
+from doc_store import get_doc_store
+from fts_index import fts_search
+
+# Tables every migrated database has
+tables = {'searches', 'recent_searches', 'documents', 'search_hits', 'document_fingerprints', 'document_text',
+          'document_dictionaries', 'ingest_checkpoints', 'document_store_state', 'documents_fts'}
+
+def table_names(connection):
+    return {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+def test_fresh_database_is_migrated_to_latest(db_file):
+    connection = connect(db_file)
+    assert connection.execute('PRAGMA user_version').fetchone()[0] == schema.schema_version
+    assert tables <= table_names(connection)
+    assert 'search_results' not in table_names(connection)
+    # Migrating again is a no-op
+    assert schema.migrate(connection) == schema.schema_version
+    connection.close()
+
+def test_v1_database_keeps_its_results(db_file):
+    connection = sqlite3.connect(db_file)
+    for statement in schema.schema_v1:
+        connection.execute(statement)
+    connection.execute("INSERT INTO searches (search_query, search_engine) VALUES ('apple pie', 'Google')")
+    connection.executemany('INSERT INTO search_results (url, title, description, search_id) VALUES (?, ?, ?, ?)',
+                           [('http://a.test/pie', 'Apple pie', 'An apple pie recipe with cinnamon', 1),
+                            ('http://a.test/pie', 'Apple pie', 'An apple pie recipe with cinnamon', 1),
+                            ('http://b.test/tart', 'Pear tart', 'A pear tart with almonds', 1)])
+    connection.execute('PRAGMA user_version = 1')
+    connection.commit()
+    connection.close()
+
+    connection = connect(db_file)
+    cursor = connection.cursor()
+    assert cursor.execute('PRAGMA user_version').fetchone()[0] == schema.schema_version
+    assert 'search_results' not in table_names(connection)
+    # Duplicate rows collapse into one document, still linked to the search
+    documents = dict(cursor.execute('SELECT url, id FROM documents').fetchall())
+    assert set(documents) == {'http://a.test/pie', 'http://b.test/tart'}
+    assert cursor.execute('SELECT COUNT(*) FROM search_hits WHERE search_id = 1').fetchone()[0] == 2
+    # Text moved to the document store, and the FTS index and fingerprints cover the old rows
+    store = get_doc_store(db_file, cursor)
+    assert store.get(cursor, documents['http://a.test/pie']) == 'An apple pie recipe with cinnamon'
+    assert cursor.execute('SELECT COUNT(*) FROM documents WHERE description IS NOT NULL').fetchone()[0] == 0
+    assert [row[1] for row in fts_search(cursor, ['almonds'])] == ['http://b.test/tart']
+    assert cursor.execute('SELECT COUNT(*) FROM document_fingerprints').fetchone()[0] == 2
+    cursor.close()
+    connection.close()
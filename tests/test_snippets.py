@@ -0,0 +1,13 @@
+from snippets import build_snippet, snippet_segments
+
+def test_snippet_marks_terms_and_escapes_text():
+    snippet = build_snippet('Fish & <chips> are tasty fish', ['fish'])
+    assert snippet == '<mark>Fish</mark> &amp; &lt;chips&gt; are tasty <mark>fish</mark>'
+
+def test_segments_are_plain_text():
+    snippet = build_snippet('Fish & <chips> are tasty fish', ['fish'])
+    assert snippet_segments(snippet) == [['Fish', True], [' & <chips> are tasty ', False], ['fish', True]]
+
+def test_segments_without_marks():
+    assert snippet_segments('no &lt;b&gt; here') == [['no <b> here', False]]
+    assert snippet_segments('') == []
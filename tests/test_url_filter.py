@@ -0,0 +1,63 @@
+import pytest
+from url_filter import UrlFilter, get_url_filter
+from engine_config import block_list, ad_block_list, filter_function
+
+@pytest.fixture
+def url_filter():
+    url_filter = UrlFilter()
+    url_filter.add_lists(block_list, ad_block_list)
+    return url_filter
+
+@pytest.mark.parametrize('url', [
+    'https://example.com/reader/article',
+    'https://example.com/download?file=report',
+    'https://shadow.example.com/news',
+    'https://example.com/a/b.html',
+    'https://www.google.com/url?q=https://example.com/page&sa=U',
+])
+def test_allowed(url_filter, url):
+    assert url_filter.check(url) is None
+
+@pytest.mark.parametrize('url, match', [
+    ('https://example.com/ad/banner', ('token', 'ad')),
+    ('https://ads.example.com/page', ('token', 'ads')),
+    ('https://example.com/page?popup=1', ('token', 'popup')),
+    ('https://example.com/report.pdf', ('extension', 'pdf')),
+    ('https://example.com/IMAGE.PNG', ('extension', 'png')),
+    ('https://example.com/cdn-cgi/l/email-protection', ('pattern', 'cdn-cgi')),
+    ('javascript:void(0)', ('pattern', 'javascript:')),
+    ('https://example.com/page#section', ('pattern', '#')),
+])
+def test_blocked(url_filter, url, match):
+    assert url_filter.check(url) == match
+
+def test_easylist_rules(url_filter):
+    assert url_filter.add_easylist_rule('||tracker.test^')
+    assert url_filter.add_easylist_rule('/sponsored/*/click')
+    assert url_filter.add_easylist_rule('@@||good.tracker.test^')
+    assert url_filter.add_easylist_rule('||popups.test^$popup')
+    # Comments, element hiding and resource-type rules don't apply to links
+    assert not url_filter.add_easylist_rule('! comment')
+    assert not url_filter.add_easylist_rule('example.com##.banner')
+    assert not url_filter.add_easylist_rule('||images.test^$image')
+    assert url_filter.check('https://cdn.tracker.test/page') == ('host', 'tracker.test')
+    assert url_filter.check('https://good.tracker.test/page') is None
+    assert url_filter.check('https://nottracker.test/page') is None
+    assert url_filter.check('https://example.com/sponsored/x/click') == ('pattern', '/sponsored/*/click')
+    assert url_filter.check('https://example.com/sponsored/x') is None
+    assert url_filter.check('https://popups.test/') == ('host', 'popups.test')
+    assert url_filter.check('https://images.test/') is None
+
+def test_stats_count_checks(url_filter):
+    url_filter.check('https://example.com/ad/')
+    url_filter.check('https://example.com/ad/')
+    url_filter.check('https://example.com/')
+    stats = url_filter.stats()
+    assert stats['checked'] == 3 and stats['blocked'] == 2
+    assert stats['top_rules'] == [(('token', 'ad'), 2)]
+
+def test_filter_function():
+    assert get_url_filter(block_list, ad_block_list) is get_url_filter(block_list, ad_block_list)
+    assert filter_function('https://example.com/reader/', block_list, ad_block_list)
+    assert not filter_function('/relative/path', block_list, ad_block_list)
+    assert not filter_function('https://example.com/ads/', block_list, ad_block_list)
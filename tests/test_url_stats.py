@@ -0,0 +1,70 @@
+import sqlite3
+import pytest
+import mysql.connector
+import url_stats
+from url_stats import store_results, get_connection, sqlite_schema
+
+results = [('https://example.com/a', 'Google', 2, 'Example: Python tips', 'Python and Flask', 'Text'),
+           ('https://example.org/b', 'Google', 2, 'Example: Flask', 'A web framework', 'Text'),
+           ('https://example.net/c.pdf', 'Google', 2, 'Example: Guide', 'No Description', 'PDF')]
+
+# SQLite stand-in for the MySQL tables store_results writes
+@pytest.fixture
+def cnx():
+    cnx = sqlite3.connect(':memory:')
+    for statement in sqlite_schema:
+        cnx.execute(statement)
+    yield cnx
+    cnx.close()
+
+def test_store_results_returns_new_ids(cnx):
+    stored = store_results(cnx, 'python flask', 'google', results)
+    assert stored == [(1, 'https://example.com/a', 'Text'), (2, 'https://example.org/b', 'Text'), (3, 'https://example.net/c.pdf', 'PDF')]
+    # A second search for the same query only reports the rows it added
+    assert [row[0] for row in store_results(cnx, 'python flask', 'google', results[:1])] == [4]
+    assert cnx.execute('SELECT Results_ID, title, info_type FROM parsed_url ORDER BY Results_ID').fetchall()[:3] == \
+        [(1, 'Example: Python tips', 'Text'), (2, 'Example: Flask', 'Text'), (3, 'Example: Guide', 'PDF')]
+
+def test_store_results_counts_terms_per_result(cnx):
+    store_results(cnx, 'Python Flask', 'google', results)
+    rows = cnx.execute('SELECT Stats_ID, stats_url, occurrence_count FROM url_stats ORDER BY Stats_ID, rowid').fetchall()
+    # One row per result and query term: 'python' is in one result, 'flask' in two
+    assert rows == [(1, 'https://example.com/a', 1), (1, 'https://example.com/a', 2),
+                    (2, 'https://example.org/b', 1), (2, 'https://example.org/b', 2),
+                    (3, 'https://example.net/c.pdf', 1), (3, 'https://example.net/c.pdf', 2)]
+
+def test_store_results_counts_over_counted_results(cnx):
+    store_results(cnx, 'flask', 'google', results[:1], counted_results=results)
+    assert cnx.execute('SELECT occurrence_count FROM url_stats').fetchall() == [(2,)]
+
+def test_store_results_without_results(cnx):
+    assert store_results(cnx, 'python', 'google', []) == []
+    assert cnx.execute('SELECT COUNT(*) FROM search_term').fetchone()[0] == 0
+
+def test_store_results_rolls_back_and_raises(cnx):
+    cnx.execute('DROP TABLE url_stats')
+    with pytest.raises(sqlite3.Error):
+        store_results(cnx, 'python flask', 'google', results)
+    # The search_term and parsed_url rows written before the failure are gone
+    assert cnx.execute('SELECT COUNT(*) FROM search_term').fetchone()[0] == 0
+    assert cnx.execute('SELECT COUNT(*) FROM parsed_url').fetchone()[0] == 0
+
+# Pool that is empty for the first few checkouts
+class BusyPool:
+    def __init__(self, busy):
+        self.busy = busy
+
+    def get_connection(self):
+        if self.busy:
+            self.busy -= 1
+            raise mysql.connector.errors.PoolError('Failed getting connection; pool exhausted')
+        return 'connection'
+
+def test_get_connection_waits_for_a_free_connection(monkeypatch):
+    monkeypatch.setattr(url_stats, 'pool', BusyPool(3))
+    assert get_connection({}) == 'connection'
+
+def test_get_connection_gives_up_after_timeout(monkeypatch):
+    monkeypatch.setattr(url_stats, 'pool', BusyPool(1000))
+    with pytest.raises(mysql.connector.errors.PoolError):
+        get_connection({}, timeout=0.2)
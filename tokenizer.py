@@ -0,0 +1,8 @@
+import re
+
+# Pattern used to split titles and descriptions into index terms
+token_pattern = re.compile(r'\w+')
+
+# Function for splitting text into lowercase index terms
+def tokenize(text):
+    return token_pattern.findall(text.lower())
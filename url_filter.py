@@ -0,0 +1,257 @@
+import os
+import re
+import sys
+import threading
+import urllib.parse
+from collections import Counter, deque
+from metrics import count
+
+# Compiled URL filter for links scraped from results pages
+# Block rules are compiled once into structures that each check visits in time linear in the URL:
+#   host rules      blocked domains and their subdomains, looked up per host suffix in a set
+#   token rules     words such as 'ad' or 'banner' matched as whole host labels or path/query words,
+#                   so /ad/ and ads.example.com are blocked but /reader/ and /download are not
+#   extension rules file extensions of the last path segment, e.g. pdf or png
+#   pattern rules   substrings and EasyList-style path patterns, all found in one pass by an
+#                   Aho-Corasick automaton; wildcard patterns are keyed by their longest literal
+#                   and confirmed with a regex only when that literal occurs
+# Exception rules (EasyList @@ lines) are kept the same way and only consulted for blocked URLs.
+
+# Splits URLs into words for token rules
+word_pattern = re.compile(r'[a-z0-9]+')
+# Dotted extensions in the last path segment
+extension_pattern = re.compile(r'\.([a-z0-9]+)')
+# EasyList options that still apply when the rule is used on a link rather than a page resource
+page_options = {'third-party', '~third-party', 'document', 'popup', 'match-case'}
+# Extra blocklists loaded into the default filter, separated by os.pathsep
+blocklist_paths = os.environ.get('URL_BLOCKLIST', '')
+
+# Aho-Corasick automaton: finds every added pattern that occurs in a text in one pass over the text
+class PatternAutomaton:
+    def __init__(self):
+        # Per state: transitions, failure link, values of the patterns ending there,
+        # and those values plus the ones of every pattern ending in a suffix, filled in by build
+        self.goto = [{}]
+        self.fail = [0]
+        self.values = {}
+        self.output = {}
+        self.built = True
+
+    # Add a pattern, reported as value when it occurs
+    def add(self, pattern, value):
+        state = 0
+        for char in pattern:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = self.goto[state][char] = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+            state = next_state
+        self.values.setdefault(state, []).append(value)
+        self.built = False
+
+    # Compute failure links breadth-first, merging each state's outputs with its failure state's
+    def build(self):
+        self.output = {state: list(values) for state, values in self.values.items()}
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                if self.fail[next_state] in self.output:
+                    self.output[next_state] = self.output.get(next_state, []) + self.output[self.fail[next_state]]
+        self.built = True
+
+    # Yield the value of every pattern occurrence in text
+    def search(self, text):
+        if not self.built:
+            self.build()
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if state in output:
+                yield from output[state]
+
+# Turn an EasyList pattern into (literal, regex): the longest literal part keys the automaton, and regex
+# (None for a plain substring) confirms a match; returns None for patterns with no usable literal
+def compile_pattern(pattern):
+    host_anchor = pattern.startswith('||')
+    start_anchor = not host_anchor and pattern.startswith('|')
+    end_anchor = pattern.endswith('|')
+    body = pattern[2 if host_anchor else 1 if start_anchor else 0:len(pattern) - 1 if end_anchor else len(pattern)]
+    literal = max(re.split(r'[*^]', body), key=len)
+    if not literal:
+        return None
+    if not (host_anchor or start_anchor or end_anchor or '*' in body or '^' in body):
+        return literal, None
+    regex = ''.join('.*' if char == '*' else r'(?:[^\w.%-]|$)' if char == '^' else re.escape(char) for char in body)
+    if host_anchor:
+        regex = r'^[a-z][a-z0-9+.-]*://(?:[^/?#]*\.)?' + regex
+    elif start_anchor:
+        regex = '^' + regex
+    if end_anchor:
+        regex += '$'
+    return literal, re.compile(regex)
+
+# Rules of one polarity (block or exception)
+class RuleSet:
+    def __init__(self):
+        self.hosts = set()
+        self.tokens = set()
+        self.extensions = set()
+        self.automaton = PatternAutomaton()
+        # Pattern rules by index, as (rule text, regex or None)
+        self.patterns = []
+
+    # Add a pattern rule; returns False if it has nothing to match on
+    def add_pattern(self, rule):
+        compiled = compile_pattern(rule)
+        if compiled is None:
+            return False
+        literal, regex = compiled
+        self.automaton.add(literal, len(self.patterns))
+        self.patterns.append((rule, regex))
+        return True
+
+    # Find the first rule matching a URL, as (kind, rule), or None
+    # url is the lowercased link and target the URL it points to; host, words and extensions come from target
+    def match(self, url, target, host, words, extensions):
+        labels = host.split('.')
+        for i in range(len(labels) - 1):
+            suffix = '.'.join(labels[i:])
+            if suffix in self.hosts:
+                return 'host', suffix
+        for word in words:
+            if word in self.tokens:
+                return 'token', word
+        for extension in extensions:
+            if extension in self.extensions:
+                return 'extension', extension
+        for index in self.automaton.search(url):
+            rule, regex = self.patterns[index]
+            if regex is None or regex.search(target):
+                return 'pattern', rule
+        return None
+
+    # Number of rules of each kind
+    def sizes(self):
+        return {'host': len(self.hosts), 'token': len(self.tokens), 'extension': len(self.extensions), 'pattern': len(self.patterns)}
+
+# Block rules plus exceptions, with counts of what they matched
+class UrlFilter:
+    def __init__(self):
+        self.blocked = RuleSet()
+        self.allowed = RuleSet()
+        self.checked = 0
+        self.hits = Counter()
+        self.lock = threading.Lock()
+
+    # Add the repo's simple lists: block_list entries like '.pdf' are extensions and the rest substrings,
+    # ad_block_list entries are whole words
+    def add_lists(self, block_list=(), ad_block_list=()):
+        for entry in block_list:
+            entry = entry.lower()
+            if entry.startswith('.') and entry[1:].isalnum():
+                self.blocked.extensions.add(entry[1:])
+            else:
+                self.blocked.add_pattern(entry)
+        for entry in ad_block_list:
+            entry = entry.lower()
+            if entry.isalnum():
+                self.blocked.tokens.add(entry)
+            else:
+                self.blocked.add_pattern(entry)
+
+    # Add one EasyList-style line; returns whether it became a rule
+    # Element hiding rules, regex rules and rules limited to resource types or sites don't apply to links and are skipped
+    def add_easylist_rule(self, line):
+        line = line.strip().lower()
+        if not line or line.startswith(('!', '[')) or re.search(r'#[@?$]?#', line):
+            return False
+        rules = self.blocked
+        if line.startswith('@@'):
+            rules, line = self.allowed, line[2:]
+        if '$' in line:
+            line, options = line.rsplit('$', 1)
+            if not set(options.split(',')) <= page_options:
+                return False
+        if not line or (line.startswith('/') and line.endswith('/') and len(line) > 1):
+            return False
+        # ||example.com^ blocks a domain and its subdomains
+        host = re.fullmatch(r'\|\|([a-z0-9.-]+)\^?', line)
+        if host:
+            rules.hosts.add(host.group(1))
+            return True
+        return rules.add_pattern(line)
+
+    # Load an EasyList-style file; returns the number of rules added
+    def load_easylist(self, path):
+        with open(path, encoding='utf-8', errors='replace') as f:
+            return sum(self.add_easylist_rule(line) for line in f)
+
+    # Classify a link: the (kind, rule) that blocks it, or None if it is allowed
+    def check(self, url):
+        url = url.lower()
+        # Links may wrap their target, as Google's /url?q=https://... does
+        target = url[max(0, url.find('http')):]
+        parts = urllib.parse.urlsplit(target)
+        host = parts.hostname or ''
+        words = word_pattern.findall(host + ' ' + parts.path + ' ' + parts.query)
+        extensions = extension_pattern.findall(parts.path.rsplit('/', 1)[-1])
+        match = self.blocked.match(url, target, host, words, extensions)
+        if match is not None and self.allowed.match(url, target, host, words, extensions) is not None:
+            match = None
+        with self.lock:
+            self.checked += 1
+            if match is not None:
+                self.hits[match] += 1
+        if match is not None:
+            count('urls_blocked_total', kind=match[0])
+        return match
+
+    # Whether a link passes the filter
+    def allows(self, url):
+        return self.check(url) is None
+
+    # Rule sizes, URLs checked and blocked, and the rules that matched most
+    def stats(self, top=10):
+        with self.lock:
+            return {'rules': self.blocked.sizes(), 'exceptions': self.allowed.sizes(), 'checked': self.checked,
+                    'blocked': sum(self.hits.values()), 'top_rules': self.hits.most_common(top)}
+
+# One compiled filter per pair of lists, shared by every crawl in the process
+filters = {}
+filters_lock = threading.Lock()
+
+# Get the filter for block lists, compiling it with any URL_BLOCKLIST files on first use
+def get_url_filter(block_list=(), ad_block_list=()):
+    key = (tuple(block_list), tuple(ad_block_list))
+    with filters_lock:
+        url_filter = filters.get(key)
+        if url_filter is None:
+            url_filter = UrlFilter()
+            url_filter.add_lists(block_list, ad_block_list)
+            for path in filter(None, blocklist_paths.split(os.pathsep)):
+                print('Loaded %d rules from %s' % (url_filter.load_easylist(path), path))
+            url_filter.blocked.automaton.build()
+            url_filter.allowed.automaton.build()
+            filters[key] = url_filter
+    return url_filter
+
+# Check URLs read from stdin against the default lists and blocklist files: python url_filter.py [blocklist ...] < urls
+if __name__ == '__main__':
+    from engine_config import block_list, ad_block_list
+    url_filter = get_url_filter(block_list, ad_block_list)
+    for path in sys.argv[1:]:
+        print('Loaded %d rules from %s' % (url_filter.load_easylist(path), path))
+    for line in sys.stdin:
+        match = url_filter.check(line.strip())
+        print('%s\t%s' % ('blocked by %s %s' % match if match else 'allowed', line.strip()))
+    print(url_filter.stats())